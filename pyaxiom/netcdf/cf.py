@@ -3,8 +3,11 @@
 import os
 from datetime import datetime
 
+import numpy as np
+
 from pyaxiom.utils import all_subclasses
 from pyaxiom.netcdf import EnhancedDataset
+from pyaxiom.netcdf.utils import isstr, in_range, time_value, feature_batches, apply_chunk_layout
 
 from pyaxiom import logger
 
@@ -14,6 +17,12 @@ class CFDataset(EnhancedDataset):
     default_fill_value = -9999.9
     default_time_unit = 'seconds since 1990-01-01 00:00:00'
 
+    def __init__(self, *args, **kwargs):
+        super(CFDataset, self).__init__(*args, **kwargs)
+        # The chunk cache is not stored in the file, set it for the layout
+        # the file was written with each time it is opened
+        apply_chunk_layout(self)
+
     @classmethod
     def load(cls, path):
 
@@ -88,6 +97,116 @@ class CFDataset(EnhancedDataset):
                     ancillary_variables.append(self.variables[av])
         return list(set(ancillary_variables))
 
+    def coordinate_columns(self, columns, coordinates=None):
+        """
+        The coordinate `columns` that `to_dataframe` returns, limited to the
+        ones in `coordinates` when it is given.
+        """
+        if coordinates is None:
+            return list(columns)
+
+        unknown = set(coordinates).difference(columns)
+        if unknown:
+            raise ValueError("Unknown coordinate columns {}, expected some of {}".format(sorted(unknown), list(columns)))
+        return [ c for c in columns if c in coordinates ]
+
+    def coordinate_mask(self, tvar, xvar, yvar, start=None, end=None, bbox=None, cache=None):
+        """
+        Boolean array of the elements of the time, x and y variables between
+        `start` and `end` (anything pandas can parse as a Timestamp) and
+        inside `bbox` (min x, min y, max x, max y). Compares the raw values,
+        so no times are decoded. With a `cache` dict the mask is only
+        calculated the first time, see `read_cached`.
+        """
+        key = ('coordinate_mask', tvar.name, xvar.name, yvar.name)
+        if cache is None or key not in cache:
+            keep = np.ones(tvar.shape, dtype=bool).flatten()
+            if start is not None or end is not None:
+                keep &= in_range(tvar[:].flatten(), time_value(tvar, start), time_value(tvar, end))
+            if bbox is not None:
+                keep &= in_range(xvar[:].flatten(), bbox[0], bbox[2])
+                keep &= in_range(yvar[:].flatten(), bbox[1], bbox[3])
+            if cache is None:
+                return keep
+            cache[key] = keep
+        # Callers combine the mask with their own filters in place
+        return cache[key].copy()
+
+    def read_cached(self, var, cache=None):
+        """
+        All of the values of `var`. A `cache` dict is shared by the batches
+        of `iter_dataframes` so the coordinate mask and the count, index and
+        depth variables are only read from disk once, by the first batch.
+        """
+        if cache is None:
+            return var[:]
+        key = ('values', var.name)
+        if key not in cache:
+            cache[key] = var[:]
+        return cache[key]
+
+    def extract_vars(self, variables=None):
+        """
+        The data and ancillary variables that `to_dataframe` reads. A list of
+        `variables` limits them to the ones matching any of its items: a
+        variable name, a dict of attribute filters (see
+        `get_variables_by_attributes`) or a callable given each Variable.
+        """
+        extract_vars = list(set(self.data_vars() + self.ancillary_vars()))
+        if variables is None:
+            return extract_vars
+
+        if isstr(variables) or isinstance(variables, dict) or callable(variables):
+            variables = [variables]
+
+        def matches(var, selector):
+            if isinstance(selector, dict):
+                return var in self.get_variables_by_attributes(**selector)
+            elif callable(selector):
+                return bool(selector(var))
+            return var.name == selector
+
+        return [ v for v in extract_vars if any( matches(v, s) for s in variables ) ]
+
+    def feature_sizes(self):
+        """
+        The number of rows `to_dataframe` reads for each feature (profile,
+        trajectory or station) in the file, in file order. Padded layouts
+        count their padding.
+        """
+        raise NotImplementedError
+
+    def iter_features(self, **kwargs):
+        """
+        Yields a DataFrame for each feature in the file, reading only its
+        slices from disk. Takes the same keyword arguments as
+        `to_dataframe`, features without any rows are skipped.
+        """
+        n = len(self.feature_sizes())
+        for df in self._iter_batches(n, [ (i, i + 1) for i in range(n) ], **kwargs):
+            yield df
+
+    def iter_dataframes(self, max_rows=None, **kwargs):
+        """
+        Yields DataFrames of whole features holding up to `max_rows` rows
+        each (a single feature larger than `max_rows` is yielded on its own),
+        reading only their slices from disk. Takes the same keyword arguments
+        as `to_dataframe`, batches without any rows are skipped. Distances
+        are calculated within each DataFrame.
+        """
+        sizes = self.feature_sizes()
+        for df in self._iter_batches(len(sizes), feature_batches(sizes, max_rows), **kwargs):
+            yield df
+
+    def _iter_batches(self, n, batches, **kwargs):
+        kwargs['cache'] = {}
+        for start, stop in batches:
+            instances = np.zeros(n, dtype=bool)
+            instances[start:stop] = True
+            df = self.to_dataframe(instances=instances, **kwargs)
+            if not df.empty:
+                yield df
+
     def nc_attributes(self):
         return {
             'global' : {
@@ -1,2 +1,2 @@
-from pyaxiom.netcdf.sensors.timeseries import TimeSeries, get_dataframe_from_variable
+from pyaxiom.netcdf.sensors.timeseries import TimeSeries, get_dataframe_from_variable, get_dataframe_from_variables
 from pyaxiom.netcdf.sensors.profile import Profile, IncompleteProfile
@@ -1,4 +1,5 @@
 # Profile
+from .profile.cr import ContiguousRaggedProfile
 from .profile.im import IncompleteMultidimensionalProfile
 from .profile.om import OrthogonalMultidimensionalProfile
 
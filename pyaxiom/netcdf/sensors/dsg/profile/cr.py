@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from pygc import great_distance
+
+from pyaxiom.utils import normalize_array, get_dtype, dict_update, generic_masked, encode_times, decode_times
+from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import ChunkLayout, cf_safe_name, in_range, read_where
+from pyaxiom.netcdf.sensors.dsg.profile.im import profile_metadata
+from pyaxiom import logger
+
+
+class ContiguousRaggedProfile(CFDataset):
+    """
+    In the contiguous ragged array representation, the profiles are stored
+    one after the other along a sample dimension, with no padding. A count
+    variable, identified by its sample_dimension attribute, holds the number
+    of elements in each profile.
+    """
+
+    @classmethod
+    def is_mine(cls, dsg):
+        try:
+            pvars = dsg.get_variables_by_attributes(cf_role='profile_id')
+            assert len(pvars) == 1
+            assert dsg.featureType.lower() == 'profile'
+            assert len(dsg.t_axes()) == 1
+            assert len(dsg.x_axes()) == 1
+            assert len(dsg.y_axes()) == 1
+            assert len(dsg.z_axes()) == 1
+
+            # Not an IR
+            assert not dsg.get_variables_by_attributes(
+                instance_dimension=lambda x: x is not None
+            )
+
+            o_index_vars = dsg.get_variables_by_attributes(
+                sample_dimension=lambda x: x is not None
+            )
+            assert len(o_index_vars) == 1
+            assert o_index_vars[0].sample_dimension in dsg.dimensions  # Sample dimension
+
+            # Allow for string variables
+            pvar = pvars[0]
+            # 0 = single
+            # 1 = array of strings/ints/bytes/etc
+            # 2 = array of character arrays
+            assert 0 <= len(pvar.dimensions) <= 2
+
+            z = dsg.z_axes()[0]
+            assert z.dimensions == (o_index_vars[0].sample_dimension,)
+
+        except BaseException:
+            return False
+
+        return True
+
+    @classmethod
+    def from_dataframe(cls, df, output, **kwargs):
+        reserved_columns = ['trajectory', 'profile', 't', 'x', 'y', 'z', 'distance']
+        data_columns = [ d for d in df.columns if d not in reserved_columns ]
+
+        # Each profile's rows back to back, in the order they appear
+        unique_profiles, inverse = np.unique(df.profile.values, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        row_sizes = np.bincount(inverse, minlength=unique_profiles.size)
+        df = df.iloc[order]
+
+        layout = ChunkLayout(kwargs.pop('layout', None), 'profile', 'obs', unique_profiles.size, len(df), ragged=True)
+
+        with ContiguousRaggedProfile(output, 'w') as nc:
+
+            nc.createDimension('profile', unique_profiles.size)
+            nc.createDimension('obs', len(df))
+
+            # Metadata variables
+            nc.createVariable('crs', 'i4')
+
+            profile = layout.create_variable(nc, 'profile', get_dtype(df.profile), ('profile',))
+            row_size = layout.create_variable(nc, 'rowSize', 'i4', ('profile',))
+
+            # Create all of the variables
+            time = layout.create_variable(nc, 'time', 'i4', ('profile',))
+            latitude = layout.create_variable(nc, 'latitude', get_dtype(df.y), ('profile',))
+            longitude = layout.create_variable(nc, 'longitude', get_dtype(df.x), ('profile',))
+            if 'distance' in df:
+                distance = layout.create_variable(nc, 'distance', get_dtype(df.distance), ('profile',))
+            z = layout.create_variable(nc, 'z', get_dtype(df.z), ('obs',), fill_value=df.z.dtype.type(cls.default_fill_value))
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            profile[:] = unique_profiles
+            row_size[:] = row_sizes
+
+            # Profile values come from the first row of each profile
+            firsts = df.iloc[np.cumsum(row_sizes) - row_sizes]
+            time[:] = encode_times(firsts.t, cls.default_time_unit, integer=True)
+            latitude[:] = firsts.y.values
+            longitude[:] = firsts.x.values
+            if 'distance' in df:
+                distance[:] = firsts.distance.values
+
+            z[:] = df.z.fillna(z._FillValue).values
+
+            for c in data_columns:
+                var_name = cf_safe_name(c)
+                if np.issubdtype(df[c].dtype, 'S') or df[c].dtype == object:
+                    # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
+                    v = layout.create_variable(nc, var_name, get_dtype(df[c]), ('obs',))
+                    # Use an empty string... better than nothing!
+                    v[:] = df[c].fillna('').values.astype(object)
+                else:
+                    v = layout.create_variable(nc, var_name, get_dtype(df[c]), ('obs',), fill_value=df[c].dtype.type(cls.default_fill_value))
+                    v[:] = df[c].fillna(v._FillValue).values
+
+                attributes[var_name] = dict_update(attributes.get(var_name, {}), {
+                    'coordinates' : 'time latitude longitude z',
+                })
+
+            # Set global attributes
+            nc.update_attributes(attributes)
+
+        return ContiguousRaggedProfile(output, **kwargs)
+
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
+        if df is None:
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
+        return profile_metadata(df, geometries=geometries)
+
+    def feature_sizes(self):
+        o_index_var = self.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0]
+        return np.ma.getdata(o_index_var[:]).astype(np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the ranges of the sample dimension belonging to profiles
+            with a time between `start` and `end` and a location inside
+            `bbox` (min x, min y, max x, max y) are read from disk, and of
+            those only the rows with a z between `min_depth` and `max_depth`
+            are returned. Distances are calculated along the returned rows.
+
+            `instances` is a boolean array over the profiles limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'profile', 'distance'], coordinates)
+
+        # The count variable (rowSize) holds the number of elements in each
+        # profile, which are written contiguously along the sample dimension
+        o_index_var = self.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0]
+        p_dim = self.dimensions[o_index_var.dimensions[0]]       # Profile dimension
+        o_dim = self.dimensions[o_index_var.sample_dimension]    # Sample dimension
+        row_sizes = np.ma.getdata(self.read_cached(o_index_var, cache)).astype(np.int64)
+        logger.debug(['# profiles: ', p_dim.size])
+
+        tvar = self.t_axes()[0]
+        xvar = self.x_axes()[0]
+        yvar = self.y_axes()[0]
+        zvar = self.z_axes()[0]
+
+        # Profiles to read, and their ranges of the sample dimension
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            keep &= instances
+        obs_keep = keep.repeat(row_sizes)
+        row_sizes = row_sizes[keep]
+        logger.debug(['# profiles read: ', keep.sum()])
+
+        # Profiles
+        pvar = self.get_variables_by_attributes(cf_role='profile_id')[0]
+        try:
+            p = normalize_array(pvar)
+        except ValueError:
+            p = np.asarray(list(range(len(pvar))), dtype=np.integer)
+        p = np.asarray(p)[keep].repeat(row_sizes)
+        logger.debug(['profile data size: ', p.size])
+
+        # Z
+        z = generic_masked(read_where(zvar, obs_keep).flatten(), attrs=self.vatts(zvar.name)).round(5)
+        logger.debug(['z data size: ', z.size])
+
+        # Rows to return
+        rows = in_range(z, min_depth, max_depth)
+
+        # X
+        x = generic_masked(read_where(xvar, keep).repeat(row_sizes), attrs=self.vatts(xvar.name)).round(5)
+        logger.debug(['x data size: ', x.size])
+
+        # Y
+        y = generic_masked(read_where(yvar, keep).repeat(row_sizes), attrs=self.vatts(yvar.name)).round(5)
+        logger.debug(['y data size: ', y.size])
+
+        df_data = {
+            'x': x,
+            'y': y,
+            'z': z,
+            'profile': p
+        }
+
+        # T
+        if 't' in columns:
+            t = decode_times(read_where(tvar, keep), tvar.units, getattr(tvar, 'calendar', 'standard')).repeat(row_sizes)
+            logger.debug(['time data size: ', t.size])
+            df_data['t'] = t
+
+        if min_depth is not None or max_depth is not None:
+            df_data = { k: v[rows] for k, v in df_data.items() }
+            x = df_data['x']
+            y = df_data['y']
+        else:
+            rows = slice(None)
+
+        # Distance
+        if 'distance' in columns:
+            d = np.ma.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = generic_masked(np.cumsum(d), minv=0).round(2)
+            logger.debug(['distance data size: ', d.size])
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(x.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
+        for i, dvar in enumerate(extract_vars):
+            if dvar.dimensions == (p_dim.name,):
+                # Profile dimension
+                vdata = generic_masked(read_where(dvar, keep).repeat(row_sizes)[rows], attrs=self.vatts(dvar.name)).round(3)
+            elif dvar.dimensions == (o_dim.name,):
+                # Sample dimension
+                vdata = generic_masked(read_where(dvar, obs_keep).flatten()[rows], attrs=self.vatts(dvar.name)).round(3)
+            else:
+                logger.warning("Skipping variable {}... it didn't seem like a data variable".format(dvar))
+                continue
+
+            building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
+            df_data[dvar.name] = vdata
+
+        df = pd.DataFrame(df_data)
+
+        # Drop all data columns with no data
+        if clean_cols:
+            df = df.dropna(axis=1, how='all')
+
+        # Drop all data rows with no data variable data
+        if clean_rows:
+            df = df.iloc[~building_index_to_drop]
+
+        return df
+
+    def nc_attributes(self):
+        atts = super(ContiguousRaggedProfile, self).nc_attributes()
+        return dict_update(atts, {
+            'global' : {
+                'featureType': 'profile',
+                'cdm_data_type': 'Profile'
+            },
+            'profile' : {
+                'cf_role': 'profile_id',
+                'long_name' : 'profile identifier'
+            },
+            'rowSize' : {
+                'sample_dimension': 'obs',
+                'long_name': 'number of obs in this profile'
+            },
+            'distance' : {
+                'long_name': 'Great circle distance between trajectory points',
+                'standard_name': 'distance_between_trajectory_points',
+                'units': 'm'
+            }
+        })
@@ -1,20 +1,60 @@
 # -*- coding: utf-8 -*-
 import math
-from datetime import datetime
 from collections import namedtuple
 
 import numpy as np
 import pandas as pd
-import netCDF4 as nc4
 from pygc import great_distance
 from shapely.geometry import Point, LineString
 
-from pyaxiom.utils import unique_justseen, normalize_array, get_dtype, dict_update, generic_masked
+from pyaxiom.utils import unique_justseen, normalize_array, get_dtype, dict_update, generic_masked, encode_times, padded_index, padded_array, decode_times
 from pyaxiom.netcdf import CFDataset
-from pyaxiom.netcdf.utils import cf_safe_name
+from pyaxiom.netcdf.utils import ChunkLayout, create_padded_variables, in_range, read_where
 from pyaxiom import logger
 
 
+def profile_metadata(df, geometries=True):
+    """ Profile metadata calculated from the DataFrame of any profile file """
+    profiles = {}
+    for pid, pgroup in df.groupby('profile'):
+        pgroup = pgroup.sort_values('t')
+        first_row = pgroup.iloc[0]
+        profile = namedtuple('Profile', ['min_z', 'max_z', 't', 'x', 'y', 'loc'])
+        profiles[pid] = profile(
+            min_z=pgroup.z.min(),
+            max_z=pgroup.z.max(),
+            t=first_row.t,
+            x=first_row.x,
+            y=first_row.y,
+            loc=Point(first_row.x, first_row.y)
+        )
+
+    geometry = None
+    first_row = df.iloc[0]
+    first_loc = Point(first_row.x, first_row.y)
+    if geometries:
+        null_coordinates = df.x.isnull() | df.y.isnull()
+        coords = list(unique_justseen(zip(
+            df.x[~null_coordinates].tolist(),
+            df.y[~null_coordinates].tolist()
+        )))
+        if len(coords) > 1:
+            geometry = LineString(coords)  # noqa
+        elif len(coords) == 1:
+            geometry = first_loc  # noqa
+
+    meta = namedtuple('Metadata', ['min_z', 'max_z', 'min_t', 'max_t', 'profiles', 'first_loc', 'geometry'])
+    return meta(
+        min_z=df.z.min(),
+        max_z=df.z.max(),
+        min_t=df.t.min(),
+        max_t=df.t.max(),
+        profiles=profiles,
+        first_loc=first_loc,
+        geometry=geometry
+    )
+
+
 class IncompleteMultidimensionalProfile(CFDataset):
     """
     If there are the same number of levels in each profile, but they do not
@@ -40,6 +80,11 @@ class IncompleteMultidimensionalProfile(CFDataset):
             assert len(dsg.y_axes()) == 1
             assert len(dsg.z_axes()) == 1
 
+            # Not a CR
+            assert not dsg.get_variables_by_attributes(
+                sample_dimension=lambda x: x is not None
+            )
+
             # Allow for string variables
             pvar = pvars[0]
             # 0 = single
@@ -68,183 +113,170 @@ class IncompleteMultidimensionalProfile(CFDataset):
         return True
 
     @classmethod
-    def from_dataframe(cls, df, output, **kwargs):
+    def from_dataframe(cls, df, output, ragged_threshold=None, **kwargs):
+        """ Writes the profiles padded to the length of the longest one.
+            If more than `ragged_threshold` (a fraction) of the padded array
+            would be fill values a ContiguousRaggedProfile is written (and
+            returned) instead. A `layout` hint ('per-instance',
+            'per-variable-scan' or 'balanced') sets the chunk shapes, see
+            `pyaxiom.netcdf.utils.ChunkLayout`.
+        """
         reserved_columns = ['trajectory', 'profile', 't', 'x', 'y', 'z', 'distance']
         data_columns = [ d for d in df.columns if d not in reserved_columns ]
 
-        with IncompleteMultidimensionalProfile(output, 'w') as nc:
+        unique_profiles, index, counts, first_rows = padded_index(df.profile.values)
+        padding = 1 - float(counts.sum()) / (counts.size * counts.max())
+        if ragged_threshold is not None and padding > ragged_threshold:
+            from pyaxiom.netcdf.sensors.dsg.profile.cr import ContiguousRaggedProfile
+            logger.info('{:.0%} of the padded profiles would be fill values, writing a contiguous ragged file'.format(padding))
+            return ContiguousRaggedProfile.from_dataframe(df, output, **kwargs)
 
-            profile_group = df.groupby('profile')
-            max_zs = profile_group.size().max()
+        layout = ChunkLayout(kwargs.pop('layout', None), 'profile', 'z', unique_profiles.size, counts.max())
+
+        with IncompleteMultidimensionalProfile(output, 'w') as nc:
 
-            unique_profiles = df.profile.unique()
             nc.createDimension('profile', unique_profiles.size)
-            nc.createDimension('z', max_zs)
+            nc.createDimension('z', counts.max())
 
             # Metadata variables
             nc.createVariable('crs', 'i4')
 
-            profile = nc.createVariable('profile', get_dtype(df.profile), ('profile',))
+            profile = layout.create_variable(nc, 'profile', get_dtype(df.profile), ('profile',))
 
             # Create all of the variables
-            time = nc.createVariable('time', 'i4', ('profile',))
-            latitude = nc.createVariable('latitude', get_dtype(df.y), ('profile',))
-            longitude = nc.createVariable('longitude', get_dtype(df.x), ('profile',))
+            time = layout.create_variable(nc, 'time', 'i4', ('profile',))
+            latitude = layout.create_variable(nc, 'latitude', get_dtype(df.y), ('profile',))
+            longitude = layout.create_variable(nc, 'longitude', get_dtype(df.x), ('profile',))
             if 'distance' in df:
-                distance = nc.createVariable('distance', get_dtype(df.distance), ('profile',))
-            z = nc.createVariable('z', get_dtype(df.z), ('profile', 'z'), fill_value=df.z.dtype.type(cls.default_fill_value))
-
-            attributes = dict_update(nc.nc_attributes(), kwargs.pop('attributes', {}))
-
-            for i, (uid, pdf) in enumerate(profile_group):
-                profile[i] = uid
-
-                time[i] = nc4.date2num(pdf.t.iloc[0], units=cls.default_time_unit)
-                latitude[i] = pdf.y.iloc[0]
-                longitude[i] = pdf.x.iloc[0]
-                if 'distance' in pdf:
-                    distance[i] = pdf.distance.iloc[0]
-
-                zvalues = pdf.z.fillna(z._FillValue).values
-                sl = slice(0, zvalues.size)
-                z[i, sl] = zvalues
-                for c in data_columns:
-                    # Create variable if it doesn't exist
-                    var_name = cf_safe_name(c)
-                    if var_name not in nc.variables:
-                        if np.issubdtype(pdf[c].dtype, 'S') or pdf[c].dtype == object:
-                            # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
-                            v = nc.createVariable(var_name, get_dtype(pdf[c]), ('profile', 'z'))
-                        else:
-                            v = nc.createVariable(var_name, get_dtype(pdf[c]), ('profile', 'z'), fill_value=pdf[c].dtype.type(cls.default_fill_value))
-                            
-                        if var_name not in attributes:
-                            attributes[var_name] = {}
-                        attributes[var_name] = dict_update(attributes[var_name], {
-                            'coordinates' : 'time latitude longitude z',
-                        })
-                    else:
-                        v = nc.variables[var_name]
-
-                    if hasattr(v, '_FillValue'):
-                        vvalues = pdf[c].fillna(v._FillValue).values
-                    else:
-                        # Use an empty string... better than nothing!
-                        vvalues = pdf[c].fillna('').values
-
-                    sl = slice(0, vvalues.size)
-                    v[i, sl] = vvalues
+                distance = layout.create_variable(nc, 'distance', get_dtype(df.distance), ('profile',))
+            z = layout.create_variable(nc, 'z', get_dtype(df.z), ('profile', 'z'), fill_value=df.z.dtype.type(cls.default_fill_value))
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            # Profile values come from the first row of each profile
+            profile[:] = unique_profiles
+            time[:] = encode_times(df.t.iloc[first_rows], cls.default_time_unit, integer=True)
+            latitude[:] = df.y.values[first_rows]
+            longitude[:] = df.x.values[first_rows]
+            if 'distance' in df:
+                distance[:] = df.distance.values[first_rows]
+
+            z[:] = padded_array(df.z.values, index, z.shape, z._FillValue)
+            create_padded_variables(nc, df, data_columns, index, ('profile', 'z'), cls.default_fill_value, attributes, 'time latitude longitude z', layout=layout)
 
             # Set global attributes
             nc.update_attributes(attributes)
 
         return IncompleteMultidimensionalProfile(output, **kwargs)
 
-    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
         if df is None:
-            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows)
-
-        profiles = {}
-        for pid, pgroup in df.groupby('profile'):
-            pgroup = pgroup.sort_values('t')
-            first_row = pgroup.iloc[0]
-            profile = namedtuple('Profile', ['min_z', 'max_z', 't', 'x', 'y', 'loc'])
-            profiles[pid] = profile(
-                min_z=pgroup.z.min(),
-                max_z=pgroup.z.max(),
-                t=first_row.t,
-                x=first_row.x,
-                y=first_row.y,
-                loc=Point(first_row.x, first_row.y)
-            )
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
+        return profile_metadata(df, geometries=geometries)
 
-        geometry = None
-        first_row = df.iloc[0]
-        first_loc = Point(first_row.x, first_row.y)
-        if geometries:
-            null_coordinates = df.x.isnull() | df.y.isnull()
-            coords = list(unique_justseen(zip(
-                df.x[~null_coordinates].tolist(),
-                df.y[~null_coordinates].tolist()
-            )))
-            if len(coords) > 1:
-                geometry = LineString(coords)  # noqa
-            elif len(coords) == 1:
-                geometry = first_loc  # noqa
-
-        meta = namedtuple('Metadata', ['min_z', 'max_z', 'min_t', 'max_t', 'profiles', 'first_loc', 'geometry'])
-        return meta(
-            min_z=df.z.min(),
-            max_z=df.z.max(),
-            min_t=df.t.min(),
-            max_t=df.t.max(),
-            profiles=profiles,
-            first_loc=first_loc,
-            geometry=geometry
-        )
+    def feature_sizes(self):
+        pvar = self.get_variables_by_attributes(cf_role='profile_id')[0]
+        p_dim = self.dimensions[pvar.dimensions[0]]
+        zvar = self.z_axes()[0]
+        z_dim = self.dimensions[[ d for d in zvar.dimensions if d != p_dim.name ][0]]
+        return np.full(p_dim.size, z_dim.size, dtype=np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the profiles with a time between `start` and `end` and a
+            location inside `bbox` (min x, min y, max x, max y) are read
+            from disk, and of those only the rows with a z between
+            `min_depth` and `max_depth` are returned. Distances are
+            calculated along the returned rows.
+
+            `instances` is a boolean array over the profiles limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'profile', 'distance'], coordinates)
 
-    def to_dataframe(self, clean_cols=True, clean_rows=True):
         pvar = self.get_variables_by_attributes(cf_role='profile_id')[0]
         # Multiple profiles in the file
         p_dim = self.dimensions[pvar.dimensions[0]]
         ps = p_dim.size
         logger.debug(['# profiles: ', ps])
 
+        tvar = self.t_axes()[0]
+        xvar = self.x_axes()[0]
+        yvar = self.y_axes()[0]
         zvar = self.z_axes()[0]
 
         z_dim = self.dimensions[[ d for d in zvar.dimensions if d != p_dim.name ][0]]
         zs = z_dim.size
 
+        # Profiles to read
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            keep &= instances
+        logger.debug(['# profiles read: ', keep.sum()])
+
         # Profiles
         try:
             p = normalize_array(pvar)
         except ValueError:
             p = np.asarray(list(range(len(pvar))), dtype=np.integer)
-        p = p.repeat(zs)
+        p = p[keep].repeat(zs)
         logger.debug(['profile data size: ', p.size])
 
         # Z
-        z = generic_masked(zvar[:].flatten(), attrs=self.vatts(zvar.name)).round(5)
+        z = generic_masked(read_where(zvar, keep).flatten(), attrs=self.vatts(zvar.name)).round(5)
         logger.debug(['z data size: ', z.size])
 
-        # T
-        tvar = self.t_axes()[0]
-        t = nc4.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'))
-        if isinstance(t, datetime):
-            # Size one
-            t = np.array([t.isoformat()], dtype='datetime64')
-        t = t.repeat(zs)
-        logger.debug(['time data size: ', t.size])
+        # Rows to return
+        rows = in_range(z, min_depth, max_depth)
 
         # X
-        xvar = self.x_axes()[0]
-        x = generic_masked(xvar[:].repeat(zs), attrs=self.vatts(xvar.name)).round(5)
+        x = generic_masked(read_where(xvar, keep).repeat(zs), attrs=self.vatts(xvar.name)).round(5)
         logger.debug(['x data size: ', x.size])
 
         # Y
-        yvar = self.y_axes()[0]
-        y = generic_masked(yvar[:].repeat(zs), attrs=self.vatts(yvar.name)).round(5)
+        y = generic_masked(read_where(yvar, keep).repeat(zs), attrs=self.vatts(yvar.name)).round(5)
         logger.debug(['y data size: ', y.size])
 
-        # Distance
-        d = np.ma.zeros(y.size, dtype=np.float64)
-        d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
-        d = generic_masked(np.cumsum(d), minv=0).round(2)
-        logger.debug(['distance data size: ', d.size])
-
         df_data = {
-            't': t,
             'x': x,
             'y': y,
             'z': z,
-            'profile': p,
-            'distance': d
+            'profile': p
         }
 
-        building_index_to_drop = np.ones(t.size, dtype=bool)
-        extract_vars = list(set(self.data_vars() + self.ancillary_vars()))
+        # T
+        if 't' in columns:
+            t = decode_times(read_where(tvar, keep), tvar.units, getattr(tvar, 'calendar', 'standard')).repeat(zs)
+            logger.debug(['time data size: ', t.size])
+            df_data['t'] = t
+
+        if min_depth is not None or max_depth is not None:
+            df_data = { k: v[rows] for k, v in df_data.items() }
+            x = df_data['x']
+            y = df_data['y']
+        else:
+            rows = slice(None)
+
+        # Distance
+        if 'distance' in columns:
+            d = np.ma.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = generic_masked(np.cumsum(d), minv=0).round(2)
+            logger.debug(['distance data size: ', d.size])
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(x.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
         for i, dvar in enumerate(extract_vars):
-            vdata = generic_masked(dvar[:].flatten(), attrs=self.vatts(dvar.name)).round(3)
+            vdata = generic_masked(read_where(dvar, keep).flatten()[rows], attrs=self.vatts(dvar.name)).round(3)
             building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
             df_data[dvar.name] = vdata
 
@@ -1,17 +1,16 @@
 # -*- coding: utf-8 -*-
 import math
-from datetime import datetime
 from collections import namedtuple
 
-import netCDF4 as nc4
 import numpy as np
 import pandas as pd
 
 from pygc import great_distance
 from shapely.geometry import Point, LineString
 
-from pyaxiom.utils import unique_justseen, normalize_array, generic_masked
+from pyaxiom.utils import unique_justseen, normalize_array, generic_masked, get_dtype, dict_update, encode_times, decode_times
 from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import ChunkLayout, cf_safe_name, in_range, read_where
 from pyaxiom import logger
 
 
@@ -38,6 +37,11 @@ class OrthogonalMultidimensionalProfile(CFDataset):
             assert len(dsg.y_axes()) == 1
             assert len(dsg.z_axes()) == 1
 
+            # Not a CR
+            assert not dsg.get_variables_by_attributes(
+                sample_dimension=lambda x: x is not None
+            )
+
             # Allow for string variables
             pvar = pvars[0]
             # 0 = single
@@ -79,15 +83,99 @@ class OrthogonalMultidimensionalProfile(CFDataset):
 
         return True
 
-    def from_dataframe(self, df, variable_attributes=None, global_attributes=None):
-        variable_attributes = variable_attributes or {}
-        global_attributes = global_attributes or {}
+    @classmethod
+    def from_dataframe(cls, df, output, **kwargs):
+        """ Writes profiles that all have the same z levels, storing z(z)
+            once. If they don't the file is written (and returned) as an
+            IncompleteMultidimensionalProfile instead. A `layout` hint sets
+            the chunk shapes, see `pyaxiom.netcdf.utils.ChunkLayout`.
+        """
+        reserved_columns = ['trajectory', 'profile', 't', 'x', 'y', 'z', 'distance']
+        data_columns = [ d for d in df.columns if d not in reserved_columns ]
+
+        # Checks that don't need the rows in order: every profile has as
+        # many rows as there are z levels in the file
+        unique_profiles, counts = np.unique(df.profile.values, return_counts=True)
+        orthogonal = (
+            (counts == counts[0]).all() and
+            not pd.isnull(df.z.values).any() and
+            np.unique(df.z.values).size == counts[0]
+        )
+
+        if orthogonal:
+            # Each profile's levels in order, one profile after the other
+            df = df.sort_values(['profile', 'z'], kind='mergesort')
+            unique_profiles, first_rows = np.unique(df.profile.values, return_index=True)
+
+            zs = df.z.values
+            levels = zs[:counts[0]]
+            orthogonal = (
+                (np.diff(levels) > 0).all() and
+                (zs.reshape(unique_profiles.size, levels.size) == levels).all()
+            )
+
+        if not orthogonal:
+            from pyaxiom.netcdf.sensors.dsg.profile.im import IncompleteMultidimensionalProfile
+            logger.info('Profiles do not share the same z levels, writing an incomplete multidimensional file')
+            return IncompleteMultidimensionalProfile.from_dataframe(df, output, **kwargs)
+
+        layout = ChunkLayout(kwargs.pop('layout', None), 'profile', 'z', unique_profiles.size, levels.size)
+        shape = (unique_profiles.size, levels.size)
+
+        with OrthogonalMultidimensionalProfile(output, 'w') as nc:
+
+            nc.createDimension('profile', unique_profiles.size)
+            nc.createDimension('z', levels.size)
+
+            # Metadata variables
+            nc.createVariable('crs', 'i4')
+
+            profile = layout.create_variable(nc, 'profile', get_dtype(df.profile), ('profile',))
+
+            # Create all of the variables
+            time = layout.create_variable(nc, 'time', 'i4', ('profile',))
+            latitude = layout.create_variable(nc, 'latitude', get_dtype(df.y), ('profile',))
+            longitude = layout.create_variable(nc, 'longitude', get_dtype(df.x), ('profile',))
+            if 'distance' in df:
+                distance = layout.create_variable(nc, 'distance', get_dtype(df.distance), ('profile',))
+            z = layout.create_variable(nc, 'z', get_dtype(df.z), ('z',))
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            # Profile values come from the first row of each profile
+            profile[:] = unique_profiles
+            time[:] = encode_times(df.t.iloc[first_rows], cls.default_time_unit, integer=True)
+            latitude[:] = df.y.values[first_rows]
+            longitude[:] = df.x.values[first_rows]
+            if 'distance' in df:
+                distance[:] = df.distance.values[first_rows]
+
+            z[:] = levels
+
+            for c in data_columns:
+                var_name = cf_safe_name(c)
+                if np.issubdtype(df[c].dtype, 'S') or df[c].dtype == object:
+                    # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
+                    v = layout.create_variable(nc, var_name, get_dtype(df[c]), ('profile', 'z'))
+                    # Use an empty string... better than nothing!
+                    v[:] = df[c].fillna('').values.astype(object).reshape(shape)
+                else:
+                    v = layout.create_variable(nc, var_name, get_dtype(df[c]), ('profile', 'z'), fill_value=df[c].dtype.type(cls.default_fill_value))
+                    v[:] = df[c].fillna(v._FillValue).values.reshape(shape)
+
+                attributes[var_name] = dict_update(attributes.get(var_name, {}), {
+                    'coordinates' : 'time latitude longitude z',
+                })
+
+            # Set global attributes
+            nc.update_attributes(attributes)
 
-        raise NotImplementedError
+        return OrthogonalMultidimensionalProfile(output, **kwargs)
 
-    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
         if df is None:
-            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows)
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
 
         profiles = {}
         for pid, pgroup in df.groupby('profile'):
@@ -128,17 +216,47 @@ class OrthogonalMultidimensionalProfile(CFDataset):
             geometry=geometry
         )
 
-    def to_dataframe(self, clean_cols=True, clean_rows=True):
+    def feature_sizes(self):
+        tvar = self.t_axes()[0]
+        zvar = self.z_axes()[0]
+        return np.full(np.ones(tvar.shape).size, len(self.dimensions[zvar.dimensions[0]]), dtype=np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the profiles with a time between `start` and `end` and a
+            location inside `bbox` (min x, min y, max x, max y) are read
+            from disk, and of those only the rows with a z between
+            `min_depth` and `max_depth` are returned. Distances are
+            calculated along the returned rows.
+
+            `instances` is a boolean array over the profiles limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'profile', 'distance'], coordinates)
 
+        tvar = self.t_axes()[0]
+        xvar = self.x_axes()[0]
+        yvar = self.y_axes()[0]
         zvar = self.z_axes()[0]
         zs = len(self.dimensions[zvar.dimensions[0]])
 
+        # Profiles to read
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            keep &= instances
+        logger.debug(['# profiles read: ', keep.sum()])
+
         # Profiles
         pvar = self.get_variables_by_attributes(cf_role='profile_id')[0]
         try:
             p = normalize_array(pvar)
         except ValueError:
             p = np.asarray(list(range(len(pvar))), dtype=np.integer)
+        p = np.atleast_1d(p)[keep]
         ps = p.size
         p = p.repeat(zs)
         logger.debug(['profile data size: ', p.size])
@@ -151,44 +269,52 @@ class OrthogonalMultidimensionalProfile(CFDataset):
             z = z.flatten()
         logger.debug(['z data size: ', z.size])
 
-        # T
-        tvar = self.t_axes()[0]
-        t = nc4.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'))
-        if isinstance(t, datetime):
-            # Size one
-            t = np.array([t.isoformat()], dtype='datetime64')
-        t = t.repeat(zs)
-        logger.debug(['time data size: ', t.size])
+        # Rows to return
+        rows = in_range(z, min_depth, max_depth)
 
         # X
-        xvar = self.x_axes()[0]
-        x = generic_masked(xvar[:].repeat(zs), attrs=self.vatts(xvar.name)).round(5)
+        x = generic_masked(read_where(xvar, keep).repeat(zs), attrs=self.vatts(xvar.name)).round(5)
         logger.debug(['x data size: ', x.size])
 
         # Y
-        yvar = self.y_axes()[0]
-        y = generic_masked(yvar[:].repeat(zs), attrs=self.vatts(yvar.name)).round(5)
+        y = generic_masked(read_where(yvar, keep).repeat(zs), attrs=self.vatts(yvar.name)).round(5)
         logger.debug(['y data size: ', y.size])
 
-        # Distance
-        d = np.ma.zeros(y.size, dtype=np.float64)
-        d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
-        d = generic_masked(np.cumsum(d), minv=0).round(2)
-        logger.debug(['distance data size: ', d.size])
-
         df_data = {
-            't': t,
             'x': x,
             'y': y,
             'z': z,
-            'profile': p,
-            'distance': d
+            'profile': p
         }
 
-        building_index_to_drop = np.ones(t.size, dtype=bool)
-        extract_vars = list(set(self.data_vars() + self.ancillary_vars()))
+        # T
+        if 't' in columns:
+            t = decode_times(read_where(tvar, keep), tvar.units, getattr(tvar, 'calendar', 'standard')).repeat(zs)
+            logger.debug(['time data size: ', t.size])
+            df_data['t'] = t
+
+        if min_depth is not None or max_depth is not None:
+            df_data = { k: v[rows] for k, v in df_data.items() }
+            x = df_data['x']
+            y = df_data['y']
+        else:
+            rows = slice(None)
+
+        # Distance
+        if 'distance' in columns:
+            d = np.ma.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = generic_masked(np.cumsum(d), minv=0).round(2)
+            logger.debug(['distance data size: ', d.size])
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(x.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
         for i, dvar in enumerate(extract_vars):
-            vdata = np.ma.fix_invalid(np.ma.MaskedArray(dvar[:].round(3).flatten()))
+            vdata = np.ma.fix_invalid(np.ma.MaskedArray(read_where(dvar, keep).round(3).flatten()[rows]))
             building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
             df_data[dvar.name] = vdata
 
@@ -203,3 +329,21 @@ class OrthogonalMultidimensionalProfile(CFDataset):
             df = df.iloc[~building_index_to_drop]
 
         return df
+
+    def nc_attributes(self):
+        atts = super(OrthogonalMultidimensionalProfile, self).nc_attributes()
+        return dict_update(atts, {
+            'global' : {
+                'featureType': 'profile',
+                'cdm_data_type': 'Profile'
+            },
+            'profile' : {
+                'cf_role': 'profile_id',
+                'long_name' : 'profile identifier'
+            },
+            'distance' : {
+                'long_name': 'Great circle distance between trajectory points',
+                'standard_name': 'distance_between_trajectory_points',
+                'units': 'm'
+            }
+        })
@@ -1,10 +1,37 @@
 #!python
 # coding=utf-8
-from pyaxiom.netcdf import CFDataset
 
+from pyaxiom.utils import get_dtype, dict_update, encode_times, padded_index, padded_array
+from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import ChunkLayout, create_padded_variables
 from pyaxiom import logger
 
 
+def create_station_variables(nc, df, index, first_rows, obs_dimension, fill_value, attributes, layout):
+    """ Writes the station variables of a multidimensional timeseries file
+        and a (station, `obs_dimension`) variable for each data column of
+        `df`, scattered into a padded array at `index`. Variables are
+        chunked with the ChunkLayout `layout`.
+    """
+    reserved_columns = ['station', 't', 'x', 'y', 'z']
+    data_columns = [ d for d in df.columns if d not in reserved_columns ]
+
+    # Metadata variables
+    nc.createVariable('crs', 'i4')
+
+    station = layout.create_variable(nc, 'station', get_dtype(df.station), ('station',))
+    latitude = layout.create_variable(nc, 'latitude', get_dtype(df.y), ('station',), fill_value=df.y.dtype.type(fill_value))
+    longitude = layout.create_variable(nc, 'longitude', get_dtype(df.x), ('station',), fill_value=df.x.dtype.type(fill_value))
+    z = layout.create_variable(nc, 'z', get_dtype(df.z), ('station',), fill_value=df.z.dtype.type(fill_value))
+
+    station[:] = df.station.values[first_rows]
+    latitude[:] = df.y.fillna(latitude._FillValue).values[first_rows]
+    longitude[:] = df.x.fillna(longitude._FillValue).values[first_rows]
+    z[:] = df.z.fillna(z._FillValue).values[first_rows]
+
+    create_padded_variables(nc, df, data_columns, index, ('station', obs_dimension), fill_value, attributes, 'time latitude longitude z', layout=layout)
+
+
 class IncompleteMultidimensionalTimeseries(CFDataset):
 
     @classmethod
@@ -43,10 +70,36 @@ class IncompleteMultidimensionalTimeseries(CFDataset):
 
         return True
 
-    def from_dataframe(self, df, variable_attributes=None, global_attributes=None):
-        variable_attributes = variable_attributes or {}
-        global_attributes = global_attributes or {}
-        raise NotImplementedError
+    @classmethod
+    def from_dataframe(cls, df, output, **kwargs):
+        """ Packs the stations of a DataFrame with 'station', 't', 'x', 'y'
+            and 'z' columns into one file, padding each station's
+            observations to the length of the longest station. A `layout`
+            hint sets the chunk shapes, see `pyaxiom.netcdf.utils.ChunkLayout`.
+        """
+        # Observations of each station are in time order
+        df = df.sort_values(['station', 't'], kind='mergesort')
+        stations, index, counts, first_rows = padded_index(df.station.values)
+        times = encode_times(df.t, cls.default_time_unit, integer=True).filled(int(cls.default_fill_value))
+
+        layout = ChunkLayout(kwargs.pop('layout', None), 'station', 'obs', stations.size, counts.max())
+
+        with IncompleteMultidimensionalTimeseries(output, 'w') as nc:
+            nc.createDimension('station', stations.size)
+            nc.createDimension('obs', counts.max())
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            time = layout.create_variable(nc, 'time', 'i4', ('station', 'obs'), fill_value=int(cls.default_fill_value))
+            time[:] = padded_array(times, index, time.shape, time._FillValue)
+
+            create_station_variables(nc, df, index, first_rows, 'obs', cls.default_fill_value, attributes, layout)
+
+            # Set global attributes
+            nc.update_attributes(attributes)
+
+        return IncompleteMultidimensionalTimeseries(output, **kwargs)
 
     def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
         # if df is None:
@@ -55,3 +108,16 @@ class IncompleteMultidimensionalTimeseries(CFDataset):
 
     def to_dataframe(self):
         raise NotImplementedError
+
+    def nc_attributes(self):
+        atts = super(IncompleteMultidimensionalTimeseries, self).nc_attributes()
+        return dict_update(atts, {
+            'global' : {
+                'featureType': 'timeSeries',
+                'cdm_data_type': 'Station'
+            },
+            'station' : {
+                'cf_role': 'timeseries_id',
+                'long_name' : 'station identifier'
+            }
+        })
@@ -1,7 +1,11 @@
 #!python
 # coding=utf-8
-from pyaxiom.netcdf import CFDataset
+import numpy as np
 
+from pyaxiom.utils import dict_update, encode_times
+from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import ChunkLayout
+from pyaxiom.netcdf.sensors.dsg.timeseries.im import IncompleteMultidimensionalTimeseries, create_station_variables
 from pyaxiom import logger
 
 
@@ -42,10 +46,48 @@ class OrthogonalMultidimensionalTimeseries(CFDataset):
 
         return True
 
-    def from_dataframe(self, df, variable_attributes=None, global_attributes=None):
-        variable_attributes = variable_attributes or {}
-        global_attributes = global_attributes or {}
-        raise NotImplementedError
+    @classmethod
+    def from_dataframe(cls, df, output, **kwargs):
+        """ Packs the stations of a DataFrame with 'station', 't', 'x', 'y'
+            and 'z' columns into one file with a shared time dimension.
+            If the stations don't all have one value at each of the same
+            times, or any of the times are missing, the file is written (and
+            returned) as an IncompleteMultidimensionalTimeseries instead.
+            A `layout` hint sets the chunk shapes, see `pyaxiom.netcdf.utils.ChunkLayout`.
+        """
+        times = encode_times(df.t, cls.default_time_unit, integer=True)
+        if np.ma.is_masked(times):
+            logger.info('Some times are missing, writing an incomplete multidimensional file')
+            return IncompleteMultidimensionalTimeseries.from_dataframe(df, output, **kwargs)
+        times = np.ma.getdata(times)
+
+        stations, station_index = np.unique(df.station.values, return_inverse=True)
+        unique_times, time_index = np.unique(times, return_inverse=True)
+
+        cells = np.unique(station_index * unique_times.size + time_index).size
+        if not cells == df.shape[0] == stations.size * unique_times.size:
+            logger.info('Stations do not share a time axis, writing an incomplete multidimensional file')
+            return IncompleteMultidimensionalTimeseries.from_dataframe(df, output, **kwargs)
+
+        _, first_rows = np.unique(station_index, return_index=True)
+        layout = ChunkLayout(kwargs.pop('layout', None), 'station', 'time', stations.size, unique_times.size)
+
+        with OrthogonalMultidimensionalTimeseries(output, 'w') as nc:
+            nc.createDimension('station', stations.size)
+            nc.createDimension('time', unique_times.size)
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            time = layout.create_variable(nc, 'time', 'i4', ('time',))
+            time[:] = unique_times
+
+            create_station_variables(nc, df, (station_index, time_index), first_rows, 'time', cls.default_fill_value, attributes, layout)
+
+            # Set global attributes
+            nc.update_attributes(attributes)
+
+        return OrthogonalMultidimensionalTimeseries(output, **kwargs)
 
     def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
         # if df is None:
@@ -54,3 +96,16 @@ class OrthogonalMultidimensionalTimeseries(CFDataset):
 
     def to_dataframe(self):
         raise NotImplementedError
+
+    def nc_attributes(self):
+        atts = super(OrthogonalMultidimensionalTimeseries, self).nc_attributes()
+        return dict_update(atts, {
+            'global' : {
+                'featureType': 'timeSeries',
+                'cdm_data_type': 'Station'
+            },
+            'station' : {
+                'cf_role': 'timeseries_id',
+                'long_name' : 'station identifier'
+            }
+        })
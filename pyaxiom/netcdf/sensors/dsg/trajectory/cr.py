@@ -1,18 +1,344 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+from pygc import great_distance
+
+from pyaxiom.utils import normalize_array, get_dtype, dict_update, generic_masked, encode_times, decode_times
 from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import ChunkLayout, cf_safe_name, in_range, read_where
+from pyaxiom.netcdf.sensors.dsg.trajectory.im import trajectory_metadata
+from pyaxiom import logger
 
 
 class ContiguousRaggedTrajectory(CFDataset):
+    """
+    In the contiguous ragged array representation, the trajectories are
+    stored one after the other along a sample dimension, with no padding. A
+    count variable, identified by its sample_dimension attribute, holds the
+    number of elements in each trajectory.
+    """
+
+    # Rows per chunk along the unlimited obs dimension
+    obs_chunk_size = 2 ** 14
+    # Rows a chunk layout is sized for, the totals aren't known when the
+    # unlimited dimensions are created
+    layout_rows = 2 ** 20
+
+    @classmethod
+    def is_mine(cls, dsg):
+        try:
+            tvars = dsg.get_variables_by_attributes(cf_role='trajectory_id')
+            assert len(tvars) == 1
+            assert dsg.featureType.lower() == 'trajectory'
+            assert len(dsg.t_axes()) == 1
+            assert len(dsg.x_axes()) == 1
+            assert len(dsg.y_axes()) == 1
+            assert len(dsg.z_axes()) == 1
+
+            # Not an IR
+            assert not dsg.get_variables_by_attributes(
+                instance_dimension=lambda x: x is not None
+            )
+
+            o_index_vars = dsg.get_variables_by_attributes(
+                sample_dimension=lambda x: x is not None
+            )
+            assert len(o_index_vars) == 1
+            assert o_index_vars[0].sample_dimension in dsg.dimensions  # Sample dimension
+
+            # Allow for string variables
+            tvar = tvars[0]
+            # 0 = single
+            # 1 = array of strings/ints/bytes/etc
+            # 2 = array of character arrays
+            assert 0 <= len(tvar.dimensions) <= 2
+
+            t = dsg.t_axes()[0]
+            assert t.dimensions == (o_index_vars[0].sample_dimension,)
+
+        except BaseException:
+            return False
+
+        return True
+
+    @classmethod
+    def from_dataframe(cls, df, output, **kwargs):
+        return cls.from_chunks([df], output, **kwargs)
+
+    @classmethod
+    def from_chunks(cls, chunks, output, **kwargs):
+        """
+        Writes a file from an iterable of DataFrames, holding one of them in
+        memory at a time. The rows of each trajectory must be contiguous
+        across the chunks, a trajectory may be split between the end of one
+        chunk and the start of the next. A `layout` hint sets the chunk
+        shapes for `layout_rows` rows with the trajectory lengths of the
+        first chunk, see `pyaxiom.netcdf.utils.ChunkLayout`.
+        """
+        attributes = kwargs.pop('attributes', {})
+        layout = kwargs.pop('layout', None)
+
+        with ContiguousRaggedTrajectory(output, 'w') as nc:
+            for chunk in chunks:
+                nc.append_dataframe(chunk, layout=layout)
+
+            if 'obs' not in nc.dimensions:
+                raise ValueError("There were no chunks to write")
+
+            # Set global attributes
+            nc.update_attributes(dict_update(nc.nc_attributes(), attributes))
+
+        return ContiguousRaggedTrajectory(output, **kwargs)
+
+    def append_dataframe(self, df, layout=None):
+        """
+        Appends the rows of a DataFrame to the end of the obs dimension. Rows
+        continuing the last trajectory in the file grow its rowSize, any
+        other trajectory is added after it. The file must be open for writing.
+        The `layout` hint is only used when the variables are created.
+        """
+        reserved_columns = ['trajectory', 't', 'x', 'y', 'z', 'distance']
+        data_columns = [ d for d in df.columns if d not in reserved_columns ]
+
+        if df.empty:
+            return
+
+        # Runs of rows from the same trajectory
+        ids = df.trajectory.values
+        starts = np.flatnonzero(np.append([True], ids[1:] != ids[:-1]))
+        run_ids = ids[starts]
+        run_sizes = np.diff(np.append(starts, ids.size))
+
+        if 'obs' in self.dimensions:
+            existing = normalize_array(self.variables['trajectory'])
+        else:
+            existing = np.array([])
+        n_trajectories = existing.size
+        continues = bool(n_trajectories) and run_ids[0] == existing[-1]
+
+        # Nothing is written unless all of the rows can be
+        new_ids = run_ids[1:] if continues else run_ids
+        if pd.Series(np.append(existing, new_ids)).duplicated().any():
+            raise ValueError("The rows of each trajectory must be contiguous")
+        if 'obs' in self.dimensions:
+            missing = [ c for c in data_columns if cf_safe_name(c) not in self.variables ]
+            if missing:
+                raise ValueError("Columns {} are not variables in the file".format(missing))
+
+        if 'obs' not in self.dimensions:
+            self._create_variables(df, data_columns, layout)
+
+        trajectory = self.variables['trajectory']
+        row_size = self.variables['rowSize']
+
+        if continues:
+            # Continue the last trajectory in the file
+            row_size[n_trajectories - 1] = row_size[n_trajectories - 1] + run_sizes[0]
+            run_ids = run_ids[1:]
+            run_sizes = run_sizes[1:]
+
+        if run_ids.size:
+            new = slice(n_trajectories, n_trajectories + run_ids.size)
+            if trajectory.dtype == str:
+                trajectory[new] = run_ids.astype(object)
+            else:
+                trajectory[new] = run_ids
+            row_size[new] = run_sizes
+
+        obs = slice(self.dimensions['obs'].size, self.dimensions['obs'].size + len(df))
+
+        time = self.variables['time']
+        time[obs] = encode_times(df.t, self.default_time_unit, integer=True).filled(time._FillValue)
+        for column, var_name in [('y', 'latitude'), ('x', 'longitude'), ('z', 'z'), ('distance', 'distance')]:
+            if var_name in self.variables:
+                v = self.variables[var_name]
+                v[obs] = df[column].fillna(v._FillValue).values
+
+        for c in data_columns:
+            v = self.variables[cf_safe_name(c)]
+            if v.dtype == str:
+                # Use an empty string... better than nothing!
+                v[obs] = df[c].fillna('').values.astype(object)
+            else:
+                v[obs] = df[c].fillna(v._FillValue).values
+
+    def _create_variables(self, df, data_columns, layout=None):
+        self.createDimension('trajectory', None)
+        self.createDimension('obs', None)
+
+        # Both dimensions are unlimited, so the chunks are sized for a fixed
+        # number of rows with the trajectory lengths of the first DataFrame
+        elements = max(len(df), self.layout_rows)
+        instances = int(np.ceil(elements * df.trajectory.nunique() / float(len(df))))
+        layout = ChunkLayout(layout, 'trajectory', 'obs', instances, elements, ragged=True)
+        self.update_attributes(layout.attributes())
+        options = {}
+        if layout.name is None:
+            options['chunksizes'] = (self.obs_chunk_size,)
+
+        # Metadata variables
+        self.createVariable('crs', 'i4')
+
+        layout.create_variable(self, 'trajectory', get_dtype(df.trajectory), ('trajectory',))
+        layout.create_variable(self, 'rowSize', 'i4', ('trajectory',))
+
+        def create_obs_variable(name, series):
+            if np.issubdtype(series.dtype, 'S') or series.dtype == object:
+                # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
+                return layout.create_variable(self, name, get_dtype(series), ('obs',), **options)
+            return layout.create_variable(self, name, get_dtype(series), ('obs',), zlib=True, fill_value=series.dtype.type(self.default_fill_value), **options)
+
+        # Create all of the variables
+        layout.create_variable(self, 'time', 'i4', ('obs',), zlib=True, fill_value=int(self.default_fill_value), **options)
+        create_obs_variable('latitude', df.y)
+        create_obs_variable('longitude', df.x)
+        create_obs_variable('z', df.z)
+        if 'distance' in df:
+            create_obs_variable('distance', df.distance)
+
+        for c in data_columns:
+            v = create_obs_variable(cf_safe_name(c), df[c])
+            v.setncattr('coordinates', 'time latitude longitude z')
+
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
+        if df is None:
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
+        return trajectory_metadata(df, geometries=geometries)
+
+    def feature_sizes(self):
+        o_index_var = self.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0]
+        return np.ma.getdata(o_index_var[:]).astype(np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the elements with a time between `start` and `end`, a
+            location inside `bbox` (min x, min y, max x, max y) and a z
+            between `min_depth` and `max_depth` are read from disk. Distances
+            are calculated along the returned rows.
+
+            `instances` is a boolean array over the trajectories limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'trajectory', 'distance'], coordinates)
+
+        # The count variable (rowSize) holds the number of elements in each
+        # trajectory, which are written contiguously along the sample dimension
+        o_index_var = self.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0]
+        t_dim = self.dimensions[o_index_var.dimensions[0]]       # Trajectory dimension
+        o_dim = self.dimensions[o_index_var.sample_dimension]    # Sample dimension
+        row_sizes = np.ma.getdata(self.read_cached(o_index_var, cache)).astype(np.int64)
+        logger.debug(['# trajectories: ', t_dim.size])
+
+        # Trajectories
+        pvar = self.get_variables_by_attributes(cf_role='trajectory_id')[0]
+        try:
+            p = normalize_array(pvar)
+        except BaseException:
+            logger.exception('Could not pull trajectory values from the variable, using indexes.')
+            p = np.asarray(list(range(len(pvar))), dtype=np.integer)
+
+        tvar = self.t_axes()[0]
+        xvar = self.x_axes()[0]
+        yvar = self.y_axes()[0]
+        zvar = self.z_axes()[0]
+
+        # Elements to read
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            keep &= np.asarray(instances).repeat(row_sizes)
+        if min_depth is not None or max_depth is not None:
+            keep &= in_range(self.read_cached(zvar, cache), min_depth, max_depth)
+        logger.debug(['# elements read: ', keep.sum()])
+
+        p = np.asarray(p).repeat(row_sizes)[keep]
+        logger.debug(['trajectory data size: ', p.size])
+
+        # Z
+        z = generic_masked(read_where(zvar, keep), attrs=self.vatts(zvar.name)).round(5)
+        logger.debug(['z data size: ', z.size])
+
+        # X
+        x = generic_masked(read_where(xvar, keep), attrs=self.vatts(xvar.name)).round(5)
+        logger.debug(['x data size: ', x.size])
+
+        # Y
+        y = generic_masked(read_where(yvar, keep), attrs=self.vatts(yvar.name)).round(5)
+        logger.debug(['y data size: ', y.size])
+
+        df_data = {
+            'x': x,
+            'y': y,
+            'z': z,
+            'trajectory': p
+        }
+
+        # T
+        if 't' in columns:
+            t = decode_times(read_where(tvar, keep), tvar.units, getattr(tvar, 'calendar', 'standard'))
+            logger.debug(['time data size: ', t.size])
+            df_data['t'] = t
+
+        # Distance
+        if 'distance' in columns:
+            d = np.ma.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = generic_masked(np.cumsum(d), minv=0).round(2)
+            logger.debug(['distance data size: ', d.size])
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(y.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
+        for i, dvar in enumerate(extract_vars):
+            if dvar.dimensions == (t_dim.name,):
+                # Trajectory dimension
+                vdata = generic_masked(dvar[:].repeat(row_sizes)[keep], attrs=self.vatts(dvar.name)).round(3)
+            elif dvar.dimensions == (o_dim.name,):
+                # Sample dimension
+                vdata = generic_masked(read_where(dvar, keep), attrs=self.vatts(dvar.name)).round(3)
+            else:
+                logger.warning("Skipping variable {}... it didn't seem like a data variable".format(dvar))
+                continue
+
+            building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
+            df_data[dvar.name] = vdata
+
+        df = pd.DataFrame(df_data)
+
+        # Drop all data columns with no data
+        if clean_cols:
+            df = df.dropna(axis=1, how='all')
 
-    def from_dataframe(self, df, variable_attributes=None, global_attributes=None):
-        variable_attributes = variable_attributes or {}
-        global_attributes = global_attributes or {}
-        raise NotImplementedError
+        # Drop all data rows with no data variable data
+        if clean_rows:
+            df = df.iloc[~building_index_to_drop]
 
-    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
-        # if df is None:
-        #     df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows)
-        raise NotImplementedError
+        return df
 
-    def to_dataframe(self):
-        raise NotImplementedError
+    def nc_attributes(self):
+        atts = super(ContiguousRaggedTrajectory, self).nc_attributes()
+        return dict_update(atts, {
+            'global' : {
+                'featureType': 'trajectory',
+                'cdm_data_type': 'Trajectory'
+            },
+            'trajectory' : {
+                'cf_role': 'trajectory_id',
+                'long_name' : 'trajectory identifier'
+            },
+            'rowSize' : {
+                'sample_dimension': 'obs',
+                'long_name': 'number of obs in this trajectory'
+            },
+            'distance' : {
+                'long_name': 'Great circle distance between trajectory points',
+                'standard_name': 'distance_between_trajectory_points',
+                'units': 'm'
+            }
+        })
@@ -7,17 +7,54 @@ from collections import namedtuple
 
 import numpy as np
 import pandas as pd
-import netCDF4 as nc4
 from pygc import great_distance
 from shapely.geometry import Point, LineString
 
 
-from pyaxiom.utils import unique_justseen, normalize_array, get_dtype, dict_update
+from pyaxiom.utils import unique_justseen, normalize_array, get_dtype, dict_update, encode_times, padded_index, padded_array, decode_times
 from pyaxiom.netcdf import CFDataset
-from pyaxiom.netcdf.utils import cf_safe_name
+from pyaxiom.netcdf.utils import ChunkLayout, create_padded_variables, in_range, read_where
 from pyaxiom import logger
 
 
+def trajectory_metadata(df, geometries=True):
+    """ Trajectory metadata calculated from the DataFrame of any trajectory file """
+    trajectories = {}
+    for tid, tgroup in df.groupby('trajectory'):
+        tgroup = tgroup.sort_values('t')
+        first_row = tgroup.iloc[0]
+        first_loc = Point(first_row.x, first_row.y)
+
+        geometry = None
+        if geometries:
+            null_coordinates = tgroup.x.isnull() | tgroup.y.isnull()
+            coords = list(unique_justseen(zip(
+                tgroup.x[~null_coordinates].tolist(),
+                tgroup.y[~null_coordinates].tolist()
+            )))
+            if len(coords) > 1:
+                geometry = LineString(coords)
+            elif coords == 1:
+                geometry = first_loc
+
+        trajectory = namedtuple('Trajectory', ['min_z', 'max_z', 'min_t', 'max_t', 'first_loc', 'geometry'])
+        trajectories[tid] = trajectory(
+            min_z=tgroup.z.min(),
+            max_z=tgroup.z.max(),
+            min_t=tgroup.t.min(),
+            max_t=tgroup.t.max(),
+            first_loc=first_loc,
+            geometry=geometry
+        )
+
+    meta = namedtuple('Metadata', ['min_t', 'max_t', 'trajectories'])
+    return meta(
+        min_t=df.t.min(),
+        max_t=df.t.max(),
+        trajectories=trajectories
+    )
+
+
 class IncompleteMultidimensionalTrajectory(CFDataset):
     """
     When storing multiple trajectories in the same file, and the number of
@@ -39,6 +76,11 @@ class IncompleteMultidimensionalTrajectory(CFDataset):
             assert len(dsg.y_axes()) == 1
             assert len(dsg.z_axes()) == 1
 
+            # Not a CR
+            assert not dsg.get_variables_by_attributes(
+                sample_dimension=lambda x: x is not None
+            )
+
             # Allow for string variables
             tvar = tvars[0]
             # 0 = single
@@ -88,139 +130,105 @@ class IncompleteMultidimensionalTrajectory(CFDataset):
 
         with IncompleteMultidimensionalTrajectory(output, 'w') as nc:
 
-            trajectory_group = df.groupby('trajectory')
-            max_obs = trajectory_group.size().max()
+            unique_trajectories, index, counts, _ = padded_index(df.trajectory.values)
+            layout = ChunkLayout(kwargs.pop('layout', None), 'trajectory', 'obs', unique_trajectories.size, counts.max())
 
-            unique_trajectories = df.trajectory.unique()
             nc.createDimension('trajectory', unique_trajectories.size)
-            nc.createDimension('obs', max_obs)
+            nc.createDimension('obs', counts.max())
 
             # Metadata variables
             nc.createVariable('crs', 'i4')
 
-            trajectory = nc.createVariable('trajectory', get_dtype(df.trajectory), ('trajectory',))
+            trajectory = layout.create_variable(nc, 'trajectory', get_dtype(df.trajectory), ('trajectory',))
 
             # Create all of the variables
-            time = nc.createVariable('time', 'i4', ('trajectory', 'obs'), fill_value=int(cls.default_fill_value))
-            z = nc.createVariable('z', get_dtype(df.z), ('trajectory', 'obs'), fill_value=df.z.dtype.type(cls.default_fill_value))
-            latitude = nc.createVariable('latitude', get_dtype(df.y), ('trajectory', 'obs'), fill_value=df.y.dtype.type(cls.default_fill_value))
-            longitude = nc.createVariable('longitude', get_dtype(df.x), ('trajectory', 'obs'), fill_value=df.x.dtype.type(cls.default_fill_value))
+            time = layout.create_variable(nc, 'time', 'i4', ('trajectory', 'obs'), fill_value=int(cls.default_fill_value))
+            z = layout.create_variable(nc, 'z', get_dtype(df.z), ('trajectory', 'obs'), fill_value=df.z.dtype.type(cls.default_fill_value))
+            latitude = layout.create_variable(nc, 'latitude', get_dtype(df.y), ('trajectory', 'obs'), fill_value=df.y.dtype.type(cls.default_fill_value))
+            longitude = layout.create_variable(nc, 'longitude', get_dtype(df.x), ('trajectory', 'obs'), fill_value=df.x.dtype.type(cls.default_fill_value))
+            if 'distance' in df:
+                distance = layout.create_variable(nc, 'distance', get_dtype(df.distance), ('trajectory', 'obs'), fill_value=df.distance.dtype.type(cls.default_fill_value))
+
+            attributes = dict_update(nc.nc_attributes(), layout.attributes())
+            attributes = dict_update(attributes, kwargs.pop('attributes', {}))
+
+            trajectory[:] = unique_trajectories
+
+            times = encode_times(df.t, cls.default_time_unit, integer=True).filled(time._FillValue)
+            time[:] = padded_array(times, index, time.shape, time._FillValue)
+            latitude[:] = padded_array(df.y.values, index, latitude.shape, latitude._FillValue)
+            longitude[:] = padded_array(df.x.values, index, longitude.shape, longitude._FillValue)
+            z[:] = padded_array(df.z.values, index, z.shape, z._FillValue)
             if 'distance' in df:
-                distance = nc.createVariable('distance', get_dtype(df.distance), ('trajectory', 'obs'), fill_value=df.distance.dtype.type(cls.default_fill_value))
-
-            attributes = dict_update(nc.nc_attributes(), kwargs.pop('attributes', {}))
-
-            for i, (uid, gdf) in enumerate(trajectory_group):
-                trajectory[i] = uid
-
-                # tolist() converts to a python datetime object without timezone
-                g = gdf.t.fillna(999999).tolist()   # 999999 is a dummy value
-                NaTs = gdf.t.isnull()
-                timenums = np.ma.MaskedArray(nc4.date2num(g, units=cls.default_time_unit))
-                timenums.mask = NaTs
-                time[i, :] = timenums
-
-                latitude[i, :] = gdf.y.fillna(latitude._FillValue).values
-                longitude[i, :] = gdf.x.fillna(longitude._FillValue).values
-                z[i, :] = gdf.z.fillna(z._FillValue).values
-                if 'distance' in gdf:
-                    distance[i, :] = gdf.distance.fillna(distance._FillValue).values
-
-                for c in data_columns:
-                    # Create variable if it doesn't exist
-                    var_name = cf_safe_name(c)
-                    if var_name not in nc.variables:
-                        if np.issubdtype(gdf[c].dtype, 'S') or gdf[c].dtype == object:
-                            # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
-                            v = nc.createVariable(var_name, get_dtype(gdf[c]), ('trajectory', 'obs'))
-                        else:
-                            v = nc.createVariable(var_name, get_dtype(gdf[c]), ('trajectory', 'obs'), fill_value=gdf[c].dtype.type(cls.default_fill_value))
-
-                        if var_name not in attributes:
-                            attributes[var_name] = {}
-                        attributes[var_name] = dict_update(attributes[var_name], {
-                            'coordinates' : 'time latitude longitude z',
-                        })
-                    else:
-                        v = nc.variables[var_name]
-
-                    if hasattr(v, '_FillValue'):
-                        vvalues = gdf[c].fillna(v._FillValue).values
-                    else:
-                        # Use an empty string... better than nothing!
-                        vvalues = gdf[c].fillna('').values
-
-                    sl = slice(0, vvalues.size)
-                    v[i, sl] = vvalues
+                distance[:] = padded_array(df.distance.values, index, distance.shape, distance._FillValue)
+
+            create_padded_variables(nc, df, data_columns, index, ('trajectory', 'obs'), cls.default_fill_value, attributes, 'time latitude longitude z', layout=layout)
 
             # Set global attributes
             nc.update_attributes(attributes)
 
         return IncompleteMultidimensionalTrajectory(output, **kwargs)
 
-    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
         if df is None:
-            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows)
-
-        trajectories = {}
-        for tid, tgroup in df.groupby('trajectory'):
-            tgroup = tgroup.sort_values('t')
-            first_row = tgroup.iloc[0]
-            first_loc = Point(first_row.x, first_row.y)
-
-            geometry = None
-            if geometries:
-                null_coordinates = tgroup.x.isnull() | tgroup.y.isnull()
-                coords = list(unique_justseen(zip(
-                    tgroup.x[~null_coordinates].tolist(),
-                    tgroup.y[~null_coordinates].tolist()
-                )))
-                if len(coords) > 1:
-                    geometry = LineString(coords)
-                elif coords == 1:
-                    geometry = first_loc
-
-            trajectory = namedtuple('Trajectory', ['min_z', 'max_z', 'min_t', 'max_t', 'first_loc', 'geometry'])
-            trajectories[tid] = trajectory(
-                min_z=tgroup.z.min(),
-                max_z=tgroup.z.max(),
-                min_t=tgroup.t.min(),
-                max_t=tgroup.t.max(),
-                first_loc=first_loc,
-                geometry=geometry
-            )
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
+        return trajectory_metadata(df, geometries=geometries)
 
-        meta = namedtuple('Metadata', ['min_t', 'max_t', 'trajectories'])
-        return meta(
-            min_t=df.t.min(),
-            max_t=df.t.max(),
-            trajectories=trajectories
-        )
+    def feature_sizes(self):
+        tvar = self.t_axes()[0]
+        if tvar.ndim > 1:
+            return np.full(tvar.shape[0], tvar.shape[1], dtype=np.int64)
+        return np.array([tvar.size], dtype=np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the trajectories with an element with a time between `start`
+            and `end`, a location inside `bbox` (min x, min y, max x, max y)
+            and a z between `min_depth` and `max_depth` are read from disk,
+            and of those only the matching elements are returned. Distances
+            are calculated along the returned rows.
+
+            `instances` is a boolean array over the trajectories limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'trajectory', 'distance'], coordinates)
 
-    def to_dataframe(self, clean_cols=True, clean_rows=True):
-        # Z
+        tvar = self.t_axes()[0]
+        xvar = self.x_axes()[0]
+        yvar = self.y_axes()[0]
         zvar = self.z_axes()[0]
-        z = np.ma.fix_invalid(np.ma.MaskedArray(zvar[:]))
-        z = z.flatten().round(5)
-        logger.debug(['z data size: ', z.size])
 
-        # T
-        tvar = self.t_axes()[0]
-        t = np.ma.MaskedArray(nc4.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'))).flatten()
-        # Patch the time variable back to its original mask, since num2date
-        # breaks any missing/fill values
-        if hasattr(tvar[0], 'mask'):
-            t.mask = tvar[:].mask
-        logger.debug(['time data size: ', t.size])
+        # Elements to return, and the trajectories they belong to
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            keep &= np.asarray(instances).repeat(keep.size // len(instances))
+        if min_depth is not None or max_depth is not None:
+            keep &= in_range(self.read_cached(zvar, cache).flatten(), min_depth, max_depth)
+        if tvar.ndim > 1:
+            trajectories = keep.reshape(tvar.shape[0], -1).any(axis=1)
+            rows = keep.reshape(tvar.shape[0], -1)[trajectories].flatten()
+        else:
+            trajectories = keep
+            rows = slice(None)
+        logger.debug(['# elements read: ', keep.sum()])
+
+        def read(var):
+            return np.ma.MaskedArray(read_where(var, trajectories)).flatten()[rows]
+
+        # Z
+        z = np.ma.fix_invalid(read(zvar)).round(5)
+        logger.debug(['z data size: ', z.size])
 
         # X
-        xvar = self.x_axes()[0]
-        x = np.ma.fix_invalid(np.ma.MaskedArray(xvar[:])).flatten().round(5)
+        x = np.ma.fix_invalid(read(xvar)).round(5)
         logger.debug(['x data size: ', x.size])
 
         # Y
-        yvar = self.y_axes()[0]
-        y = np.ma.fix_invalid(np.ma.MaskedArray(yvar[:])).flatten().round(5)
+        y = np.ma.fix_invalid(read(yvar)).round(5)
         logger.debug(['y data size: ', y.size])
 
         # Trajectories
@@ -237,26 +245,37 @@ class IncompleteMultidimensionalTrajectory(CFDataset):
         dim_diff = self.dimensions[list(set(tvar.dimensions).difference(set(pvar.dimensions)))[0]]
         if dim_diff:
             p = p.repeat(dim_diff.size)
+        p = p[keep]
         logger.debug(['trajectory data size: ', p.size])
 
-        # Distance
-        d = np.append([0], great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance'])
-        d = np.ma.fix_invalid(np.ma.MaskedArray(np.cumsum(d)).astype(np.float64).round(2))
-        logger.debug(['distance data size: ', d.size])
-
         df_data = {
-            't': t,
             'x': x,
             'y': y,
             'z': z,
-            'trajectory': p,
-            'distance': d
+            'trajectory': p
         }
 
-        building_index_to_drop = np.ones(t.size, dtype=bool)
-        extract_vars = list(set(self.data_vars() + self.ancillary_vars()))
+        # T
+        if 't' in columns:
+            t = decode_times(read(tvar), tvar.units, getattr(tvar, 'calendar', 'standard'))
+            logger.debug(['time data size: ', t.size])
+            df_data['t'] = t
+
+        # Distance
+        if 'distance' in columns:
+            d = np.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = np.ma.fix_invalid(np.ma.MaskedArray(np.cumsum(d)).astype(np.float64).round(2))
+            logger.debug(['distance data size: ', d.size])
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(z.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
         for i, dvar in enumerate(extract_vars):
-            vdata = np.ma.fix_invalid(np.ma.MaskedArray(dvar[:].round(3).flatten()))
+            vdata = np.ma.fix_invalid(read(dvar).round(3))
             building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
             df_data[dvar.name] = vdata
 
@@ -7,12 +7,12 @@ from collections import namedtuple
 import pytz
 import numpy as np
 import pandas as pd
-import netCDF4 as nc4
 from pygc import great_distance
 from shapely.geometry import Point, LineString
 
-from pyaxiom.utils import unique_justseen, normalize_array, get_fill_value, get_dtype, generic_masked
+from pyaxiom.utils import unique_justseen, normalize_array, get_dtype, generic_masked, decode_times
 from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.utils import in_range, read_where
 from pyaxiom import logger
 
 
@@ -58,9 +58,9 @@ class ContiguousRaggedTrajectoryProfile(CFDataset):
         global_attributes = global_attributes or {}
         raise NotImplementedError
 
-    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True):
+    def calculated_metadata(self, df=None, geometries=True, clean_cols=True, clean_rows=True, start=None, end=None, bbox=None, min_depth=None, max_depth=None):
         if df is None:
-            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows)
+            df = self.to_dataframe(clean_cols=clean_cols, clean_rows=clean_rows, start=start, end=end, bbox=bbox, min_depth=min_depth, max_depth=max_depth)
 
         trajectories = {}
         for tid, tgroup in df.groupby('trajectory'):
@@ -115,7 +115,31 @@ class ContiguousRaggedTrajectoryProfile(CFDataset):
             trajectories=trajectories
         )
 
-    def to_dataframe(self, clean_cols=True, clean_rows=True):
+    def feature_sizes(self):
+        r_index_var = self.get_variables_by_attributes(instance_dimension=lambda x: x is not None)[0]
+        r_dim = self.dimensions[r_index_var.instance_dimension]
+        o_index_var = self.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0]
+        row_sizes = np.ma.filled(o_index_var[:], 0)
+        r_index = np.ma.filled(r_index_var[:], 0)
+        return np.bincount(r_index, weights=row_sizes, minlength=r_dim.size).astype(np.int64)
+
+    def to_dataframe(self, clean_cols=True, clean_rows=True, variables=None, coordinates=None, start=None, end=None, bbox=None, min_depth=None, max_depth=None, instances=None, cache=None):
+        """ `variables` limits the data variables that are read (see
+            `CFDataset.extract_vars`) and `coordinates` the coordinate
+            columns that are returned.
+
+            Only the ranges of the sample dimension belonging to profiles
+            with a time between `start` and `end` and a location inside
+            `bbox` (min x, min y, max x, max y) are read from disk, and of
+            those only the rows with a z between `min_depth` and `max_depth`
+            are returned. Distances are calculated along the returned rows.
+
+            `instances` is a boolean array over the trajectories limiting the
+            ones that are read, see `CFDataset.iter_dataframes`, which also
+            passes the `cache` of values shared by its batches.
+        """
+        columns = self.coordinate_columns(['t', 'x', 'y', 'z', 'trajectory', 'profile', 'distance'], coordinates)
+
         # The index variable (trajectory_index) is identified by having an
         # attribute with name of instance_dimension whose value is the instance
         # dimension name (trajectory in this example). The index variable must
@@ -176,76 +200,96 @@ class ContiguousRaggedTrajectoryProfile(CFDataset):
         else:
             zvar = zvars[0]
 
-        p = np.ma.masked_all(o_dim.size, dtype=profile_indexes.dtype)
-        r = np.ma.masked_all(o_dim.size, dtype=traj_indexes.dtype)
-        t = np.ma.masked_all(o_dim.size, dtype=tvar.dtype)
-        x = np.ma.masked_all(o_dim.size, dtype=xvar.dtype)
-        y = np.ma.masked_all(o_dim.size, dtype=yvar.dtype)
-        si = 0
-
-        for i in np.arange(profile_indexes.size):
-            ei = si + o_index_var[i]
-            p[si:ei] = profile_indexes[i]
-            r[si:ei] = traj_indexes[r_index_var[i]]
-            t[si:ei] = tvar[i]
-            x[si:ei] = xvar[i]
-            y[si:ei] = yvar[i]
-            si = ei
-
-        t_mask = False
-        tfill = get_fill_value(tvar)
-        if tfill is not None:
-            t_mask = np.copy(np.ma.getmaskarray(t))
-            t[t_mask] = 1
-
-        t = np.ma.MaskedArray(
-            nc4.num2date(t, tvar.units, getattr(tvar, 'calendar', 'standard'))
+        # Read each profile dimension variable once and repeat its values
+        # over the number of elements in each profile
+        row_sizes = np.ma.filled(self.read_cached(o_index_var, cache), 0).astype(np.int64)
+        n_obs = min(row_sizes.sum(), o_dim.size)
+
+        # Profiles to read, and their ranges of the sample dimension. Any
+        # elements past the last profile are only read without a filter.
+        keep = self.coordinate_mask(tvar, xvar, yvar, start=start, end=end, bbox=bbox, cache=cache)
+        if instances is not None:
+            # Profiles of the trajectories to read
+            keep &= np.asarray(instances)[np.ma.filled(self.read_cached(r_index_var, cache), 0)]
+        obs_keep = np.empty(o_dim.size, dtype=bool)
+        obs_keep[:n_obs] = keep.repeat(row_sizes)[:n_obs]
+        obs_keep[n_obs:] = keep.all()
+        row_sizes = row_sizes[keep]
+        n_samples = obs_keep.sum()
+        n_obs = min(row_sizes.sum(), n_samples)
+        logger.debug(['# profiles read: ', keep.sum()])
+
+        def to_sample(values, dtype):
+            vdata = np.ma.masked_all(n_samples, dtype=dtype)
+            vdata[:n_obs] = np.ma.MaskedArray(values).repeat(row_sizes)[:n_obs]
+            return vdata
+
+        r_index = read_where(r_index_var, keep)
+        trajectories = np.ma.MaskedArray(
+            np.asarray(traj_indexes)[np.ma.filled(r_index, 0)],
+            mask=np.ma.getmaskarray(r_index)
         )
-        # Patch the time variable back to its original mask, since num2date
-        # breaks any missing/fill values
-        t[t_mask] = np.ma.masked
+
+        p = to_sample(np.asarray(profile_indexes)[keep], profile_indexes.dtype)
+        r = to_sample(trajectories, traj_indexes.dtype)
+        x = to_sample(read_where(xvar, keep), xvar.dtype)
+        y = to_sample(read_where(yvar, keep), yvar.dtype)
 
         # X and Y
         x = generic_masked(x, minv=-180, maxv=180).round(5)
         y = generic_masked(y, minv=-90, maxv=90).round(5)
 
-        # Distance
-        d = np.ma.zeros(o_dim.size, dtype=np.float64)
-        d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
-        d = generic_masked(np.cumsum(d), minv=0).round(2)
-
         # Sample dimension
-        z = generic_masked(zvar[:].flatten(), attrs=self.vatts(zvar.name)).round(5)
+        z = generic_masked(read_where(zvar, obs_keep).flatten(), attrs=self.vatts(zvar.name)).round(5)
+
+        # Rows to return
+        rows = in_range(z, min_depth, max_depth)
 
         df_data = {
-            't': t,
             'x': x,
             'y': y,
             'z': z,
             'trajectory': r,
-            'profile': p,
-            'distance': d
+            'profile': p
         }
 
-        building_index_to_drop = np.ones(o_dim.size, dtype=bool)
-        extract_vars = list(set(self.data_vars() + self.ancillary_vars()))
+        if 't' in columns:
+            # Decode one time per profile before repeating them
+            t = decode_times(read_where(tvar, keep), tvar.units, getattr(tvar, 'calendar', 'standard'))
+            df_data['t'] = to_sample(t, t.dtype)
+
+        if min_depth is not None or max_depth is not None:
+            df_data = { k: v[rows] for k, v in df_data.items() }
+            x = df_data['x']
+            y = df_data['y']
+        else:
+            rows = slice(None)
+
+        # Distance
+        if 'distance' in columns:
+            d = np.ma.zeros(y.size, dtype=np.float64)
+            if d.size > 1:
+                d[1:] = great_distance(start_latitude=y[0:-1], end_latitude=y[1:], start_longitude=x[0:-1], end_longitude=x[1:])['distance']
+            d = generic_masked(np.cumsum(d), minv=0).round(2)
+            df_data['distance'] = d
+
+        df_data = { k: v for k, v in df_data.items() if k in columns }
+
+        building_index_to_drop = np.ones(y.size, dtype=bool)
+        extract_vars = self.extract_vars(variables)
         for i, dvar in enumerate(extract_vars):
 
             # Profile dimensions
             if dvar.dimensions == (p_dim.name,):
-                vdata = np.ma.masked_all(o_dim.size, dtype=dvar.dtype)
-                si = 0
-                for j in np.arange(profile_indexes.size):
-                    ei = si + o_index_var[j]
-                    vdata[si:ei] = dvar[j]
-                    si = ei
+                vdata = to_sample(read_where(dvar, keep), dvar.dtype)[rows]
 
             # Sample dimensions
             elif dvar.dimensions == (o_dim.name,):
-                vdata = generic_masked(dvar[:].flatten(), attrs=self.vatts(dvar.name)).round(3)
+                vdata = generic_masked(read_where(dvar, obs_keep).flatten()[rows], attrs=self.vatts(dvar.name)).round(3)
 
             else:
                 logger.warning("Skipping variable {}... it didn't seem like a data variable".format(dvar))
+                continue
 
             building_index_to_drop = (building_index_to_drop == True) & (vdata.mask == True)  # noqa
             df_data[dvar.name] = vdata
@@ -12,13 +12,14 @@ import numpy as np
 import pandas as pd
 
 from pyaxiom import logger
+from pyaxiom.utils import encode_times, padded_index, padded_array
 
 
 class Profile(object):
 
     def __init__(self, df=None, global_attributes=None, variable_attributes=None, fill_value=None, vertical_positive=None, base_time=None):
 
-        self.df = df if isinstance(df, pd.DataFrame) and not df.empty else pd.DataFrame()
+        self.df = df
         self.fill_value = fill_value or -9999.9
         self.global_attributes = global_attributes or {}
         self.variable_attributes = variable_attributes or {}
@@ -74,9 +75,75 @@ class Profile(object):
     def variable_attributes(self, vas):
         self._variable_attributes = vas
 
+    @property
+    def df(self):
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df if isinstance(df, pd.DataFrame) and not df.empty else pd.DataFrame()
+        # Recalculated the next time they are needed
+        self._statistics = None
+
+    @property
+    def statistics(self):
+        """ Global attributes calculated from the DataFrame. They are cached
+            until `df` is replaced, changing the DataFrame in place doesn't
+            recalculate them.
+        """
+        if self._statistics is None:
+            self._statistics = self._calculate_statistics()
+        return self._statistics
+
+    def _calculate_statistics(self):
+        stats = {}
+        if self.df.empty:
+            return stats
+
+        # Time, from one sort of the values without any missing times
+        times = np.sort(self.df['time'].values.astype('datetime64[ns]'))
+        times = times[~np.isnat(times)]
+        if times.size:
+            starting = pd.Timestamp(times[0])
+            ending = pd.Timestamp(times[-1])
+            stats.update({
+                'time_coverage_start': starting.strftime("%Y-%m-%dT%H:%M:00Z"),
+                'time_coverage_end': ending.strftime("%Y-%m-%dT%H:%M:00Z"),
+                'time_coverage_duration': "P%sS" % str(int(round((ending - starting).total_seconds()))),
+            })
+
+            # Resolution is the most common difference between unique times,
+            # the mode of the sorted differences
+            ns = times.view(np.int64)
+            ns = ns[np.append(True, ns[1:] != ns[:-1])]
+            diffs = np.sort(ns[1:] - ns[:-1])
+            if diffs.size and diffs[0] != diffs[-1]:
+                starts = np.flatnonzero(np.append(True, diffs[1:] != diffs[:-1]))
+                runs = np.diff(np.append(starts, diffs.size))
+                time_diff = diffs[starts[runs.argmax()]] // 10**9
+                stats.update({
+                    'time_coverage_resolution': "P%sS" % str(time_diff)
+                })
+
+        # Vertical
+        stats.update({
+            'geospatial_vertical_min': self.df['z'].min(),
+            'geospatial_vertical_max': self.df['z'].max(),
+        })
+
+        # Horizontal
+        stats.update({
+            'geospatial_lat_min': self.df['latitude'].min(),
+            'geospatial_lat_max': self.df['latitude'].max(),
+            'geospatial_lon_min': self.df['longitude'].min(),
+            'geospatial_lon_max': self.df['longitude'].max(),
+        })
+
+        return stats
+
     @property
     def global_attributes(self):
-        gas = self._global_attributes
+        gas = dict(self._global_attributes)
         gas.update({
             'geospatial_vertical_positive': self.vertical_positive,
             'date_created': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:00Z"),
@@ -85,39 +152,7 @@ class Profile(object):
             'featureType': 'profile',
             'cdm_data_type': 'Profile'
         })
-
-        if not self.df.empty:
-            # Time
-            starting = self.df['time'].min()
-            ending = self.df['time'].max()
-            duration = "P%sS" % str(int(round((ending - starting).total_seconds())))
-            gas.update({
-                'time_coverage_start': starting.strftime("%Y-%m-%dT%H:%M:00Z"),
-                'time_coverage_end': ending.strftime("%Y-%m-%dT%H:%M:00Z"),
-                'time_coverage_duration': duration,
-            })
-            diffs = self.df['time'].unique()[1:] - self.df['time'].unique()[:-1]
-            uniqs, inverse = np.unique(diffs, return_inverse=True)
-            if uniqs.size > 1:
-                time_diffs = diffs[np.bincount(inverse).argmax()]
-                gas.update({
-                    'time_coverage_resolution': "P%sS" % str(round(time_diffs.astype('timedelta64[s]').astype(int)))
-                })
-
-            # Vertical
-            gas.update({
-                'geospatial_vertical_min': self.df['z'].min(),
-                'geospatial_vertical_max': self.df['z'].max(),
-            })
-
-            # Horizontal
-            gas.update({
-                'geospatial_lat_min': self.df['latitude'].min(),
-                'geospatial_lat_max': self.df['latitude'].max(),
-                'geospatial_lon_min': self.df['longitude'].min(),
-                'geospatial_lon_max': self.df['longitude'].max(),
-            })
-
+        gas.update(self.statistics)
         return gas
 
     @global_attributes.setter
@@ -141,7 +176,12 @@ class Profile(object):
 
 class IncompleteProfile(Profile):
 
-    def export(self, output_file):
+    def export(self, output_file, chunk_per_profile=False):
+        """ Writes the profiles as an incomplete multidimensional array, each
+            (profile, z) variable in one call. With `chunk_per_profile` each
+            profile is stored in its own chunk, which suits reading a profile
+            at a time.
+        """
         super(IncompleteProfile, self).export(output_file)
 
         with netCDF4.Dataset(output_file, 'w', clobber=True) as nc:
@@ -149,19 +189,18 @@ class IncompleteProfile(Profile):
             gas = self.global_attributes
             nc.setncatts(gas)
 
-            profiles = self.df.profile.unique().size
-            profile_group = self.df.groupby('profile')
-            max_z = profile_group.size().max()
+            unique_profiles, index, counts, unique_profile_rows = padded_index(self.df.profile.values)
+            profiles = unique_profiles.size
+            max_z = counts.max()
 
             nc.createDimension('profile', profiles)
             nc.createDimension('z', max_z)
 
             profile = nc.createVariable('profile', self.df.profile.dtype, ('profile',))
-            _, unique_profile_rows = np.unique(self.df.profile.values, return_index=True)
             profile[:] = list(range(profiles))
 
             time = nc.createVariable('time', int, ('profile',))
-            time[:] = netCDF4.date2num([datetime.utcfromtimestamp(t) for t in self.df.time.unique().astype('<M8[s]').astype(int)], units=self.base_time)
+            time[:] = encode_times(self.df.time.iloc[unique_profile_rows], self.base_time, integer=True)
 
             latitude = nc.createVariable('latitude', self.df.latitude.dtype, ('profile',))
             latitude[:] = self.df.latitude.values[unique_profile_rows]
@@ -174,18 +213,24 @@ class IncompleteProfile(Profile):
             nc.createVariable("platform", "i4")
             nc.setncattr('platform', 'platform')
 
+            chunking = {}
+            if chunk_per_profile is True:
+                chunking['chunksizes'] = (1, max_z)
+
             # Data vars
             reserved_columns = ['profile', 'time', 'latitude', 'longitude']
-            for i, (name, p) in enumerate(profile_group):
-                for c in [d for d in self.df.columns if d not in reserved_columns]:
-                    var_name = c.split(' ')[0].lower()
-                    fill = p[c].dtype.type(self.fill_value)
-                    if var_name not in nc.variables:
-                        v = nc.createVariable(var_name, self.df[c].dtype, ('profile', 'z'), fill_value=fill)
-                    else:
-                        v = nc.variables[var_name]
-                    assignable_values = p[c].fillna(fill).values
-                    v[i, :len(assignable_values)] = assignable_values
+            for c in [d for d in self.df.columns if d not in reserved_columns]:
+                var_name = c.split(' ')[0].lower()
+                fill = self.df[c].dtype.type(self.fill_value)
+                if var_name not in nc.variables:
+                    v = nc.createVariable(var_name, self.df[c].dtype, ('profile', 'z'), fill_value=fill, **chunking)
+                    v[:] = padded_array(self.df[c].values, index, (profiles, max_z), fill)
+                else:
+                    # Two columns with the same variable name, the last one wins
+                    v = nc.variables[var_name]
+                    values = v[:]
+                    values[index] = np.ma.masked_invalid(self.df[c].values)
+                    v[:] = values
 
             for k, v in self.variable_attributes.items():
                 if k in nc.variables:
@@ -3,18 +3,21 @@
 
 import os
 import random
+import multiprocessing
 import bisect
-import calendar
 from datetime import datetime
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
 
-import netCDF4
 import numpy as np
 import pandas as pd
+from dateutil.relativedelta import relativedelta
 
 from pyaxiom import logger
 from pyaxiom.urn import IoosUrn
-from pyaxiom.utils import urnify
+from pyaxiom.utils import urnify, encode_times, decode_times, parse_time_units
 from pyaxiom.netcdf.dataset import EnhancedDataset
+from pyaxiom.netcdf.utils import in_range, time_value
 
 
 def get_type(obj):
@@ -28,15 +31,304 @@ def get_type(obj):
         return type(obj)
 
 
+MatchSummary = namedtuple('MatchSummary', ['matched', 'out_of_range', 'duplicates'])
+
+
+def _locate(axis, values):
+    """ Indexes of `values` in the sorted `axis` and whether each one is
+        exactly on it. Values are compared in the axis' dtype when it is a
+        floating point type, so float32 axes still match their float64
+        source values.
+    """
+    axis = np.asarray(axis)
+    if np.issubdtype(axis.dtype, np.floating):
+        values = values.astype(axis.dtype)
+    indexes = np.searchsorted(axis, values, side='left')
+    found = indexes < axis.size
+    found[found] = axis[indexes[found]] == values[found]
+    return indexes, found
+
+
+def match_values(values, times, time_axis, fillvalue, verticals=None, vertical_axis=None):
+    """ Scatters values onto a (time,) or (time, z) array by locating each
+        value's time (and vertical) in the sorted axes with a single batched
+        search. Values that are not exactly on an axis are dropped and values
+        landing on an already matched cell overwrite it (the last one wins).
+        Returns the filled array and a MatchSummary of what happened.
+    """
+    values = np.ma.filled(np.ma.asarray(values).flatten(), fillvalue)
+    times = np.asarray(times).flatten()
+    if times.size != values.size:
+        raise ValueError("The 'times' parameter must match the size of the 'values' parameter.")
+
+    time_indexes, in_range = _locate(time_axis, times)
+
+    if vertical_axis is None:
+        shape = (time_axis.size, )
+        flat_indexes = time_indexes
+    else:
+        verticals = np.asarray(verticals).flatten()
+        if verticals.size != values.size:
+            raise ValueError("The 'verticals' parameter must match the size of the 'values' parameter.")
+        vertical_indexes, on_axis = _locate(vertical_axis, verticals)
+        in_range &= on_axis
+        shape = (time_axis.size, vertical_axis.size, )
+        flat_indexes = time_indexes * vertical_axis.size + vertical_indexes
+
+    flat_indexes = flat_indexes[in_range]
+    values = values[in_range]
+
+    # Keep the last value matched to each cell, like assigning in order would
+    cells, last_seen = np.unique(flat_indexes[::-1], return_index=True)
+    used_values = np.ndarray(shape, dtype=get_type(values))
+    used_values.fill(fillvalue)
+    used_values.flat[cells] = values[flat_indexes.size - 1 - last_seen]
+
+    summary = MatchSummary(
+        matched=int(cells.size),
+        out_of_range=int(in_range.size - flat_indexes.size),
+        duplicates=int(flat_indexes.size - cells.size)
+    )
+    return used_values, summary
+
+
+class _VariableSequence(object):
+    """ Lets bisect search a sorted 1-D variable one value at a time """
+
+    def __init__(self, var):
+        self.var = var
+
+    def __len__(self):
+        return self.var.size
+
+    def __getitem__(self, i):
+        return self.var[i]
+
+
+def _most_common(counts):
+    """ The most common key of a {value: count} dict, the smallest one on
+        ties. None unless there is more than one key to choose from.
+    """
+    if len(counts) <= 1:
+        return None
+    keys = sorted(counts.keys())
+    return keys[int(np.argmax([ counts[k] for k in keys ]))]
+
+
+def delta_lengths(times, units, delta, sign=1):
+    """ The length of `delta` in `units` when it is added to (sign=1) or
+        subtracted from (sign=-1) each of the numeric `times`. Fixed deltas
+        (timedelta, numpy timedelta64 and pandas Timedelta) are computed once.
+        Calendar deltas (relativedelta and pandas DateOffset, i.e. months and
+        years) are applied to all of the times at once with pandas.
+    """
+    unit_ns, epoch_ns = parse_time_units(units)
+
+    if isinstance(delta, relativedelta):
+        delta = pd.DateOffset(**{ k: getattr(delta, k) for k in ['years', 'months', 'days', 'hours', 'minutes', 'seconds', 'microseconds'] if getattr(delta, k) })
+    if not isinstance(delta, pd.DateOffset):
+        return pd.Timedelta(delta).value / float(unit_ns)
+
+    instants = pd.to_datetime(np.round(np.asarray(times, dtype=np.float64) * unit_ns).astype(np.int64) + epoch_ns)
+    if sign > 0:
+        shifted = instants + delta
+    else:
+        shifted = instants - delta
+    return sign * (shifted.asi8 - instants.asi8) / float(unit_ns)
+
+
+LayoutPlan = namedtuple('LayoutPlan', ['layout', 'reason', 'attempt', 'times', 'verticals', 'order'])
+
+
+def plan_layout(times, verticals):
+    """ Picks the file layout for a set of time and vertical values with a
+        single sort, so TimeSeries.from_dataframe only has to write once.
+
+        * orthogonal - one vertical level, one row per time value
+        * unique-time - the unique times and vertical levels form a complete
+          grid, the rows just need sorting before a reshape
+        * scatter - duplicate or missing time/vertical cells, every value has
+          to be matched into the unique time and vertical axes
+
+        `order` is the row order for the values, when they need to be sorted.
+    """
+    times = np.asarray(times)
+    verticals = np.asarray(verticals)
+    unique_verticals = np.unique(verticals)
+
+    if unique_verticals.size <= 1:
+        return LayoutPlan(
+            layout='orthogonal',
+            reason='a single vertical level with one row per time value',
+            attempt=1,
+            times=times,
+            verticals=verticals,
+            order=None
+        )
+
+    order = np.lexsort((verticals, times))
+    sorted_times = times[order]
+    sorted_verticals = verticals[order]
+    unique_times = np.unique(sorted_times)
+
+    duplicates = np.count_nonzero(
+        (sorted_times[1:] == sorted_times[:-1]) &
+        (sorted_verticals[1:] == sorted_verticals[:-1])
+    )
+    missing = unique_times.size * unique_verticals.size - (times.size - duplicates)
+
+    if duplicates == 0 and missing == 0:
+        return LayoutPlan(
+            layout='unique-time',
+            reason='{!s} times and {!s} vertical levels form a complete grid'.format(unique_times.size, unique_verticals.size),
+            attempt=2,
+            times=unique_times,
+            verticals=unique_verticals,
+            order=order
+        )
+
+    return LayoutPlan(
+        layout='scatter',
+        reason='{!s} duplicate and {!s} missing cells in the {!s} times by {!s} vertical levels grid'.format(duplicates, missing, unique_times.size, unique_verticals.size),
+        attempt=5,
+        times=unique_times,
+        verticals=unique_verticals,
+        order=None
+    )
+
+
+# Bytes of data in each chunk along time for the expected access pattern:
+# whole records at once or short windows of time.
+ACCESS_CHUNK_BYTES = {
+    'series': 4 * 1024 * 1024,
+    'window': 64 * 1024,
+}
+
+
+class StoragePolicy(object):
+    """ How a TimeSeries chunks and compresses its variables.
+
+        Chunks along time are `chunk_rows` long, or hold about `chunk_bytes`
+        (defaulting from `access`) of data when `chunk_rows` is None. A
+        `least_significant_digit` int quantizes every floating point data
+        variable, a {variable_name: digits} dict only the ones named.
+    """
+
+    def __init__(self, name, access='window', chunk_bytes=None, chunk_rows=None, zlib=True, complevel=4, shuffle=True, least_significant_digit=None):
+        if access not in ACCESS_CHUNK_BYTES:
+            raise ValueError("Unknown access pattern '{}', expected one of {}".format(access, sorted(ACCESS_CHUNK_BYTES.keys())))
+        self.name = name
+        self.access = access
+        self.chunk_bytes = chunk_bytes or ACCESS_CHUNK_BYTES[access]
+        self.chunk_rows = chunk_rows
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.least_significant_digit = least_significant_digit
+
+    def time_chunk(self, size, row_bytes):
+        """ Chunk length along a time dimension of `size` rows """
+        if self.chunk_rows is not None:
+            rows = self.chunk_rows
+        else:
+            rows = self.chunk_bytes // max(int(row_bytes), 1)
+        # Never larger than the data, older libnetcdf rejects chunks larger
+        # than the current size of an unlimited dimension
+        return int(max(1, min(size, rows)))
+
+    def variable_options(self, variable_name, dtype, size=None, row_size=None):
+        """ createVariable keyword arguments for a data variable. Variables
+            chunked along time should pass the `size` of the time dimension
+            and, for (time, z) variables, the `row_size` of the z dimension.
+        """
+        dtype = np.dtype(dtype)
+        options = dict(zlib=self.zlib)
+        if self.zlib is True:
+            options.update(complevel=self.complevel, shuffle=self.shuffle)
+
+        if size is not None:
+            if row_size is None:
+                options['chunksizes'] = (self.time_chunk(size, dtype.itemsize),)
+            else:
+                options['chunksizes'] = (self.time_chunk(size, dtype.itemsize * row_size), row_size)
+
+        digits = self.least_significant_digit
+        if isinstance(digits, dict):
+            digits = digits.get(variable_name)
+        if digits is not None and np.issubdtype(dtype, np.floating):
+            options['least_significant_digit'] = digits
+
+        return options
+
+    def describe(self):
+        if self.chunk_rows is not None:
+            chunks = 'time chunks of {!s} rows'.format(self.chunk_rows)
+        else:
+            chunks = '{} access time chunks of {!s} bytes'.format(self.access, self.chunk_bytes)
+        if self.zlib is True:
+            compression = 'zlib level {!s}{}'.format(self.complevel, ' with shuffle' if self.shuffle else '')
+        else:
+            compression = 'no compression'
+        described = "Storage policy '{}': {}, {}".format(self.name, chunks, compression)
+        if self.least_significant_digit is not None:
+            described += ', least_significant_digit {!s}'.format(self.least_significant_digit)
+        return described
+
+
+STORAGE_POLICIES = {
+    # The layout TimeSeries has always written
+    'default': StoragePolicy('default', chunk_rows=1000),
+    # Small files, read whole
+    'archive': StoragePolicy('archive', access='series', complevel=9),
+    # Cheap to decompress windows of time
+    'fast-read': StoragePolicy('fast-read', access='window', complevel=1),
+    # Few large chunks and no compression
+    'fast-write': StoragePolicy('fast-write', access='series', zlib=False),
+}
+
+
+def get_storage_policy(policy=None):
+    """ A StoragePolicy from a preset name, an existing policy or None """
+    if policy is None:
+        return STORAGE_POLICIES['default']
+    elif isinstance(policy, StoragePolicy):
+        return policy
+    try:
+        return STORAGE_POLICIES[policy]
+    except KeyError:
+        raise ValueError("Unknown storage policy '{}', expected one of {}".format(policy, sorted(STORAGE_POLICIES.keys())))
+
+
+StationResult = namedtuple('StationResult', ['station', 'path', 'error'])
+
+
+def _export_station(job):
+    """ Writes one station's file, run in a worker process by
+        TimeSeries.from_stations_dataframe. Errors are returned as text so
+        one bad station doesn't abort the batch.
+    """
+    station, df, kwargs = job
+    try:
+        ts = TimeSeries.from_dataframe(df, **kwargs)
+        ts.ncd.close()
+        return StationResult(station, ts.out_file, None)
+    except Exception as e:
+        logger.exception("Could not export station {!s}".format(station))
+        return StationResult(station, None, '{}: {!s}'.format(type(e).__name__, e))
+
+
 class TimeSeries(object):
 
+    # Data held by a batch is written once it grows past this many bytes
+    batch_bytes = 64 * 1024 * 1024
+
     @staticmethod
-    def from_dataframe(df, output_directory, output_filename, latitude, longitude, station_name, global_attributes, variable_name, variable_attributes, sensor_vertical_datum=None, fillvalue=None, data_column=None, vertical_axis_name=None, vertical_positive=None, create_instrument_variable=False, attempts=None):
+    def from_dataframe(df, output_directory, output_filename, latitude, longitude, station_name, global_attributes, variable_name, variable_attributes, sensor_vertical_datum=None, fillvalue=None, data_column=None, vertical_axis_name=None, vertical_positive=None, create_instrument_variable=False, attempts=None, unlimited_time=False, storage_policy=None):
 
-        # Attempts is how many files to try to build a NetCDF files from a
-        # dataframe. For backwards compatibility purposes, we always try
-        # everything (even manual matching which takes forever and is a memory
-        # hog).
+        # The layout is planned up front and the file is written once. For
+        # backwards compatibility, `attempts` still limits how far down the
+        # old retry ladder (1=orthogonal, 2=unique times, 5=manual matching)
+        # a dataframe is allowed to go before a ValueError is raised.
         attempts = attempts or 5
 
         if fillvalue is None:
@@ -48,50 +340,189 @@ class TimeSeries(object):
         vertical_fillvalue = df['depth'].values.dtype.type(fillvalue)
 
         df[data_column] = df[data_column].fillna(data_fillvalue)
-        times = np.asarray([ calendar.timegm(x.utctimetuple()) for x in df['time'] ])
+        times = np.ma.getdata(encode_times(df['time'], 'seconds since 1970-01-01T00:00:00Z', integer=True))
         df['depth'] = df['depth'].fillna(vertical_fillvalue)
 
         depths = df['depth'].values
+        plan = plan_layout(times, depths)
+        if plan.attempt > attempts:
+            raise ValueError("The dataframe needs the '{}' layout ({}), which is attempt {!s} of the {!s} allowed".format(plan.layout, plan.reason, plan.attempt, attempts))
+        logger.info("Using the '{}' layout: {}".format(plan.layout, plan.reason))
+
+        values = df[data_column].values
+        summary = None
+        if plan.layout == 'scatter':
+            values, summary = match_values(values, times, plan.times, data_fillvalue, verticals=depths, vertical_axis=plan.verticals)
+        elif plan.order is not None:
+            values = values[plan.order]
+
+        ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=plan.times, verticals=plan.verticals, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive, unlimited_time=unlimited_time, storage_policy=storage_policy)
+        ts.layout = plan
+        ts.add_variable(variable_name, values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
+        if summary is not None:
+            ts.match_summaries[variable_name] = summary
+            if summary.out_of_range or summary.duplicates:
+                logger.warning("Matched {!s} values for {}, dropped {!s} out of range and {!s} duplicate values".format(summary.matched, variable_name, summary.out_of_range, summary.duplicates))
+        return ts
+
+    @staticmethod
+    def from_stations_dataframe(df, stations, output_directory, variable_name, variable_attributes, station_column=None, workers=None, **kwargs):
+        """ Writes one TimeSeries file per station of a long format DataFrame
+            using a pool of `workers` processes (defaults to the CPU count,
+            1 or less writes in this process).
+
+            `stations` maps each value of `station_column` to a dict of the
+            `from_dataframe` arguments for that station: latitude, longitude,
+            station_name, global_attributes and optionally output_filename
+            (defaults to '<station>.nc'). Any other keyword arguments are
+            passed to every `from_dataframe` call.
+
+            Returns a {station: StationResult} dict. Stations that could not
+            be written have a `path` of None and the reason in `error`.
+        """
+        if station_column is None:
+            station_column = 'station'
+
+        results = {}
+        jobs = []
+        for station, sdf in df.groupby(station_column, sort=False):
+            if station not in stations:
+                results[station] = StationResult(station, None, 'KeyError: no station metadata for {!s}'.format(station))
+                continue
+            skwargs = dict(kwargs,
+                           output_directory=output_directory,
+                           output_filename='{!s}.nc'.format(station),
+                           variable_name=variable_name,
+                           variable_attributes=variable_attributes)
+            skwargs.update(stations[station])
+            jobs.append((station, sdf.drop(station_column, axis=1), skwargs))
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if workers <= 1 or len(jobs) <= 1:
+            exported = map(_export_station, jobs)
+        else:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            try:
+                exported = pool.map(_export_station, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        for r in exported:
+            results[r.station] = r
+        logger.info("Exported {!s} of {!s} stations".format(sum(r.error is None for r in results.values()), len(results)))
+        return results
+
+    @staticmethod
+    def from_chunks(chunks, output_directory, output_filename, latitude, longitude, station_name, global_attributes, variable_name, variable_attributes, sensor_vertical_datum=None, fillvalue=None, data_column=None, vertical_axis_name=None, vertical_positive=None, create_instrument_variable=False, verticals=None, storage_policy=None):
+        """ Writes a TimeSeries file from an iterable of chunks in time order,
+            holding about one chunk in memory at a time. Each chunk is either
+            a DataFrame like the one `from_dataframe` takes or a tuple of
+            (times, depths, values) arrays with times in seconds since 1970.
+
+            The vertical axis can not grow once the file exists, so it is
+            `verticals` or the unique depths of the first chunk. Values at
+            other depths are dropped and counted in `match_summaries`.
+            Rows sharing the last time of a chunk are held back and written
+            with the next chunk, so chunks can split a profile.
+        """
+        if fillvalue is None:
+            fillvalue = -9999.9
+        if data_column is None:
+            data_column = 'value'
+
+        def chunk_arrays(chunk):
+            if isinstance(chunk, pd.DataFrame):
+                times = np.ma.getdata(encode_times(chunk['time'], 'seconds since 1970-01-01T00:00:00Z', integer=True))
+                return times, chunk['depth'].values, chunk[data_column].values
+            return tuple( np.asarray(x).flatten() for x in chunk )
+
+        chunks = iter(chunks)
         try:
-            ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=times, verticals=depths, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive)
-            ts.add_variable(variable_name, df[data_column].values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
-        except ValueError:
-            if attempts < 2:
-                raise
-            logger.warning("Attempt 2: using unique times")
+            times, depths, values = chunk_arrays(next(chunks))
+        except StopIteration:
+            raise ValueError("There were no chunks to write")
+
+        data_fillvalue = values.dtype.type(fillvalue)
+        vertical_fillvalue = depths.dtype.type(fillvalue)
+        if verticals is None:
+            verticals = np.unique(pd.Series(depths).fillna(vertical_fillvalue).values)
+        verticals = np.asarray(verticals)
+        is_profile = verticals.size > 1
+
+        state = dict(ts=None, written=0, first=None, last=None)
+        diff_counts = {}
+        match_totals = np.zeros(3, dtype=np.int64)
+
+        def write(times, depths, values):
+            values = pd.Series(values).fillna(data_fillvalue).values.astype(data_fillvalue.dtype)
+            if is_profile:
+                depths = pd.Series(depths).fillna(vertical_fillvalue).values
+                block_times = np.unique(times)
+                block_values, summary = match_values(values, times, block_times, data_fillvalue, verticals=depths, vertical_axis=verticals)
+                match_totals[:] += summary
+            else:
+                order = np.argsort(times, kind='mergesort')
+                block_times = times[order]
+                block_values = values[order]
+
+            if state['last'] is not None and block_times[0] <= state['last']:
+                raise ValueError("Chunks must be in time order, {!s} came after {!s}".format(block_times[0], state['last']))
+
+            # Running time statistics, on unique times like setup_times_and_verticals
+            unique_times = np.unique(block_times)
+            if state['last'] is not None:
+                unique_times = np.append(state['last'], unique_times)
+            diffs, counts = np.unique(unique_times[1:] - unique_times[:-1], return_counts=True)
+            for d, c in zip(diffs.tolist(), counts.tolist()):
+                diff_counts[d] = diff_counts.get(d, 0) + c
+            if state['first'] is None:
+                state['first'] = block_times[0]
+            state['last'] = block_times[-1]
+
+            ts = state['ts']
+            if ts is None:
+                ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=block_times, verticals=verticals, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive, unlimited_time=True, storage_policy=storage_policy)
+                ts.add_variable(variable_name, block_values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
+                state['ts'] = ts
+            else:
+                # Aligned with the end of the unlimited time dimension
+                sl = slice(state['written'], state['written'] + block_times.size)
+                ts.time[sl] = block_times
+                ts.ncd.variables[variable_name][sl] = block_values
+            state['written'] += block_times.size
+
+        carry = None
+        while True:
+            if carry is not None:
+                times, depths, values = ( np.concatenate(x) for x in zip(carry, (times, depths, values)) )
+
             try:
-                # Try uniquing time
-                newtimes  = np.unique(times)
-                ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=newtimes, verticals=depths, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive)
-                ts.add_variable(variable_name, df[data_column].values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
-            except ValueError:
-                if attempts < 3:
-                    raise
-                logger.warning("Attempt 3: using unique depths")
-                try:
-                    # Try uniquing depths
-                    newdepths = np.unique(df['depth'].values)
-                    ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=times, verticals=newdepths, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive)
-                    ts.add_variable(variable_name, df[data_column].values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
-                except ValueError:
-                    if attempts < 4:
-                        raise
-                    logger.warning("Attempt 4: using unique time and depth")
-                    try:
-                        # Unique both time and depth
-                        newdepths = np.unique(df['depth'].values)
-                        ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=newtimes, verticals=newdepths, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive)
-                        ts.add_variable(variable_name, df[data_column].values, attributes=variable_attributes, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=True, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
-                    except ValueError:
-                        if attempts < 5:
-                            raise
-                        logger.warning("Attempt 5: manually matching (this is SLOW)")
-                        # Manually match
-                        ts = TimeSeries(output_directory, latitude, longitude, station_name, global_attributes, times=times, verticals=depths, output_filename=output_filename, vertical_fill=vertical_fillvalue, vertical_axis_name=vertical_axis_name, vertical_positive=vertical_positive)
-                        ts.add_variable(variable_name, df[data_column].values, attributes=variable_attributes, times=times, verticals=depths, sensor_vertical_datum=sensor_vertical_datum, raise_on_error=False, fillvalue=data_fillvalue, create_instrument_variable=create_instrument_variable)
+                chunk = next(chunks)
+            except StopIteration:
+                write(times, depths, values)
+                break
+
+            # Hold back the rows of the last time, the next chunk may have more of them
+            held = times == times.max()
+            carry = (times[held], depths[held], values[held])
+            if not held.all():
+                write(times[~held], depths[~held], values[~held])
+            times, depths, values = chunk_arrays(chunk)
+
+        ts = state['ts']
+        ts._set_time_coverage(state['first'], state['last'], resolution=_most_common(diff_counts))
+        ts._time_values = None
+        if is_profile:
+            ts.match_summaries[variable_name] = MatchSummary(*match_totals.tolist())
+            if match_totals[1] or match_totals[2]:
+                logger.warning("Matched {!s} values for {}, dropped {!s} out of range and {!s} duplicate values".format(match_totals[0], variable_name, match_totals[1], match_totals[2]))
+        ts.ncd.sync()
         return ts
 
-    def __init__(self, output_directory, latitude, longitude, station_name, global_attributes, times=None, verticals=None, vertical_fill=None, output_filename=None, vertical_axis_name=None, vertical_positive=None):
+    def __init__(self, output_directory, latitude, longitude, station_name, global_attributes, times=None, verticals=None, vertical_fill=None, output_filename=None, vertical_axis_name=None, vertical_positive=None, unlimited_time=False, storage_policy=None):
         if output_filename is None:
             output_filename = '{}_{}.nc'.format(station_name, int(random.random() * 100000))
             logger.info("No output filename specified, saving as {}".format(output_filename))
@@ -99,12 +530,16 @@ class TimeSeries(object):
         self.vertical_positive  = vertical_positive or 'down'
         self.vertical_axis_name = vertical_axis_name or 'z'
         self.time_axis_name     = 'time'
+        self.storage_policy     = get_storage_policy(storage_policy)
 
         # Make directory
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
 
         self.time = None
+        self.layout = None
+        self._pending_writes = None
+        self.match_summaries = {}
 
         self.out_file = os.path.abspath(os.path.join(output_directory, output_filename))
         if os.path.isfile(self.out_file):
@@ -138,6 +573,8 @@ class TimeSeries(object):
 
             old_history = getattr(nc, 'history', '')
             new_history = '{} - {} - {}'.format(now_date, 'pyaxiom', 'File created using pyaxiom')
+            if storage_policy is not None:
+                new_history = '{}\n{} - {} - {}'.format(new_history, now_date, 'pyaxiom', self.storage_policy.describe())
             if old_history:
                 nc.setncattr('history', '{}\n{}'.format(old_history, new_history))
             else:
@@ -207,16 +644,145 @@ class TimeSeries(object):
             self.vertical_fill = vertical_fill
 
         self._nc = EnhancedDataset(self.out_file, 'a')
-        self.setup_times_and_verticals(times, verticals)
+        self.setup_times_and_verticals(times, verticals, unlimited_time=unlimited_time)
         logger.info("Created file at '{}'".format(self.out_file))
 
+    @classmethod
+    def load(cls, path, storage_policy=None):
+        """ Opens an existing pyaxiom timeseries file so more rows can be
+            appended to it (see `append`) without recreating it.
+        """
+        ts = cls.__new__(cls)
+        ts.out_file = os.path.abspath(path)
+        ts._nc = EnhancedDataset(ts.out_file, 'a')
+
+        ts.time_axis_name = 'time'
+        ts.time = ts._nc.variables[ts.time_axis_name]
+        ts.z = ts._nc.get_variables_by_attributes(axis='Z')[0]
+        ts.vertical_axis_name = ts.z.name
+        ts.vertical_positive = getattr(ts.z, 'positive', 'down')
+        ts.vertical_fill = getattr(ts.z, '_FillValue', -9999.9)
+        ts.crs = ts._nc.variables['crs']
+
+        chunking = ts.time.chunking()
+        if chunking == 'contiguous':
+            ts.time_chunk = min(ts.time.size, 1000)
+        else:
+            ts.time_chunk = chunking[0]
+
+        # The stored axes are already sorted and unique
+        ts.time_indexes = slice(None)
+        ts.vertical_indexes = slice(None)
+        ts._time_values = None
+        ts.vertical_values = np.ma.getdata(ts.z[:]).flatten()
+
+        ts.layout = None
+        ts.storage_policy = get_storage_policy(storage_policy)
+        ts.match_summaries = {}
+        ts._pending_writes = None
+        return ts
+
+    def append(self, times, values, overlap=None):
+        """ Adds rows to a file with an unlimited time dimension.
+
+            `values` is a dict of variable name to an array with one row per
+            time, shaped (time,) or (time, z) like the variable in the file.
+            Only the stored rows at or after the earliest new time are read
+            and rewritten, so appending past the end only writes new rows.
+            Variables that are not in `values` get fill values for new rows.
+
+            `overlap` is what to do with times that are already stored:
+            'error' (default) raises a ValueError, 'replace' overwrites the
+            stored rows and 'skip' keeps them.
+
+            Returns the number of rows added to the time dimension.
+        """
+        overlap = overlap or 'error'
+        if overlap not in ['error', 'replace', 'skip']:
+            raise ValueError("The 'overlap' parameter must be one of 'error', 'replace' or 'skip', not {}".format(overlap))
+
+        if not self._nc.dimensions['time'].isunlimited():
+            raise ValueError("Can only append to a file with an unlimited time dimension")
+
+        times = np.asarray(times).flatten()
+        order = np.argsort(times, kind='mergesort')
+        times = times[order].astype(self.time.dtype)
+        if np.any(times[1:] == times[:-1]):
+            raise ValueError("The 'times' parameter can not contain duplicate times")
+
+        # Stored rows are read back below, so any batched data has to be written first
+        self._flush()
+
+        unknown = set(values.keys()) - set(self._nc.variables.keys())
+        if unknown:
+            raise ValueError("Variables {} are not in the file, use add_variable to create them".format(', '.join(sorted(unknown))))
+
+        # Find where the new times go on the (sorted) stored time axis
+        stored = self.time.size
+        if stored == 0 or times[0] > self.time[stored - 1]:
+            start = stored
+        else:
+            start = bisect.bisect_left(_VariableSequence(self.time), times[0])
+        stored_times = np.ma.getdata(self.time[start:]).flatten()
+
+        overlapping = np.in1d(times, stored_times)
+        if overlapping.any() and overlap == 'error':
+            raise ValueError("{!s} of the times are already in the file".format(np.count_nonzero(overlapping)))
+        keep = ~overlapping if overlap == 'skip' else np.ones(times.size, dtype=bool)
+
+        merged_times = np.union1d(stored_times, times)
+        stored_indexes = np.searchsorted(merged_times, stored_times)
+        new_indexes = np.searchsorted(merged_times, times)
+
+        # Build everything before writing so a bad shape leaves the file alone
+        rows = {}
+        for name, var in self._nc.variables.items():
+            if name == self.time_axis_name or not var.dimensions or var.dimensions[0] != 'time':
+                continue
+            if name not in values and stored_times.size == 0:
+                # Unwritten rows of an unlimited dimension read as fill values
+                continue
+
+            merged = np.ma.masked_all((merged_times.size, ) + var.shape[1:], dtype=var.dtype)
+            if stored_times.size:
+                merged[stored_indexes] = var[start:]
+            if name in values:
+                try:
+                    new_values = np.ma.reshape(values[name], (times.size, ) + var.shape[1:])[order]
+                except ValueError:
+                    raise ValueError("Values for {} must have a shape of {!s}".format(name, (times.size, ) + var.shape[1:]))
+                merged[new_indexes[keep]] = new_values[keep]
+            rows[name] = merged
+
+        self.time[start:] = merged_times
+        for name, merged in rows.items():
+            self._nc.variables[name][start:] = merged
+
+        # Time extents
+        self._set_time_coverage(self.time[0], merged_times[-1])
+        self._nc.setncattr("date_modified", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:00Z"))
+
+        self._time_values = None
+        self._sync()
+
+        added = merged_times.size - stored_times.size
+        logger.info("Appended {!s} rows to '{}'".format(added, self.out_file))
+        return added
+
+    @property
+    def time_values(self):
+        # The sorted time axis, kept in memory for matching values to it
+        if self._time_values is None:
+            self._time_values = np.ma.getdata(self.time[:]).flatten()
+        return self._time_values
+
     def add_instrument_metadata(self, urn):
         instrument = self._nc.createVariable("instrument", "i4")
         instrument.definition = "http://mmisw.org/ont/ioos/definition/sensorID"
         instrument.long_name = urn
         instrument.ioos_code = urn
         self._nc.instrument = 'instrument'
-        self._nc.sync()
+        self._sync()
 
     def add_instrument_variable(self, variable_name):
         if variable_name not in self._nc.variables:
@@ -246,25 +812,44 @@ class TimeSeries(object):
         av += ' {}'.format(instr_var_name)
         datavar.ancillary_variables = av.strip()
 
-        self._nc.sync()
+        self._sync()
 
     def add_time_bounds(self, delta=None, position=None):
+        """ Adds a (time, bounds) variable for values that are averaged over
+            `delta`, a fixed timedelta or a calendar relativedelta/DateOffset.
+            `position` is where in the interval each time is: 'start',
+            'middle' or 'end'. The bounds are computed and written one time
+            chunk at a time.
+        """
         self._nc.createDimension("bounds", 2)
         time_bounds = self._nc.createVariable('{}_bounds'.format(self.time_axis_name), "f8", ("time", "bounds",), chunksizes=(self.time_chunk, 2,))
         time_bounds.units    = "seconds since 1970-01-01T00:00:00Z"
         time_bounds.calendar = "gregorian"
+        self.time.bounds = time_bounds.name
 
-        time_objs = netCDF4.num2date(self.time[:], units=self.time.units, calendar=self.time.calendar)
-        bounds_kwargs = dict(units=time_bounds.units, calendar=time_bounds.calendar)
-
-        if position == "start":
-            time_bounds[:] = np.asarray(list(zip(self.time[:], netCDF4.date2num(time_objs + delta, **bounds_kwargs))))
-        elif position == "middle":
-            time_bounds[:] = np.asarray(list(zip(netCDF4.date2num(time_objs - delta / 2, **bounds_kwargs), netCDF4.date2num(time_objs + delta / 2, **bounds_kwargs))))
-        elif position == "end":
-            time_bounds[:] = np.asarray(list(zip(netCDF4.date2num(time_objs - delta, **bounds_kwargs), self.time[:])))
-
-        self._nc.sync()
+        if position not in ['start', 'middle', 'end']:
+            positions = []
+        else:
+            positions = range(0, self.time.size, self.time_chunk)
+
+        for start in positions:
+            sl = slice(start, start + self.time_chunk)
+            times = np.ma.getdata(self.time[sl]).astype(np.float64)
+
+            bounds = np.empty((times.size, 2), dtype=np.float64)
+            if position == "start":
+                bounds[:, 0] = times
+                bounds[:, 1] = times + delta_lengths(times, time_bounds.units, delta)
+            elif position == "middle":
+                half = delta_lengths(times, time_bounds.units, delta) / 2
+                bounds[:, 0] = times - half
+                bounds[:, 1] = times + half
+            elif position == "end":
+                bounds[:, 0] = times - delta_lengths(times, time_bounds.units, delta, sign=-1)
+                bounds[:, 1] = times
+            self._write(time_bounds, bounds, index=sl)
+
+        self._sync()
 
     def add_variable(self, variable_name, values, times=None, verticals=None, sensor_vertical_datum=None, attributes=None, unlink_from_profile=None, fillvalue=None, raise_on_error=False, create_instrument_variable=False):
 
@@ -331,32 +916,24 @@ class TimeSeries(object):
                 if times is not None and verticals is not None:
                     # Hmmm, we have two actual height values for this station.
                     # Not cool man, not cool.
-                    # Reindex the entire values array.  This is slow.
-                    indexed = ((bisect.bisect_left(self.time[:], times[i]), bisect.bisect_left(vertical_axis[:], verticals[i]), values[i]) for i in range(values.size))
-                    used_values = np.ndarray((self.time.size, vertical_axis.size, ), dtype=get_type(values))
-                    used_values.fill(fillvalue)
-                    for (tzi, zzi, vz) in indexed:
-                        if zzi < vertical_axis.size and tzi < self.time.size:
-                            used_values[tzi, zzi] = vz
-                    del indexed
+                    # Reindex the entire values array.
+                    used_values, summary = match_values(values, times, self.time_values, fillvalue, verticals=verticals, vertical_axis=self.vertical_values)
                 else:
                     raise ValueError("You need to pass in both 'times' and 'verticals' parameters that matches the size of the 'values' parameter.")
             else:
                 if times is not None:
-                    # Ugh, find the time indexes manually
-                    indexed = ((bisect.bisect_left(self.time[:], times[i]), values[i]) for i in range(values.size))
-                    used_values = np.ndarray((self.time.size, ), dtype=get_type(values))
-                    used_values.fill(fillvalue)
-                    for (tzi, vz) in indexed:
-                        if tzi < self.time.size:
-                            used_values[tzi] = vz
-                    del indexed
+                    # Find the time indexes manually
+                    used_values, summary = match_values(values, times, self.time_values, fillvalue)
                 else:
                     raise ValueError("You need to pass in a 'times' parameter that matches the size of the 'values' parameter.")
 
+            self.match_summaries[variable_name] = summary
+            if summary.out_of_range or summary.duplicates:
+                logger.warning("Matched {!s} values for {}, dropped {!s} out of range and {!s} duplicate values".format(summary.matched, variable_name, summary.out_of_range, summary.duplicates))
+
         logger.info("Setting values for {}...".format(variable_name))
         if len(used_values.shape) == 1:
-            var = self._nc.createVariable(variable_name, get_type(used_values), ("time",), fill_value=fillvalue, chunksizes=(self.time_chunk,), zlib=True)
+            var = self._nc.createVariable(variable_name, get_type(used_values), ("time",), fill_value=fillvalue, **self.storage_policy.variable_options(variable_name, get_type(used_values), size=used_values.shape[0]))
             self._nc.setncattr('ncei_template_version', 'NCEI_NetCDF_TimeSeries_Orthogonal_Template_v2.0')
             if vertical_axis.size == 1:
                 var.coordinates = "{} {} latitude longitude".format(self.time_axis_name, self.vertical_axis_name)
@@ -377,12 +954,12 @@ class TimeSeries(object):
                             inst_depth.long_name = 'sensor height above datum'
                         inst_depth.datum = sensor_vertical_datum or 'Unknown'
                         if verticals and verticals.size > 0:
-                            inst_depth[:] = verticals[0]
+                            self._write(inst_depth, verticals[0])
                         else:
-                            inst_depth[:] = self.vertical_fill
+                            self._write(inst_depth, self.vertical_fill)
 
         elif len(used_values.shape) == 2:
-            var = self._nc.createVariable(variable_name, get_type(used_values), ("time", "z",), fill_value=fillvalue, chunksizes=(self.time_chunk, vertical_axis.size,), zlib=True)
+            var = self._nc.createVariable(variable_name, get_type(used_values), ("time", "z",), fill_value=fillvalue, **self.storage_policy.variable_options(variable_name, get_type(used_values), size=used_values.shape[0], row_size=vertical_axis.size))
             var.coordinates = "{} {} latitude longitude".format(self.time_axis_name, self.vertical_axis_name)
             self._nc.setncattr('ncei_template_version', 'NCEI_NetCDF_TimeSeriesProfile_Orthogonal_Template_v2.0')
         else:
@@ -424,50 +1001,148 @@ class TimeSeries(object):
         var.platform = 'platform'
         var.ancillary_variables = 'platform'
         var.coverage_content_type = 'physicalMeasurement'
-        var[:] = used_values
+        self._write(var, used_values)
 
         if create_instrument_variable is True:
             self.add_instrument_variable(variable_name)
 
-        self._nc.sync()
+        self._sync()
         del used_values
         return var
 
-    def add_variable_object(self, varobject, dimension_map=None, reduce_dims=None):
+    def add_variables(self, variables):
+        """ Adds many variables at once. `variables` is a list of dicts of
+            `add_variable` keyword arguments. All of the variables are defined
+            first, then all of the data is written and the file is synced once.
+            Returns the created variables.
+        """
+        with self.batch():
+            return [ self.add_variable(**kwargs) for kwargs in variables ]
+
+    @contextmanager
+    def batch(self):
+        """ Groups calls to the add_* methods. Variables and attributes are
+            defined as the methods are called, but data writes are held until
+            the block exits and the file is only synced once. The held data
+            is written early when it grows past `batch_bytes`, and copies
+            from `add_variable_object` are written block by block.
+
+            >>> with ts.batch():
+            ...     ts.add_variable('temperature', temperatures)
+            ...     ts.add_variable('salinity', salinities)
+        """
+        if self._pending_writes is not None:
+            # Already inside of a batch, the outer one will write everything
+            yield self
+            return
 
+        self._pending_writes = []
+        try:
+            yield self
+        finally:
+            self._flush()
+            self._pending_writes = None
+            self._nc.sync()
+
+    def _write(self, var, values, index=None):
+        if index is None:
+            index = slice(None)
+        if self._pending_writes is None:
+            var[index] = values
+        else:
+            self._pending_writes.append((var, index, values))
+            if sum( np.asarray(v).nbytes for _, _, v in self._pending_writes ) > self.batch_bytes:
+                self._flush()
+
+    def _flush(self):
+        # Write any data held by a batch, the batch stays open
+        if self._pending_writes:
+            pending, self._pending_writes = self._pending_writes, []
+            for var, index, values in pending:
+                var[index] = values
+
+    def _sync(self):
+        # A batch syncs once when it is done
+        if self._pending_writes is None:
+            self._nc.sync()
+
+    def add_variable_object(self, varobject, dimension_map=None, reduce_dims=None, block_bytes=None):
+        """ Copies a variable, or a list of variables, from another dataset.
+            The data is copied in blocks along the largest dimension of each
+            variable, aligned to its chunks, so only about `block_bytes`
+            (16 MB by default) of it is in memory at a time.
+            `reduce_dims` drops dimensions of size 0 or 1.
+        """
         dimension_map = dimension_map or {}
         reduce_dims = reduce_dims or False
+        block_bytes = block_bytes or 16 * 1024 * 1024
 
-        fillvalue = -9999.99
-        if hasattr(varobject, '_FillValue'):
-            fillvalue = varobject._FillValue
-        fillvalue = varobject.dtype.type(fillvalue)
+        if isinstance(varobject, (list, tuple)):
+            varobjects = varobject
+        else:
+            varobjects = [varobject]
 
-        dims = []
-        for n in varobject.dimensions:
-            d = dimension_map.get(n, n)
-            dim_size = varobject.shape[list(varobject.dimensions).index(n)]
-            if reduce_dims is True and dim_size in [0, 1]:
-                continue
+        # Define everything first, then copy the data
+        copies = []
+        for varobject in varobjects:
+            fillvalue = -9999.99
+            if hasattr(varobject, '_FillValue'):
+                fillvalue = varobject._FillValue
+            fillvalue = varobject.dtype.type(fillvalue)
 
-            if d not in self._nc.dimensions:
-                self._nc.createDimension(d, dim_size)
-            dims.append(d)
+            dims = []
+            kept = []
+            for i, n in enumerate(varobject.dimensions):
+                d = dimension_map.get(n, n)
+                dim_size = varobject.shape[i]
+                if reduce_dims is True and dim_size in [0, 1]:
+                    continue
 
-        var = self._nc.createVariable(varobject.name, get_type(varobject), dims, fill_value=fillvalue, zlib=True)
+                if d not in self._nc.dimensions:
+                    self._nc.createDimension(d, dim_size)
+                dims.append(d)
+                kept.append(i)
 
-        for k in varobject.ncattrs():
-            if k not in ['name', '_FillValue']:
-                var.setncattr(k, varobject.getncattr(k))
+            var = self._nc.createVariable(varobject.name, get_type(varobject), dims, fill_value=fillvalue, **self.storage_policy.variable_options(varobject.name, get_type(varobject)))
 
-        if reduce_dims:
-            var[:] = varobject[:].squeeze()
-        else:
-            var[:] = varobject[:]
+            for k in varobject.ncattrs():
+                if k not in ['name', '_FillValue']:
+                    var.setncattr(k, varobject.getncattr(k))
 
-        self._nc.sync()
+            copies.append((varobject, var, kept))
 
-    def setup_times_and_verticals(self, times, verticals):
+        for varobject, var, kept in copies:
+            self._copy_blocks(varobject, var, kept, block_bytes)
+
+        self._sync()
+
+    def _copy_blocks(self, varobject, var, kept, block_bytes):
+        if 0 in varobject.shape:
+            return
+
+        if not kept:
+            # Scalar, or every dimension was reduced
+            self._write(var, varobject[:].squeeze())
+            return
+
+        # Reduced dimensions are size 1, index them away
+        source = [ slice(None) if i in kept else 0 for i in range(len(varobject.shape)) ]
+        destination = [ slice(None) ] * len(kept)
+
+        axis = max(kept, key=lambda i: varobject.shape[i])
+        row_bytes = max(np.dtype(varobject.dtype).itemsize, 8) * int(np.prod(varobject.shape)) // varobject.shape[axis]
+        chunking = varobject.chunking()
+        chunk = 1 if chunking == 'contiguous' else chunking[axis]
+        rows = max(1, block_bytes // row_bytes)
+        block = max(chunk, rows // chunk * chunk)
+
+        for start in range(0, varobject.shape[axis], block):
+            source[axis] = slice(start, start + block)
+            destination[kept.index(axis)] = source[axis]
+            # Not held by a batch, so only one block is in memory
+            var[tuple(destination)] = varobject[tuple(source)]
+
+    def setup_times_and_verticals(self, times, verticals, unlimited_time=False):
 
         if isinstance(times, (list, tuple,)):
             times = np.asarray(times)
@@ -499,6 +1174,8 @@ class TimeSeries(object):
         # That means we allow duplicate times, as long as the data contains duplicate times as well.
         self.time_indexes = np.argsort(times)
         full_times = times[self.time_indexes]
+        # Keep the sorted axes around so values can be matched without reading them back from the file
+        self._time_values = full_times
 
         # Unique the vertical values
         # Special case for all zeros.  Added here for greater readability.
@@ -520,26 +1197,20 @@ class TimeSeries(object):
 
         # Calculate time stats based on a unique time array
         unique_times = np.unique(full_times)
-        starting = datetime.utcfromtimestamp(unique_times[0])
-        ending   = datetime.utcfromtimestamp(unique_times[-1])
 
         logger.debug("Setting up time...")
-        # Time extents
-        self._nc.setncattr("time_coverage_start",    starting.isoformat())
-        self._nc.setncattr("time_coverage_end",      ending.isoformat())
-        # duration (ISO8601 format)
-        self._nc.setncattr("time_coverage_duration", "PT{0:d}S".format(int(round((ending - starting).total_seconds()))))
         # resolution (ISO8601 format)
         # subtract adjacent times to produce an array of differences, then get the most common occurance
-        diffs = unique_times[1:] - unique_times[:-1]
-        uniqs, inverse = np.unique(diffs, return_inverse=True)
-        if uniqs.size > 1:
-            time_diffs = diffs[np.bincount(inverse).argmax()]
-            self._nc.setncattr("time_coverage_resolution", "PT{0:d}S".format(int(round(time_diffs))))
+        diffs, counts = np.unique(unique_times[1:] - unique_times[:-1], return_counts=True)
+        self._set_time_coverage(unique_times[0], unique_times[-1], resolution=_most_common(dict(zip(diffs, counts))))
 
         # Time
-        self.time_chunk = min(full_times.size, 1000)
-        self._nc.createDimension("time", full_times.size)
+        self.time_chunk = self.storage_policy.time_chunk(full_times.size, np.dtype(get_type(full_times)).itemsize)
+        if unlimited_time is True:
+            # Leave room to grow, see `append`
+            self._nc.createDimension("time", None)
+        else:
+            self._nc.createDimension("time", full_times.size)
         self.time = self._nc.createVariable(self.time_axis_name, get_type(full_times), ("time",), chunksizes=(self.time_chunk,))
         self.time.units          = "seconds since 1970-01-01T00:00:00Z"
         self.time.standard_name  = "time"
@@ -597,9 +1268,22 @@ class TimeSeries(object):
         self.z.units         = "m"
         self.z.axis          = "Z"
         self.z[:] = unique_verticals
+        self.vertical_values = np.ma.getdata(unique_verticals).flatten()
 
         self._nc.sync()
 
+    def _set_time_coverage(self, first, last, resolution=None):
+        starting = datetime.utcfromtimestamp(first)
+        ending   = datetime.utcfromtimestamp(last)
+
+        # Time extents
+        self._nc.setncattr("time_coverage_start",    starting.isoformat())
+        self._nc.setncattr("time_coverage_end",      ending.isoformat())
+        # duration (ISO8601 format)
+        self._nc.setncattr("time_coverage_duration", "PT{0:d}S".format(int(round((ending - starting).total_seconds()))))
+        if resolution is not None:
+            self._nc.setncattr("time_coverage_resolution", "PT{0:d}S".format(int(round(resolution))))
+
     @property
     def ncd(self):
         return self._nc
@@ -609,47 +1293,79 @@ class TimeSeries(object):
             self._nc.close()
 
 
-def get_dataframe_from_variable(nc, data_var):
-    """ Returns a Pandas DataFrame of the data.
-        This always returns positive down depths
+def time_window(time_var, start=None, end=None):
+    """ The slice of a sorted 1-D time variable between `start` and `end`
+        (inclusive, anything pandas can parse as a Timestamp). The variable
+        is binary searched on disk so only a few values are read.
     """
-    time_var = nc.get_variables_by_attributes(standard_name='time')[0]
+    sequence = _VariableSequence(time_var)
+    first = 0
+    last = time_var.size
+    if start is not None:
+        first = bisect.bisect_left(sequence, time_value(time_var, start))
+    if end is not None:
+        last = bisect.bisect_right(sequence, time_value(time_var, end))
+    return slice(first, max(first, last))
+
 
+def _depth_variables(nc):
     depth_vars = nc.get_variables_by_attributes(axis=lambda v: v is not None and v.lower() == 'z')
     depth_vars += nc.get_variables_by_attributes(standard_name=lambda v: v in ['height', 'depth' 'surface_altitude'], positive=lambda x: x is not None)
+    return depth_vars
+
 
+def _depth_variable(depth_vars, data_var):
     # Find the correct depth variable
-    depth_var = None
     for d in depth_vars:
         try:
             if d._name in data_var.coordinates.split(" ") or d._name in data_var.dimensions:
-                depth_var = d
-                break
+                return d
         except AttributeError:
             continue
+    return None
+
 
-    times  = netCDF4.num2date(time_var[:], units=time_var.units, calendar=getattr(time_var, 'calendar', 'standard'))
+def _decode_window(time_var, tsl):
+    if tsl.stop > tsl.start:
+        return decode_times(time_var[tsl], time_var.units, getattr(time_var, 'calendar', 'standard'))
+    return np.array([], dtype='datetime64[ns]')
+
+
+def _read_columns(times, tsl, depth_var, data_vars, min_depth=None, max_depth=None):
+    """ Reads the values of `data_vars`, which all have the same dimensions
+        and depth variable, for the `tsl` slice of time. Returns the
+        (times, depths, values) columns with one row per value, after the
+        depth range is applied.
+    """
     original_times_size = times.size
+    data_var = data_vars[0]
 
     if depth_var is None and hasattr(data_var, 'sensor_depth'):
         depth_type = get_type(data_var.sensor_depth)
         depths = np.asarray([data_var.sensor_depth] * len(times)).flatten()
-        values = data_var[:].flatten()
+        values = [ v[tsl].flatten() for v in data_vars ]
     elif depth_var is None:
         depths = np.asarray([np.nan] * len(times)).flatten()
         depth_type = get_type(depths)
-        values = data_var[:].flatten()
+        values = [ v[tsl].flatten() for v in data_vars ]
     else:
         depths = depth_var[:]
         depth_type = get_type(depths)
+        flip = getattr(depth_var, 'positive', 'down').lower() == 'up'
         if len(data_var.shape) > 1:
+            # Only read the levels inside of the depth range
+            zsl = slice(None)
+            if min_depth is not None or max_depth is not None:
+                inside = np.flatnonzero(in_range(depths * -1 if flip else depths, min_depth, max_depth))
+                zsl = slice(inside[0], inside[-1] + 1) if inside.size else slice(0, 0)
+                depths = depths[zsl]
             times = np.repeat(times, depths.size)
             depths = np.tile(depths, original_times_size)
-            values = data_var[:, :].flatten()
+            values = [ v[tsl, zsl].flatten() for v in data_vars ]
         else:
-            values = data_var[:].flatten()
+            values = [ v[tsl].flatten() for v in data_vars ]
 
-        if getattr(depth_var, 'positive', 'down').lower() == 'up':
+        if flip:
             logger.warning("Converting depths to positive down before returning the DataFrame")
             depths = depths * -1
 
@@ -661,10 +1377,83 @@ def get_dataframe_from_variable(nc, data_var):
     ):
         depths = np.asarray([np.nan] * len(times)).flatten()
 
-    df = pd.DataFrame({ 'time':   times,
-                        'value':  values.astype(data_var.dtype),
-                        'unit':   data_var.units if hasattr(data_var, 'units') else np.nan,
-                        'depth':  depths.astype(depth_type) })
+    values = [ v.astype(dv.dtype) for v, dv in zip(values, data_vars) ]
+    return times, depths.astype(depth_type), values
+
+
+def _indexed_frame(df, min_depth=None, max_depth=None):
+    if min_depth is not None or max_depth is not None:
+        df = df[in_range(df['depth'].values, min_depth, max_depth)]
 
     df.set_index([pd.DatetimeIndex(df['time']), pd.Float64Index(df['depth'])], inplace=True)
     return df
+
+
+def get_dataframe_from_variable(nc, data_var, start=None, end=None, min_depth=None, max_depth=None):
+    """ Returns a Pandas DataFrame of the data.
+        This always returns positive down depths
+
+        `start` and `end` limit the rows to a time window and `min_depth`
+        and `max_depth` to a (positive down) depth range, all inclusive.
+        Only the matching part of the data variable is read from disk.
+    """
+    time_var = nc.get_variables_by_attributes(standard_name='time')[0]
+    depth_var = _depth_variable(_depth_variables(nc), data_var)
+
+    tsl = time_window(time_var, start, end)
+    times, depths, values = _read_columns(_decode_window(time_var, tsl), tsl, depth_var, [data_var], min_depth, max_depth)
+
+    df = pd.DataFrame({ 'time':   times,
+                        'value':  values[0],
+                        'unit':   data_var.units if hasattr(data_var, 'units') else np.nan,
+                        'depth':  depths })
+    return _indexed_frame(df, min_depth, max_depth)
+
+
+def get_dataframe_from_variables(nc, variables=None, start=None, end=None, min_depth=None, max_depth=None):
+    """ Returns a wide Pandas DataFrame with a column for each of the
+        `variables` (names or variables, defaults to every variable along
+        the time dimension, and optionally a depth dimension, that isn't a
+        coordinate or bounds variable) and the same index as
+        `get_dataframe_from_variable`. The time axis is decoded once and
+        each variable is read once.
+
+        Variables on different dimensions or depths can't share an index,
+        if there are any a {(dimensions, depth variable name): DataFrame}
+        dict is returned with one frame for each group instead.
+    """
+    time_var = nc.get_variables_by_attributes(standard_name='time')[0]
+    depth_vars = _depth_variables(nc)
+
+    if variables is None:
+        skips = set([time_var.name] + [ d.name for d in depth_vars ])
+        for v in nc.variables.values():
+            skips.update(getattr(v, 'bounds', '').split())
+        depth_dimensions = set( d for dv in depth_vars for d in dv.dimensions )
+        variables = [
+            v for v in nc.variables.values()
+            if v.dimensions and v.dimensions[0] == time_var.dimensions[0] and v.name not in skips and
+            all( d in depth_dimensions for d in v.dimensions[1:] )
+        ]
+    variables = [ nc.variables[v] if not hasattr(v, 'dimensions') else v for v in variables ]
+
+    # Group the variables that can share an index, keeping their order
+    groups = OrderedDict()
+    for v in variables:
+        depth_var = _depth_variable(depth_vars, v)
+        key = (v.dimensions, depth_var.name if depth_var is not None else getattr(v, 'sensor_depth', None))
+        groups.setdefault(key, (depth_var, []))[1].append(v)
+
+    tsl = time_window(time_var, start, end)
+    times = _decode_window(time_var, tsl)
+
+    frames = OrderedDict()
+    for key, (depth_var, data_vars) in groups.items():
+        gtimes, depths, values = _read_columns(times, tsl, depth_var, data_vars, min_depth, max_depth)
+        columns = OrderedDict([('time', gtimes), ('depth', depths)])
+        columns.update(( (v.name, vvalues) for v, vvalues in zip(data_vars, values) ))
+        frames[key] = _indexed_frame(pd.DataFrame(columns), min_depth, max_depth)
+
+    if len(frames) == 1:
+        return list(frames.values())[0]
+    return frames
@@ -1,5 +1,13 @@
 #!python
 # coding=utf-8
+import math
+from functools import partial
+
+import netCDF4
+import numpy as np
+import pandas as pd
+
+from pyaxiom.utils import get_dtype, dict_update, padded_array
 
 
 def isstr(s):
@@ -16,3 +24,214 @@ def cf_safe_name(name):
             # Add a letter to the front
             name = "v_{}".format(name)
         return re.sub(r'[^_a-zA-Z0-9]', "_", name)
+
+
+def in_range(values, minv=None, maxv=None):
+    """ Boolean array of the `values` between `minv` and `maxv` (inclusive).
+        Masked and NaN values are never in range.
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+    inside = ~np.isnan(values)
+    if minv is not None:
+        inside[inside] = values[inside] >= minv
+    if maxv is not None:
+        inside[inside] = values[inside] <= maxv
+    return inside
+
+
+def time_value(time_var, value):
+    """ `value` (anything pandas can parse as a Timestamp) as a number in
+        the units and calendar of `time_var`, or None if `value` is None
+    """
+    if value is None:
+        return None
+    value = pd.Timestamp(value)
+    if value.tzinfo is not None:
+        value = value.tz_convert('UTC').tz_localize(None)
+    return netCDF4.date2num(value.to_pydatetime(), units=time_var.units, calendar=getattr(time_var, 'calendar', 'standard'))
+
+
+def read_where(var, keep):
+    """ The values of `var` where the boolean `keep` is True along its first
+        dimension. Each run of consecutive True values is read in one call,
+        so selecting a few instances reads only their hyperslabs.
+    """
+    rows = np.flatnonzero(keep)
+    if rows.size == len(keep):
+        return var[:]
+    elif rows.size == 0:
+        return np.ma.masked_all((0,) + tuple(var.shape[1:]), dtype=var.dtype if var.dtype != str else object)
+
+    breaks = np.flatnonzero(np.diff(rows) > 1) + 1
+    starts = rows[np.append([0], breaks)]
+    ends = rows[np.append(breaks - 1, rows.size - 1)] + 1
+    return np.ma.concatenate([ var[s:e] for s, e in zip(starts, ends) ])
+
+
+def feature_batches(sizes, max_rows=None):
+    """ (start, stop) ranges of the features with the row counts in `sizes`,
+        each holding as many whole features as fit in `max_rows` and at
+        least one. A single range without a `max_rows`.
+    """
+    if max_rows is None:
+        return [(0, len(sizes))] if len(sizes) else []
+
+    batches = []
+    start = 0
+    rows = 0
+    for i, size in enumerate(sizes):
+        if rows and rows + size > max_rows:
+            batches.append((start, i))
+            start = i
+            rows = 0
+        rows += size
+    if start < len(sizes):
+        batches.append((start, len(sizes)))
+    return batches
+
+
+# Target size of one chunk for each layout hint
+CHUNK_LAYOUT_BYTES = {
+    'per-instance': 64 * 1024,
+    'balanced': 1024 * 1024,
+    'per-variable-scan': 4 * 1024 * 1024,
+}
+# Ragged per-instance chunks are never smaller than this
+MIN_CHUNK_BYTES = 4 * 1024
+
+
+def chunk_cache(layout, shape, chunksizes, itemsize):
+    """ HDF5 chunk cache (size, nelems, preemption) for reading a variable
+        of `shape` stored in `chunksizes` chunks the way `layout` expects.
+        The cache holds the chunks spanning one instance (two for
+        'balanced'), and scans evict chunks as soon as they are read.
+    """
+    across = 1
+    for size, chunk in zip(shape[1:], chunksizes[1:]):
+        across *= int(math.ceil(float(size) / chunk))
+    slots = across * 2 if layout == 'balanced' else across
+    preemption = 1.0 if layout == 'per-variable-scan' else 0.75
+    size = int(np.prod(chunksizes)) * itemsize * slots
+    return size, max(1009, slots * 100), preemption
+
+
+class ChunkLayout(object):
+    """ Chunk shapes and chunk cache settings for a DSG file, from a hint of
+        how it will be read:
+
+        * per-instance: one whole profile, trajectory or station at a time
+        * per-variable-scan: one variable across all of the instances
+        * balanced: a compromise between the two
+
+        `instances` and `elements` are the sizes of the instance and
+        element dimensions. Ragged files have one element dimension for all
+        of the instances, its chunks hold about one instance for
+        'per-instance'. A layout named None leaves chunking to the library.
+    """
+
+    def __init__(self, name, instance_dimension, element_dimension, instances, elements, ragged=False, chunk_bytes=None):
+        if name is not None and name not in CHUNK_LAYOUT_BYTES:
+            raise ValueError("Unknown chunk layout '{}', expected one of {}".format(name, sorted(CHUNK_LAYOUT_BYTES.keys())))
+        self.name = name
+        self.instance_dimension = instance_dimension
+        self.element_dimension = element_dimension
+        self.instances = int(instances)
+        self.elements = int(elements)
+        self.ragged = ragged
+        self.chunk_bytes = chunk_bytes or CHUNK_LAYOUT_BYTES.get(name)
+
+    def chunksizes(self, dimensions, dtype):
+        """ Chunk shape for a variable over `dimensions`, or None to leave
+            it to the library
+        """
+        if self.name is None or not dimensions:
+            return None
+
+        # np.dtype(str) has no fixed size
+        itemsize = np.dtype(dtype).itemsize or 8
+        chunk_elements = max(1, self.chunk_bytes // itemsize)
+
+        def clamp(size, n):
+            return int(max(1, min(size, n)))
+
+        dimensions = tuple(dimensions)
+        if dimensions == (self.instance_dimension,):
+            return (clamp(self.instances, chunk_elements),)
+        elif dimensions == (self.element_dimension,):
+            if self.ragged and self.name == 'per-instance':
+                row_size = int(math.ceil(float(self.elements) / max(self.instances, 1)))
+                return (clamp(self.elements, min(chunk_elements, max(row_size, MIN_CHUNK_BYTES // itemsize))),)
+            return (clamp(self.elements, chunk_elements),)
+        elif dimensions == (self.instance_dimension, self.element_dimension):
+            if self.name == 'per-instance':
+                row = min(self.elements, chunk_elements)
+            elif self.name == 'per-variable-scan':
+                row = self.elements
+            else:
+                row = min(self.elements, int(math.sqrt(chunk_elements)))
+            return (clamp(self.instances, chunk_elements // max(row, 1)), clamp(self.elements, row))
+
+        return None
+
+    def create_variable(self, nc, name, datatype, dimensions=(), **kwargs):
+        """ nc.createVariable with this layout's chunk shape and cache """
+        chunks = self.chunksizes(dimensions, datatype)
+        if chunks is not None:
+            kwargs['chunksizes'] = chunks
+        v = nc.createVariable(name, datatype, dimensions, **kwargs)
+        if chunks is not None:
+            itemsize = np.dtype(datatype).itemsize or 8
+            v.set_var_chunk_cache(*chunk_cache(self.name, v.shape, chunks, itemsize))
+        return v
+
+    def attributes(self):
+        """ Records the layout so readers can adapt to it """
+        if self.name is None:
+            return {}
+        return {
+            'global': {
+                'chunk_layout': self.name
+            }
+        }
+
+
+def apply_chunk_layout(nc):
+    """ Sets the chunk cache of each chunked variable in a file written
+        with a ChunkLayout to suit the layout it recorded
+    """
+    layout = getattr(nc, 'chunk_layout', None)
+    if layout not in CHUNK_LAYOUT_BYTES:
+        return None
+
+    for v in nc.variables.values():
+        chunks = v.chunking()
+        if chunks == 'contiguous' or not v.dimensions:
+            continue
+        itemsize = v.dtype.itemsize if hasattr(v.dtype, 'itemsize') else 8
+        v.set_var_chunk_cache(*chunk_cache(layout, v.shape, chunks, itemsize))
+    return layout
+
+
+def create_padded_variables(nc, df, columns, index, dimensions, fill_value, attributes, coordinates, layout=None):
+    """ Creates a `dimensions` variable for each of the `columns` of `df`
+        and writes it in one call from a padded array (see
+        `pyaxiom.utils.padded_index`). `attributes` is updated with the
+        `coordinates` of each variable. Variables are chunked with the
+        ChunkLayout `layout` when there is one.
+    """
+    create_variable = nc.createVariable if layout is None else partial(layout.create_variable, nc)
+    shape = tuple( nc.dimensions[d].size for d in dimensions )
+    for c in columns:
+        var_name = cf_safe_name(c)
+        if np.issubdtype(df[c].dtype, 'S') or df[c].dtype == object:
+            # AttributeError: cannot set _FillValue attribute for VLEN or compound variable
+            v = create_variable(var_name, get_dtype(df[c]), dimensions)
+            # Use an empty string... better than nothing!
+            v[:] = padded_array(df[c].values, index, shape)
+        else:
+            v = create_variable(var_name, get_dtype(df[c]), dimensions, fill_value=df[c].dtype.type(fill_value))
+            v[:] = padded_array(df[c].values, index, shape, v._FillValue)
+
+        attributes[var_name] = dict_update(attributes.get(var_name, {}), {
+            'coordinates' : coordinates,
+        })
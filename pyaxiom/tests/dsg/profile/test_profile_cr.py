@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from pyaxiom.netcdf import CFDataset
+from pyaxiom.netcdf.sensors.dsg import ContiguousRaggedProfile, IncompleteMultidimensionalProfile
+
+import logging
+from pyaxiom import logger
+logger.level = logging.DEBUG
+logger.handlers = [logging.StreamHandler()]
+
+
+class TestContiguousRaggedProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.multi = os.path.join(os.path.dirname(__file__), 'resources', 'im-multiple.nc')
+        with IncompleteMultidimensionalProfile(self.multi) as ncd:
+            self.df = ncd.to_dataframe()
+
+    def test_crp_round_trip(self):
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with ContiguousRaggedProfile.from_dataframe(self.df, tmp) as ncd:
+            assert ncd.dimensions['obs'].size == len(self.df)
+            assert ncd.variables['rowSize'][:].sum() == len(self.df)
+            # The data variables have no attributes to identify them by
+            df = ncd.to_dataframe(clean_rows=False)
+            m = ncd.calculated_metadata(clean_rows=False)
+            data = { c: np.ma.filled(ncd.variables[c][:].astype(np.float64), np.nan) for c in ['humidity', 'wind_speed'] }
+
+        assert CFDataset.load(tmp).__class__ is ContiguousRaggedProfile
+        os.remove(tmp)
+
+        original = self.df.sort_values(['profile', 't'], kind='mergesort').reset_index(drop=True)
+        df = df.reset_index(drop=True)
+        assert df.profile.tolist() == original.profile.tolist()
+        assert np.allclose(df.z.values, original.z.values)
+        assert (df.t == original.t).all()
+        for c, values in data.items():
+            assert np.allclose(values, original[c].values, equal_nan=True)
+        assert len(m.profiles.keys()) == original.profile.unique().size
+
+    def test_crp_ragged_threshold(self):
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        # One deep profile and many shallow ones
+        df = self.df[(self.df.groupby('profile').cumcount() < 2) | (self.df.profile == self.df.profile.iloc[0])]
+        with IncompleteMultidimensionalProfile.from_dataframe(df, tmp, ragged_threshold=0.01) as ncd:
+            assert isinstance(ncd, ContiguousRaggedProfile)
+        with IncompleteMultidimensionalProfile.from_dataframe(df, tmp, ragged_threshold=1) as ncd:
+            assert isinstance(ncd, IncompleteMultidimensionalProfile)
+        os.remove(tmp)
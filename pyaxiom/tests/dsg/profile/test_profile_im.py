@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
+import tempfile
 import unittest
 
 from dateutil.parser import parse as dtparse
 import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from pyaxiom.netcdf.utils import apply_chunk_layout
 from pyaxiom.netcdf.sensors.dsg import IncompleteMultidimensionalProfile
 
 import logging
@@ -24,6 +28,101 @@ class TestIncompleteMultidimensionalProfile(unittest.TestCase):
         with IncompleteMultidimensionalProfile(self.multi) as ncd:
             ncd.to_dataframe()
 
+    def test_imp_from_dataframe(self):
+        df = pd.DataFrame({
+            'profile': [2, 1, 2, 2, 1],
+            't': [ dtparse('2000-01-0{} 00:00:00'.format(d)) for d in [2, 1, 2, 2, 1] ],
+            'x': [-72., -73., -72., -72., -73.],
+            'y': [34., 35., 34., 34., 35.],
+            'z': [0., 0., 1., np.nan, 1.],
+            'temperature': np.arange(5.),
+            'quality': ['good', 'bad', None, 'good', 'bad']
+        })
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        IncompleteMultidimensionalProfile.from_dataframe(df, tmp).close()
+        with nc4.Dataset(tmp) as ncd:
+            assert ncd.variables['profile'][:].tolist() == [1, 2]
+            assert ncd.variables['latitude'][:].tolist() == [35, 34]
+            assert ncd.variables['z'][0].compressed().tolist() == [0, 1]
+            assert ncd.variables['z'][1].compressed().tolist() == [0, 1]
+            assert ncd.variables['temperature'][:].filled(-1).tolist() == [[1, 4, -1], [0, 2, 3]]
+            assert ncd.variables['quality'][:].tolist() == [['bad', 'bad', ''], ['good', '', 'good']]
+        os.remove(tmp)
+
+    def test_imp_dataframe_projection(self):
+        with IncompleteMultidimensionalProfile(self.multi) as ncd:
+            df = ncd.to_dataframe(variables=['humidity'])
+            assert sorted(df.columns) == ['distance', 'humidity', 'profile', 't', 'x', 'y', 'z']
+
+            df = ncd.to_dataframe(variables=[{'standard_name': 'wind_speed'}], coordinates=['profile', 'z'])
+            assert sorted(df.columns) == ['profile', 'wind_speed', 'z']
+
+            df = ncd.to_dataframe(clean_rows=False, variables=[lambda v: v.name == 'humidity'], coordinates=[])
+            assert df.columns.tolist() == ['humidity']
+
+            full = ncd.to_dataframe(clean_rows=False)
+            assert np.allclose(df.humidity.values, full.humidity.values, equal_nan=True)
+
+            with self.assertRaises(ValueError):
+                ncd.to_dataframe(coordinates=['depth'])
+
+    def test_imp_dataframe_predicates(self):
+        with IncompleteMultidimensionalProfile(self.multi) as ncd:
+            full = ncd.to_dataframe(clean_rows=False)
+            df = ncd.to_dataframe(clean_rows=False, start='1990-01-02', end='1990-01-03', bbox=(50, 50, 150, 150), min_depth=2, max_depth=5)
+
+            expected = full[
+                (full.t >= '1990-01-02') & (full.t <= '1990-01-03') &
+                full.x.between(50, 150) & full.y.between(50, 150) &
+                full.z.between(2, 5)
+            ]
+            assert len(df) == len(expected) == 112
+            assert df.profile.tolist() == expected.profile.tolist()
+            assert np.allclose(df.humidity.values, expected.humidity.values, equal_nan=True)
+
+            assert ncd.to_dataframe(start='2000-01-01').empty
+
+            m = ncd.calculated_metadata(start='1990-01-02', end='1990-01-03')
+            assert m.min_t == dtparse('1990-01-02 01:00:00')
+            assert m.max_t == dtparse('1990-01-03 00:00:00')
+            assert len(m.profiles) == 24
+
+    def test_imp_iter_dataframes(self):
+        with IncompleteMultidimensionalProfile(self.multi) as ncd:
+            full = ncd.to_dataframe(clean_rows=False)
+            sizes = ncd.feature_sizes()
+            assert sizes.sum() == len(full)
+
+            features = list(ncd.iter_features(clean_rows=False))
+            assert len(features) == sizes.size == 142
+            assert all( f.profile.nunique() == 1 for f in features )
+
+            batches = list(ncd.iter_dataframes(max_rows=500, clean_rows=False, coordinates=['profile', 'z']))
+            assert all( len(b) <= 500 for b in batches )
+            df = pd.concat(batches)
+            assert df.profile.tolist() == full.profile.tolist()
+            assert np.allclose(df.humidity.values, full.humidity.values, equal_nan=True)
+
+            # Predicates apply to each batch
+            batches = list(ncd.iter_dataframes(max_rows=500, start='1990-01-02', end='1990-01-03'))
+            assert pd.concat(batches).profile.nunique() == 24
+
+    def test_imp_chunk_layout(self):
+        with IncompleteMultidimensionalProfile(self.multi) as ncd:
+            df = ncd.to_dataframe()
+
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with IncompleteMultidimensionalProfile.from_dataframe(df, tmp, layout='per-instance') as ncd:
+            assert ncd.chunk_layout == 'per-instance'
+            z = ncd.variables['z']
+            assert z.chunking() == [ z.shape[0], z.shape[1] ]
+            assert apply_chunk_layout(ncd) == 'per-instance'
+
+        with IncompleteMultidimensionalProfile.from_dataframe(df, tmp) as ncd:
+            assert 'chunk_layout' not in ncd.ncattrs()
+            assert apply_chunk_layout(ncd) is None
+        os.remove(tmp)
+
     def test_imp_calculated_metadata(self):
         with IncompleteMultidimensionalProfile(self.multi) as ncd:
             m = ncd.calculated_metadata()
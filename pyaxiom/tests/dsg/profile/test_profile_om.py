@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import tempfile
 
 import unittest
 from dateutil.parser import parse as dtparse
 import numpy as np
 
-from pyaxiom.netcdf.sensors.dsg import OrthogonalMultidimensionalProfile
+from pyaxiom.netcdf.sensors.dsg import OrthogonalMultidimensionalProfile, IncompleteMultidimensionalProfile
 
 import logging
 from pyaxiom import logger
@@ -30,6 +31,39 @@ class TestOrthogonalMultidimensionalProfile(unittest.TestCase):
         with OrthogonalMultidimensionalProfile(self.multi) as m:
             m.to_dataframe()
 
+    def test_omp_from_dataframe(self):
+        with OrthogonalMultidimensionalProfile(self.multi) as ncd:
+            df = ncd.to_dataframe(clean_rows=False)
+
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        attributes = {
+            'temperature': {
+                'units': 'degree_Celsius',
+                'standard_name': 'sea_water_temperature'
+            }
+        }
+        with OrthogonalMultidimensionalProfile.from_dataframe(df, tmp, attributes=attributes) as ncd:
+            assert isinstance(ncd, OrthogonalMultidimensionalProfile)
+            assert ncd.variables['z'].dimensions == ('z',)
+            assert ncd.variables['temperature'].shape == (35, 2064)
+            rdf = ncd.to_dataframe(clean_rows=False)
+
+        assert rdf.profile.tolist() == df.profile.tolist()
+        assert np.allclose(rdf.z.values, df.z.values)
+        assert (rdf.t == df.t).all()
+        assert np.allclose(rdf.temperature.values, df.temperature.values, equal_nan=True)
+
+        # Profiles with different z levels
+        with OrthogonalMultidimensionalProfile.from_dataframe(df.iloc[1:], tmp) as ncd:
+            assert isinstance(ncd, IncompleteMultidimensionalProfile)
+
+        # Same number of levels, but one of them repeated in a profile
+        two = df[df.profile.isin(df.profile.unique()[:2])].copy()
+        two.iloc[-1, two.columns.get_loc('z')] = two.z.iloc[-2]
+        with OrthogonalMultidimensionalProfile.from_dataframe(two, tmp) as ncd:
+            assert isinstance(ncd, IncompleteMultidimensionalProfile)
+        os.remove(tmp)
+
     def test_omp_calculated_metadata(self):
         with OrthogonalMultidimensionalProfile(self.single) as ncd:
             s = ncd.calculated_metadata()
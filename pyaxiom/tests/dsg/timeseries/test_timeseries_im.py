@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pyaxiom.netcdf.sensors.dsg import IncompleteMultidimensionalTimeseries
+
+import logging
+from pyaxiom import logger
+logger.level = logging.DEBUG
+logger.handlers = [logging.StreamHandler()]
+
+
+class TestIncompleteMultidimensionalTimeseries(unittest.TestCase):
+
+    def setUp(self):
+        self.multi = os.path.join(os.path.dirname(__file__), 'resources', 'im-multiple.nc')
+
+    def test_imt_load(self):
+        IncompleteMultidimensionalTimeseries(self.multi).close()
+
+    def test_imt_from_dataframe(self):
+        df = pd.DataFrame({
+            'station': [2, 1, 2, 2, 1],
+            't': [ datetime(2000, 1, 1, h) for h in [3, 5, 1, 2, 0] ],
+            'x': [-72., -73., -72., -72., -73.],
+            'y': [34., 35., 34., 34., 35.],
+            'z': 1.,
+            'temperature': np.arange(5.)
+        })
+
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with IncompleteMultidimensionalTimeseries.from_dataframe(df, tmp) as ncd:
+            assert IncompleteMultidimensionalTimeseries.is_mine(ncd)
+            assert ncd.dimensions['obs'].size == 3
+            assert (ncd.variables['station'][:] == [1, 2]).all()
+            temp = ncd.variables['temperature'][:]
+            assert (temp[0].compressed() == [4, 1]).all()
+            assert (temp[1] == [2, 3, 0]).all()
+            assert ncd.variables['time'][0].mask.tolist() == [False, False, True]
+        os.remove(tmp)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from pyaxiom.netcdf.sensors.dsg import OrthogonalMultidimensionalTimeseries, IncompleteMultidimensionalTimeseries
+
+import logging
+from pyaxiom import logger
+logger.level = logging.DEBUG
+logger.handlers = [logging.StreamHandler()]
+
+
+class TestOrthogonalMultidimensionalTimeseries(unittest.TestCase):
+
+    def setUp(self):
+        self.multi = os.path.join(os.path.dirname(__file__), 'resources', 'om-multiple.nc')
+        times = [ datetime(2000, 1, 1, h) for h in range(4) ]
+        self.df = pd.DataFrame({
+            'station': np.repeat(['b', 'a'], 4),
+            't': times[::-1] + times,
+            'x': np.repeat([-72., -73.], 4),
+            'y': np.repeat([34., 35.], 4),
+            'z': 0.,
+            'temperature': np.arange(8.),
+            'flag': list('abcdefgh')
+        })
+
+    def test_omt_load(self):
+        OrthogonalMultidimensionalTimeseries(self.multi).close()
+
+    def test_omt_from_dataframe(self):
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with OrthogonalMultidimensionalTimeseries.from_dataframe(self.df, tmp) as ncd:
+            assert OrthogonalMultidimensionalTimeseries.is_mine(ncd)
+            assert ncd.dimensions['station'].size == 2
+            assert ncd.dimensions['time'].size == 4
+            assert ncd.variables['station'][:].tolist() == ['a', 'b']
+            assert (ncd.variables['longitude'][:] == [-73, -72]).all()
+            # Station 'b' was in reverse time order
+            assert (ncd.variables['temperature'][:] == [[4, 5, 6, 7], [3, 2, 1, 0]]).all()
+            assert ncd.variables['flag'][1, 0] == 'd'
+            t = nc4.num2date(ncd.variables['time'][:], ncd.variables['time'].units)
+            assert t[0] == datetime(2000, 1, 1, 0)
+        os.remove(tmp)
+
+    def test_omt_from_dataframe_incomplete(self):
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        # Stations no longer share a time axis
+        df = self.df.iloc[1:]
+        with OrthogonalMultidimensionalTimeseries.from_dataframe(df, tmp) as ncd:
+            assert isinstance(ncd, IncompleteMultidimensionalTimeseries)
+        os.remove(tmp)
+
+    def test_omt_from_dataframe_missing_time(self):
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        df = self.df.copy()
+        df.loc[0, 't'] = pd.NaT
+        with OrthogonalMultidimensionalTimeseries.from_dataframe(df, tmp) as ncd:
+            assert isinstance(ncd, IncompleteMultidimensionalTimeseries)
+            time = ncd.variables['time']
+            # Written as a missing value, not as the epoch
+            assert np.ma.getmaskarray(time[:]).sum() == 1
+            assert 0 not in time[:].compressed().tolist()
+        os.remove(tmp)
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import os
+import tempfile
 
 import unittest
 from dateutil.parser import parse as dtparse
 import numpy as np
+import pandas as pd
 
+from pyaxiom.netcdf import CFDataset
 from pyaxiom.netcdf.sensors.dsg import ContiguousRaggedTrajectory
+from pyaxiom.netcdf.utils import chunk_cache
 
 import logging
 from pyaxiom import logger
@@ -16,13 +20,118 @@ logger.handlers = [logging.StreamHandler()]
 class TestContiguousRaggedTrajectory(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.multi = os.path.join(os.path.dirname(__file__), 'resources', 'cr-multiple.nc')
 
     def test_crt_load(self):
-        pass
+        ContiguousRaggedTrajectory(self.multi).close()
+        assert CFDataset.load(self.multi).__class__ is ContiguousRaggedTrajectory
 
     def test_crt_dataframe(self):
-        pass
+        with ContiguousRaggedTrajectory(self.multi) as ncd:
+            df = ncd.to_dataframe(clean_rows=False)
+            row_sizes = ncd.variables['rowSize'][:]
+
+        assert len(df) == 163
+        assert df.trajectory.unique().size == 6
+        assert df.groupby('trajectory', sort=False).size().tolist() == row_sizes.tolist()
+
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with ContiguousRaggedTrajectory.from_dataframe(df, tmp) as ncd:
+            assert ncd.dimensions['obs'].isunlimited()
+            assert ncd.variables['rowSize'][:].tolist() == row_sizes.tolist()
+            rdf = ncd.to_dataframe(clean_rows=False)
+        os.remove(tmp)
+
+        assert rdf.trajectory.tolist() == df.trajectory.tolist()
+        assert (rdf.t == df.t).all()
+        assert np.allclose(rdf.z.values, df.z.values)
+
+    def test_crt_from_chunks(self):
+        with ContiguousRaggedTrajectory(self.multi) as ncd:
+            df = ncd.to_dataframe(clean_rows=False)
+            row_sizes = ncd.variables['rowSize'][:]
+
+        # Chunks that split trajectories between them
+        chunks = [ df.iloc[i:i + 10] for i in range(0, len(df), 10) ]
+
+        tmp = tempfile.mkstemp(suffix='.nc')[-1]
+        with ContiguousRaggedTrajectory.from_chunks(chunks, tmp) as ncd:
+            assert ncd.dimensions['obs'].size == len(df)
+            assert ncd.variables['rowSize'][:].tolist() == row_sizes.tolist()
+            rdf = ncd.to_dataframe(clean_rows=False)
+
+        # Append one more trajectory to the existing file
+        with ContiguousRaggedTrajectory(tmp, 'a') as ncd:
+            extra = df[df.trajectory == df.trajectory.iloc[0]].copy()
+            extra['trajectory'] = 'Extra'
+            ncd.append_dataframe(extra)
+            assert ncd.variables['rowSize'][-1] == len(extra)
+            assert ncd.dimensions['obs'].size == len(df) + len(extra)
+
+            # A trajectory that is already in the file, after rows that
+            # continue the last one
+            with self.assertRaises(ValueError):
+                ncd.append_dataframe(pd.concat([extra.iloc[0:1], df.iloc[0:1]]))
+            # Nothing was written
+            assert ncd.variables['rowSize'][-1] == len(extra)
+            assert ncd.dimensions['obs'].size == len(df) + len(extra)
+
+            # A column that isn't a variable in the file
+            more = extra.copy()
+            more['trajectory'] = 'More'
+            more['sal'] = 35.0
+            with self.assertRaises(ValueError):
+                ncd.append_dataframe(more)
+            assert ncd.variables['rowSize'][-1] == len(extra)
+            assert ncd.variables['trajectory'][-1] == 'Extra'
+            assert ncd.dimensions['obs'].size == len(df) + len(extra)
+        os.remove(tmp)
+
+        assert rdf.trajectory.tolist() == df.trajectory.tolist()
+        assert np.allclose(rdf.x.values, df.x.values)
+
+        # The chunks aren't limited to the size of the first DataFrame and
+        # readers get the chunk cache of the layout
+        with ContiguousRaggedTrajectory.from_chunks(chunks, tmp, layout='per-variable-scan') as ncd:
+            z = ncd.variables['z']
+            assert z.chunking()[0] > len(chunks[0])
+            assert list(z.get_var_chunk_cache()) == list(chunk_cache('per-variable-scan', z.shape, z.chunking(), z.dtype.itemsize))
+        os.remove(tmp)
+
+    def test_crt_dataframe_predicates(self):
+        with ContiguousRaggedTrajectory(self.multi) as ncd:
+            full = ncd.to_dataframe(clean_rows=False)
+            df = ncd.to_dataframe(clean_rows=False, start='1990-01-01 08:00', end='1990-01-01 16:00', min_depth=full.z.median())
+
+        expected = full[
+            (full.t >= '1990-01-01 08:00') & (full.t <= '1990-01-01 16:00') &
+            (full.z >= full.z.median())
+        ]
+        assert len(df) == len(expected)
+        assert df.trajectory.tolist() == expected.trajectory.tolist()
+        assert (abs(df.t.values - expected.t.values) < np.timedelta64(1, 's')).all()
+        assert df.distance.iloc[0] == 0
+
+    def test_crt_iter_features(self):
+        with ContiguousRaggedTrajectory(self.multi) as ncd:
+            row_sizes = ncd.variables['rowSize'][:]
+            assert ncd.feature_sizes().tolist() == row_sizes.tolist()
+
+            features = list(ncd.iter_features(clean_rows=False))
+            assert [ len(f) for f in features ] == row_sizes.tolist()
+            assert [ f.trajectory.nunique() for f in features ] == [1] * row_sizes.size
+
+            # The count and depth variables are only read by the first feature
+            cache = {}
+            full = ncd.to_dataframe(clean_rows=False, min_depth=0, cache=cache)
+            assert sorted(cache) == [('coordinate_mask', 'time', 'lon', 'lat'), ('values', 'rowSize'), ('values', 'z')]
+            cache[('values', 'z')] = np.ma.masked_all(ncd.variables['z'].shape)
+            assert ncd.to_dataframe(clean_rows=False, min_depth=0, cache=cache).empty
+            features = list(ncd.iter_features(clean_rows=False, min_depth=0))
+            assert sum( len(f) for f in features ) == len(full)
 
     def test_crt_calculated_metadata(self):
-        pass
+        with ContiguousRaggedTrajectory(self.multi) as ncd:
+            m = ncd.calculated_metadata()
+            assert m.min_t == dtparse('1990-01-01 00:00:00')
+            assert len(m.trajectories) == 6
@@ -37,6 +37,17 @@ class TestContinousRaggedTrajectoryProfile(unittest.TestCase):
         with ContiguousRaggedTrajectoryProfile(self.missing_time) as t:
             t.to_dataframe()
 
+    def test_crtp_dataframe_rows(self):
+        with ContiguousRaggedTrajectoryProfile(self.multi) as m:
+            df = m.to_dataframe(clean_rows=False)
+            row_sizes = m.get_variables_by_attributes(sample_dimension=lambda x: x is not None)[0][:]
+            times = m.t_axes()[0][:]
+
+        # Every element of a profile has the profile's values
+        assert df.groupby('profile', sort=False).size().tolist() == row_sizes.tolist()
+        assert (df.groupby('profile', sort=False).t.nunique() == 1).all()
+        assert df.t.drop_duplicates().size == np.unique(times).size
+
     def test_crtp_calculated_metadata(self):
         with ContiguousRaggedTrajectoryProfile(self.single) as st:
             s = st.calculated_metadata()
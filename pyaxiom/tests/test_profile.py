@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import netCDF4
+
+from pyaxiom.netcdf.sensors import IncompleteProfile
+
+import logging
+from pyaxiom import logger
+logger.level = logging.INFO
+logger.handlers = [logging.StreamHandler()]
+
+
+class TestIncompleteProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'profile')
+        self.df = pd.DataFrame({
+            'profile': [2, 1, 2, 2, 1],
+            'time': [ datetime(2000, 1, d) for d in [2, 1, 2, 2, 1] ],
+            'latitude': [34., 35., 34., 34., 35.],
+            'longitude': [-72., -73., -72., -72., -73.],
+            'z': [0., 0., 1., 2., 1.],
+            'Temperature (C)': [10., 20., 11., np.nan, 21.],
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_export(self):
+        output_file = os.path.join(self.output_directory, 'incomplete.nc')
+        IncompleteProfile(self.df).export(output_file, chunk_per_profile=True)
+
+        with netCDF4.Dataset(output_file) as nc:
+            assert nc.dimensions['z'].size == 3
+            assert nc.variables['latitude'][:].tolist() == [35, 34]
+            assert nc.variables['time'][:].tolist() == [946684800, 946771200]
+            assert nc.variables['z'][:].filled(-1).tolist() == [[0, 1, -1], [0, 1, 2]]
+            temperature = nc.variables['temperature']
+            assert temperature.chunking() == [1, 3]
+            assert temperature[:].filled(-1).tolist() == [[20, 21, -1], [10, 11, -1]]
+
+    def test_global_attributes_cached(self):
+        p = IncompleteProfile(self.df, global_attributes=dict(title='casts'))
+        gas = p.global_attributes
+        assert gas['title'] == 'casts'
+        assert gas['time_coverage_start'] == '2000-01-01T00:00:00Z'
+        assert gas['time_coverage_duration'] == 'P86400S'
+        assert gas['geospatial_lat_max'] == 35
+        # Only one unique difference between times
+        assert 'time_coverage_resolution' not in gas
+        # Calculated attributes aren't stored with the user's attributes
+        assert 'time_coverage_start' not in p._global_attributes
+        assert p.statistics is p.statistics
+
+        df = self.df.copy()
+        df['time'] = [ datetime(2000, 1, 1, h) for h in [0, 1, 2, 4, 5] ]
+        p.df = df
+        gas = p.global_attributes
+        assert gas['time_coverage_end'] == '2000-01-01T05:00:00Z'
+        assert gas['time_coverage_resolution'] == 'P3600S'
+
+    def test_global_attributes_missing_time(self):
+        df = self.df.copy()
+        df['time'] = [ datetime(2000, 1, 2), None, datetime(2000, 1, 2), datetime(2000, 1, 3), datetime(2000, 1, 1) ]
+        gas = IncompleteProfile(df).global_attributes
+        assert gas['time_coverage_start'] == '2000-01-01T00:00:00Z'
+        assert gas['time_coverage_end'] == '2000-01-03T00:00:00Z'
+        assert gas['time_coverage_duration'] == 'P172800S'
+
+        df['time'] = pd.NaT
+        gas = IncompleteProfile(df).global_attributes
+        assert 'time_coverage_start' not in gas
+        assert gas['geospatial_lat_max'] == 35
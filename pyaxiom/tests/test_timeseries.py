@@ -6,13 +6,15 @@ import shutil
 import unittest
 from copy import copy
 from datetime import timedelta, datetime
+from dateutil.relativedelta import relativedelta
 
 import numpy as np
 import pandas as pd
 import netCDF4
 
 from pyaxiom.netcdf import EnhancedDataset
-from pyaxiom.netcdf.sensors import TimeSeries, get_dataframe_from_variable
+from pyaxiom.netcdf.sensors import TimeSeries, get_dataframe_from_variable, get_dataframe_from_variables
+from pyaxiom.netcdf.sensors.timeseries import plan_layout, StoragePolicy
 
 import logging
 from pyaxiom import logger
@@ -320,6 +322,37 @@ class TestTimeSeries(unittest.TestCase):
         assert nc.variables.get('temperature').size == len(times) * len(verticals)
         assert (nc.variables.get('temperature')[:] == np.repeat([20, 21, 22, 23, 24, 25], len(verticals)).reshape((len(times), len(verticals)))).all()
 
+    def test_timeseries_profile_match_summary(self):
+        filename = 'test_timeseries_profile_match_summary.nc'
+        times = [0, 1000, 2000]
+        verticals = [0, 1]
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=self.latitude,
+                        longitude=self.longitude,
+                        station_name=self.station_name,
+                        global_attributes=self.global_attributes,
+                        output_filename=filename,
+                        times=times,
+                        verticals=verticals)
+
+        # One value past the last time, one past the last vertical, one
+        # between two times, one between two verticals and one duplicate cell
+        values = [10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
+        values_times = [0, 0, 1000, 1000, 2000, 2000, 3000, 2000, 2000, 500, 1000]
+        values_verticals = [0, 1, 0, 1, 0, 1, 0, 5, 1, 0, 0.5]
+        attrs = dict(standard_name='sea_water_temperature')
+        ts.add_variable('temperature', values=values, attributes=attrs, times=values_times, verticals=values_verticals)
+
+        summary = ts.match_summaries['temperature']
+        assert summary.matched == 6
+        assert summary.out_of_range == 4
+        assert summary.duplicates == 1
+
+        nc = netCDF4.Dataset(os.path.join(self.output_directory, filename))
+        # The last duplicate value wins
+        assert (nc.variables.get('temperature')[:] == np.asarray([[10, 11], [12, 13], [14, 18]])).all()
+        nc.close()
+
     def test_timeseries_profile_duplicate_heights(self):
         filename = 'test_timeseries_profile_duplicate_heights.nc'
         times = [0, 1000, 2000, 3000, 4000, 5000]
@@ -552,6 +585,60 @@ class TestTimeSeries(unittest.TestCase):
         assert (nc.variables.get('salinity')[:] == values.reshape((len(times), len(verticals)))).all()
         assert nc.variables.get('dissolved_oxygen')[:].mask.all()
 
+    def test_timeseries_add_variables(self):
+        filename = 'test_timeseries_add_variables.nc'
+        times = [0, 1000, 2000, 3000, 4000, 5000]
+        verticals = [0, 1, 2]
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=self.latitude,
+                        longitude=self.longitude,
+                        station_name=self.station_name,
+                        global_attributes=self.global_attributes,
+                        output_filename=filename,
+                        times=times,
+                        verticals=verticals)
+
+        values = np.repeat([20, 21, 22, 23, 24, 25], len(verticals))
+        bottom_values = [30, 31, 32, 33, 34, 35]
+        attrs = dict(standard_name='sea_water_temperature')
+        created = ts.add_variables([
+            dict(variable_name='temperature', values=values, attributes=attrs),
+            dict(variable_name='salinity', values=values.reshape((len(times), len(verticals)))),
+            dict(variable_name='bottom_temperature', values=bottom_values, verticals=[60], unlink_from_profile=True, attributes=attrs),
+        ])
+        assert [ v.name for v in created ] == ['temperature', 'salinity', 'bottom_temperature']
+
+        nc = netCDF4.Dataset(os.path.join(self.output_directory, filename))
+        assert (nc.variables.get('temperature')[:] == values.reshape((len(times), len(verticals)))).all()
+        assert (nc.variables.get('salinity')[:] == values.reshape((len(times), len(verticals)))).all()
+        assert (nc.variables.get('bottom_temperature')[:] == np.asarray(bottom_values)).all()
+        assert nc.variables.get('sensor_depth')[:] == 60
+        nc.close()
+
+    def test_timeseries_batch_defers_writes(self):
+        filename = 'test_timeseries_batch_defers_writes.nc'
+        times = [0, 1000, 2000]
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=self.latitude,
+                        longitude=self.longitude,
+                        station_name=self.station_name,
+                        global_attributes=self.global_attributes,
+                        output_filename=filename,
+                        times=times)
+
+        with ts.batch():
+            var = ts.add_variable('temperature', values=[20, 21, 22])
+            ts.add_instrument_variable('temperature')
+            assert var[:].mask.all()
+        assert (var[:] == [20, 21, 22]).all()
+        assert ts.ncd.variables['temperature'].instrument == 'temperature_instrument'
+
+        # Held data is written once it grows past batch_bytes
+        ts.batch_bytes = 1
+        with ts.batch():
+            var = ts.add_variable('salinity', values=[30, 31, 32])
+            assert (var[:] == [30, 31, 32]).all()
+
     def test_extracting_dataframe_all_masked_heights(self):
         filename = 'test_extracting_dataframe_all_masked_heights.nc'
         times = [0, 1000, 2000, 3000, 4000, 5000]
@@ -906,6 +993,334 @@ class TestTimeseriesTimeBounds(unittest.TestCase):
                                                                 ])).all()
         nc.close()
 
+    def test_time_bounds_calendar_months(self):
+        filename = 'test_timeseries_bounds_months.nc'
+        times = [ (datetime(2016, m, 1) - datetime(1970, 1, 1)).total_seconds() for m in [1, 2, 3] ]
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=self.latitude,
+                        longitude=self.longitude,
+                        station_name=self.station_name,
+                        global_attributes=self.global_attributes,
+                        output_filename=filename,
+                        times=times)
+        ts.add_time_bounds(delta=relativedelta(months=1), position='start')
+        ts.ncd.close()
+
+        with netCDF4.Dataset(os.path.join(self.output_directory, filename)) as nc:
+            bounds = nc.variables.get('time_bounds')[:]
+            # January, a leap year February and March
+            assert ((bounds[:, 1] - bounds[:, 0]) / 86400 == [31, 29, 31]).all()
+        os.remove(os.path.join(self.output_directory, filename))
+
+
+class TestTimeseriesAppend(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output")
+        self.global_attributes = dict(id='this.is.the.id')
+
+        self.filename = 'test_timeseries_append.nc'
+        self.path = os.path.join(self.output_directory, self.filename)
+        self.times = [0, 1000, 2000]
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=34,
+                        longitude=-72,
+                        station_name="PytoolsTestStation",
+                        global_attributes=self.global_attributes,
+                        output_filename=self.filename,
+                        times=self.times,
+                        verticals=[0, 1],
+                        unlimited_time=True)
+        attrs = dict(standard_name='sea_water_temperature')
+        ts.add_variable('temperature', values=[20, 20, 21, 21, 22, 22], attributes=attrs)
+        ts.add_variable('salinity', values=[30, 30, 31, 31, 32, 32])
+        ts.ncd.close()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_append_after_end(self):
+        ts = TimeSeries.load(self.path)
+        added = ts.append([4000, 3000], dict(temperature=[[24, 24], [23, 23]]))
+        ts.ncd.close()
+        assert added == 2
+
+        with netCDF4.Dataset(self.path) as nc:
+            assert (nc.variables['time'][:] == [0, 1000, 2000, 3000, 4000]).all()
+            assert (nc.variables['temperature'][:, 0] == [20, 21, 22, 23, 24]).all()
+            assert nc.variables['salinity'][3:].mask.all()
+            assert nc.time_coverage_end == '1970-01-01T01:06:40'
+            assert nc.time_coverage_duration == 'PT4000S'
+
+    def test_append_overlap_error(self):
+        ts = TimeSeries.load(self.path)
+        with self.assertRaises(ValueError):
+            ts.append([2000, 3000], dict(temperature=[[0, 0], [23, 23]]))
+        ts.ncd.close()
+
+        with netCDF4.Dataset(self.path) as nc:
+            assert nc.variables['time'].size == 3
+
+    def test_append_overlap_replace(self):
+        ts = TimeSeries.load(self.path)
+        added = ts.append([500, 2000, 3000], dict(temperature=[[5, 5], [0, 0], [23, 23]]), overlap='replace')
+        ts.ncd.close()
+        assert added == 2
+
+        with netCDF4.Dataset(self.path) as nc:
+            assert (nc.variables['time'][:] == [0, 500, 1000, 2000, 3000]).all()
+            assert (nc.variables['temperature'][:, 1] == [20, 5, 21, 0, 23]).all()
+            # Stored rows that moved keep their values
+            assert (nc.variables['salinity'][:, 0].compressed() == [30, 31, 32]).all()
+
+    def test_append_overlap_skip(self):
+        ts = TimeSeries.load(self.path)
+        ts.append([2000, 3000], dict(temperature=[[0, 0], [23, 23]]), overlap='skip')
+        ts.ncd.close()
+
+        with netCDF4.Dataset(self.path) as nc:
+            assert (nc.variables['temperature'][:, 0] == [20, 21, 22, 23]).all()
+
+    def test_append_fixed_time(self):
+        filename = 'test_timeseries_append_fixed.nc'
+        ts = TimeSeries(output_directory=self.output_directory,
+                        latitude=34,
+                        longitude=-72,
+                        station_name="PytoolsTestStation",
+                        global_attributes=self.global_attributes,
+                        output_filename=filename,
+                        times=self.times)
+        ts.add_variable('temperature', values=[20, 21, 22])
+        with self.assertRaises(ValueError):
+            ts.append([3000], dict(temperature=[23]))
+        ts.ncd.close()
+        os.remove(os.path.join(self.output_directory, filename))
+
+
+class TestTimeseriesVariableObject(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'objects')
+        os.makedirs(self.output_directory)
+        self.source_path = os.path.join(self.output_directory, 'source.nc')
+        with netCDF4.Dataset(self.source_path, 'w') as nc:
+            nc.createDimension('time', 100)
+            nc.createDimension('bin', 7)
+            nc.createDimension('one', 1)
+            velocity = nc.createVariable('velocity', 'f8', ('time', 'bin'), chunksizes=(10, 7))
+            velocity.units = 'm/s'
+            velocity[:] = np.arange(700.).reshape(100, 7)
+            heading = nc.createVariable('heading', 'f4', ('one', 'time'))
+            heading[:] = np.arange(100.).reshape(1, 100)
+
+        self.ts = TimeSeries(output_directory=self.output_directory,
+                             latitude=34,
+                             longitude=-72,
+                             station_name="PytoolsTestStation",
+                             global_attributes=dict(id='this.is.the.id'),
+                             output_filename='test_variable_object.nc',
+                             times=np.arange(100) * 60)
+
+    def tearDown(self):
+        self.ts.ncd.close()
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_copy_in_blocks(self):
+        with netCDF4.Dataset(self.source_path) as source:
+            # Smaller than one chunk, so each block is one chunk of rows
+            self.ts.add_variable_object([source.variables['velocity'], source.variables['heading']], reduce_dims=True, block_bytes=100)
+            assert (self.ts.ncd.variables['velocity'][:] == source.variables['velocity'][:]).all()
+            assert self.ts.ncd.variables['velocity'].units == 'm/s'
+            assert self.ts.ncd.variables['heading'].dimensions == ('time',)
+            assert (self.ts.ncd.variables['heading'][:] == np.arange(100.)).all()
+
+    def test_copy_in_batch(self):
+        with netCDF4.Dataset(self.source_path) as source:
+            # The blocks are written as they are copied, not held by the batch
+            with self.ts.batch():
+                self.ts.add_variable_object(source.variables['velocity'], block_bytes=100)
+                assert (self.ts.ncd.variables['velocity'][:] == source.variables['velocity'][:]).all()
+
+
+class TestTimeseriesFromChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'chunks')
+        self.kwargs = dict(output_directory=self.output_directory,
+                           latitude=34,
+                           longitude=-72,
+                           station_name="PytoolsTestStation",
+                           global_attributes=dict(id='this.is.the.id'),
+                           variable_name='temperature',
+                           variable_attributes=dict(standard_name='sea_water_temperature'))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def frame(self, times, verticals):
+        times = np.repeat(times, len(verticals))
+        return pd.DataFrame({
+            'time': [ datetime.utcfromtimestamp(x) for x in times ],
+            'depth': np.tile(verticals, len(times) // len(verticals)),
+            'value': np.arange(times.size, dtype=np.float64)
+        })
+
+    def assert_same(self, df, chunks):
+        TimeSeries.from_dataframe(df, output_filename='whole.nc', **self.kwargs).ncd.close()
+        ts = TimeSeries.from_chunks(chunks, output_filename='chunked.nc', **self.kwargs)
+        ts.ncd.close()
+
+        with netCDF4.Dataset(os.path.join(self.output_directory, 'whole.nc')) as whole, \
+                netCDF4.Dataset(os.path.join(self.output_directory, 'chunked.nc')) as chunked:
+            for v in ['time', 'z', 'temperature']:
+                assert (whole.variables[v][:] == chunked.variables[v][:]).all()
+            for a in ['time_coverage_start', 'time_coverage_end', 'time_coverage_duration', 'time_coverage_resolution']:
+                assert getattr(whole, a, None) == getattr(chunked, a, None)
+        return ts
+
+    def test_from_chunks_single_level(self):
+        # Irregular spacing so the resolution is written
+        df = self.frame(np.cumsum(np.tile([60, 60, 120], 33)), [2])
+        self.assert_same(df, [ df.iloc[i:i + 7] for i in range(0, len(df), 7) ])
+
+    def test_from_chunks_profile_split_across_chunks(self):
+        df = self.frame(np.arange(0, 20) * 60, [1, 2, 3])
+        # Chunk edges fall inside profiles
+        ts = self.assert_same(df, [ df.iloc[i:i + 5] for i in range(0, len(df), 5) ])
+        assert ts.match_summaries['temperature'].matched == len(df)
+
+    def test_from_chunks_off_grid_depth(self):
+        df = self.frame(np.arange(0, 10) * 60, [1, 2, 3])
+        # Between two of the levels found in the first chunk
+        df.loc[20, 'depth'] = 1.5
+        ts = TimeSeries.from_chunks([df.iloc[:15], df.iloc[15:]], output_filename='offgrid.nc', **self.kwargs)
+        ts.ncd.close()
+
+        summary = ts.match_summaries['temperature']
+        assert summary.matched == len(df) - 1
+        assert summary.out_of_range == 1
+        assert summary.duplicates == 0
+
+        with netCDF4.Dataset(os.path.join(self.output_directory, 'offgrid.nc')) as nc:
+            temperature = nc.variables['temperature'][:]
+            # The level 2 value of that time is not overwritten
+            assert temperature[6, 1] == 19
+            assert temperature[6, 2] is np.ma.masked
+
+    def test_from_chunks_tuples(self):
+        times = np.arange(0, 10) * 60
+        chunks = [ (times[:5], np.zeros(5), np.arange(5.)), (times[5:], np.zeros(5), np.arange(5., 10.)) ]
+        ts = TimeSeries.from_chunks(chunks, output_filename='tuples.nc', **self.kwargs)
+        ts.ncd.close()
+        with netCDF4.Dataset(os.path.join(self.output_directory, 'tuples.nc')) as nc:
+            assert (nc.variables['time'][:] == times).all()
+            assert (nc.variables['temperature'][:] == np.arange(10.)).all()
+
+    def test_from_chunks_out_of_order(self):
+        df = self.frame(np.arange(0, 10) * 60, [2])
+        with self.assertRaises(ValueError):
+            TimeSeries.from_chunks([df.iloc[5:], df.iloc[:5]], output_filename='bad.nc', **self.kwargs)
+
+
+class TestTimeseriesFromStations(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'stations')
+        times = np.arange(0, 10) * 60
+        frames = []
+        for i, station in enumerate(['a', 'b', 'c']):
+            frames.append(pd.DataFrame({
+                'station': station,
+                'time': [ datetime.utcfromtimestamp(x) for x in times ],
+                'depth': 0,
+                'value': np.arange(10.) + i
+            }))
+        self.df = pd.concat(frames, ignore_index=True)
+        self.stations = {
+            s: dict(latitude=34, longitude=-72 + i, station_name='station_{}'.format(s), global_attributes=dict(id=s))
+            for i, s in enumerate(['a', 'b'])
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_from_stations_dataframe(self):
+        for workers in [1, 2]:
+            results = TimeSeries.from_stations_dataframe(self.df,
+                                                         self.stations,
+                                                         output_directory=self.output_directory,
+                                                         variable_name='temperature',
+                                                         variable_attributes=dict(standard_name='sea_water_temperature'),
+                                                         workers=workers)
+            assert sorted(results.keys()) == ['a', 'b', 'c']
+            # No metadata for 'c', which doesn't stop the others
+            assert results['c'].path is None
+            assert 'c' in results['c'].error
+
+            for i, s in enumerate(['a', 'b']):
+                assert results[s].error is None
+                with netCDF4.Dataset(results[s].path) as nc:
+                    assert nc.variables['longitude'][:] == -72 + i
+                    assert (nc.variables['temperature'][:] == np.arange(10.) + i).all()
+
+
+class TestTimeseriesStoragePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'storage')
+        self.times = np.arange(0, 5000) * 60
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def timeseries(self, storage_policy, verticals=None):
+        return TimeSeries(output_directory=self.output_directory,
+                          latitude=34,
+                          longitude=-72,
+                          station_name="PytoolsTestStation",
+                          global_attributes=dict(id='this.is.the.id'),
+                          output_filename='test_storage_policy.nc',
+                          times=self.times,
+                          verticals=verticals,
+                          storage_policy=storage_policy)
+
+    def test_default_policy(self):
+        ts = self.timeseries(None)
+        ts.add_variable('temperature', values=np.random.rand(self.times.size))
+        var = ts.ncd.variables['temperature']
+        assert var.chunking() == [1000]
+        assert var.filters()['zlib'] is True
+        assert 'Storage policy' not in ts.ncd.history
+        ts.ncd.close()
+
+    def test_archive_policy(self):
+        ts = self.timeseries('archive', verticals=[0, 1, 2])
+        ts.add_variable('temperature', values=np.random.rand(self.times.size, 3))
+        var = ts.ncd.variables['temperature']
+        # The whole series fits in one chunk
+        assert var.chunking() == [self.times.size, 3]
+        assert var.filters()['complevel'] == 9
+        assert var.filters()['shuffle'] is True
+        assert "Storage policy 'archive'" in ts.ncd.history
+        ts.ncd.close()
+
+    def test_custom_policy(self):
+        policy = StoragePolicy('quantized', chunk_bytes=8 * 100, zlib=False, least_significant_digit={'temperature': 1})
+        ts = self.timeseries(policy)
+        ts.add_variable('temperature', values=np.arange(self.times.size) + 0.123456)
+        ts.add_variable('salinity', values=np.arange(self.times.size) + 0.123456)
+        temperature = ts.ncd.variables['temperature']
+        assert temperature.chunking() == [100]
+        assert temperature.filters()['zlib'] is False
+        assert not np.isclose(temperature[0], 0.123456)
+        assert np.isclose(temperature[0], 0.123456, atol=0.1)
+        assert np.isclose(ts.ncd.variables['salinity'][0], 0.123456)
+        ts.ncd.close()
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.timeseries('fastest')
+
 
 class TestDataFrameFromVariable(unittest.TestCase):
     def test_sensor_with_depths(self):
@@ -933,6 +1348,107 @@ class TestDataFrameFromVariable(unittest.TestCase):
 
         assert np.allclose(df1.depth.unique(), np.asarray([-0.0508, -0.2032, -0.508]))
 
+    def test_time_and_depth_window(self):
+        ncfile1 = os.path.join(os.path.dirname(__file__), 'resources', 'sensor_with_depths_3.nc')
+        with EnhancedDataset(ncfile1) as ncd1:
+            ncvar1 = ncd1.variables['soil_moisture_percent']
+            full = get_dataframe_from_variable(ncd1, ncvar1)
+            start = full.time.iloc[30]
+            end = full.time.iloc[90]
+
+            df1 = get_dataframe_from_variable(ncd1, ncvar1, start=start, end=end, min_depth=-0.3, max_depth=-0.1)
+            expected = full[(full.time >= start) & (full.time <= end) & (full.depth >= -0.3) & (full.depth <= -0.1)]
+            assert not df1.empty
+            assert df1.time.min() == start
+            assert df1.time.max() == end
+            assert np.allclose(df1.depth.unique(), [-0.2032])
+            assert np.allclose(df1.value.values, expected.value.values)
+
+            # Nothing inside of the window
+            assert get_dataframe_from_variable(ncd1, ncvar1, start=end, end=start).empty
+            assert get_dataframe_from_variable(ncd1, ncvar1, min_depth=10).empty
+
+
+class TestDataFrameFromVariables(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = os.path.join(os.path.dirname(__file__), "output", 'variables')
+        times = [0, 1000, 2000, 3000, 4000, 5000]
+        verticals = [6, 7, 8]
+        self.ts = TimeSeries(output_directory=self.output_directory,
+                             latitude=34,
+                             longitude=-72,
+                             station_name="PytoolsTestStation",
+                             global_attributes=dict(id='this.is.the.id'),
+                             output_filename='test_variables.nc',
+                             times=times,
+                             verticals=verticals)
+        values = np.repeat([20, 21, 22, 23, 24, 25], len(verticals))
+        attrs = dict(standard_name='sea_water_temperature')
+        self.ts.add_variable('temperature', values=values, attributes=attrs)
+        self.ts.add_variable('salinity', values=values + 10)
+        self.ts.add_variable('bottom_temperature', values=[30, 31, 32, 33, 34, 35], verticals=[60], unlink_from_profile=True, attributes=attrs)
+
+    def tearDown(self):
+        self.ts.ncd.close()
+        shutil.rmtree(self.output_directory, ignore_errors=True)
+
+    def test_wide_frame(self):
+        nc = self.ts.ncd
+        df = get_dataframe_from_variables(nc, ['temperature', 'salinity'], start=datetime(1970, 1, 1, 0, 16, 40), min_depth=7)
+        assert df.columns.tolist() == ['time', 'depth', 'temperature', 'salinity']
+        single = get_dataframe_from_variable(nc, nc.variables['salinity'], start=datetime(1970, 1, 1, 0, 16, 40), min_depth=7)
+        assert (df.index == single.index).all()
+        assert (df.salinity.values == single.value.values).all()
+        assert (df.salinity - df.temperature == 10).all()
+
+    def test_grouped_frames(self):
+        frames = get_dataframe_from_variables(self.ts.ncd)
+        assert list(frames.keys()) == [(('time', 'z'), 'z'), (('time',), None)]
+        assert frames[(('time', 'z'), 'z')].columns.tolist() == ['time', 'depth', 'temperature', 'salinity']
+        bottom = frames[(('time',), None)]
+        assert bottom.bottom_temperature.tolist() == [30, 31, 32, 33, 34, 35]
+        assert bottom.depth.isnull().all()
+
+    def test_skips_time_bounds(self):
+        self.ts.add_time_bounds(delta=timedelta(seconds=1000), position='start')
+        assert self.ts.ncd.variables['time'].bounds == 'time_bounds'
+        frames = get_dataframe_from_variables(self.ts.ncd)
+        assert list(frames.keys()) == [(('time', 'z'), 'z'), (('time',), None)]
+
+        # Files written without a bounds attribute
+        del self.ts.ncd.variables['time'].bounds
+        frames = get_dataframe_from_variables(self.ts.ncd)
+        assert list(frames.keys()) == [(('time', 'z'), 'z'), (('time',), None)]
+
+
+class TestPlanLayout(unittest.TestCase):
+
+    def test_single_vertical(self):
+        plan = plan_layout([2000, 0, 1000, 1000], [5, 5, 5, 5])
+        assert plan.layout == 'orthogonal'
+        assert plan.order is None
+        assert plan.times.size == 4
+
+    def test_unsorted_grid(self):
+        times = np.asarray([1000, 0, 0, 1000])
+        verticals = np.asarray([1, 1, 0, 0])
+        plan = plan_layout(times, verticals)
+        assert plan.layout == 'unique-time'
+        assert (plan.times == [0, 1000]).all()
+        assert (plan.verticals == [0, 1]).all()
+        assert (times[plan.order] == [0, 0, 1000, 1000]).all()
+        assert (verticals[plan.order] == [0, 1, 0, 1]).all()
+
+    def test_incomplete_grid(self):
+        plan = plan_layout([0, 0, 1000], [0, 1, 0])
+        assert plan.layout == 'scatter'
+        assert plan.attempt == 5
+
+    def test_duplicate_cells(self):
+        plan = plan_layout([0, 0, 1000, 1000], [0, 0, 0, 1])
+        assert plan.layout == 'scatter'
+
 
 class TestFromDataframeAttempts(unittest.TestCase):
 
@@ -1049,6 +1565,30 @@ class TestFromDataframeAttempts(unittest.TestCase):
             attempts=5
         )
 
+    def test_attempts_layout(self):
+        filename = 'test_attempts_layout.nc'
+
+        ts = TimeSeries.from_dataframe(
+            self.df,
+            output_directory=self.output_directory,
+            output_filename=filename,
+            latitude=self.latitude,
+            longitude=self.longitude,
+            station_name=self.station_name,
+            global_attributes=self.global_attributes,
+            variable_name=self.vname,
+            variable_attributes=self.vatts
+        )
+        assert ts.layout.layout == 'scatter'
+        assert ts.match_summaries[self.vname].matched == 8
+
+        nc = netCDF4.Dataset(os.path.join(self.output_directory, filename))
+        # Duplicate times are collapsed into a unique time axis
+        assert nc.variables.get('time').size == 7
+        assert nc.variables.get('z').size == 7
+        assert nc.variables.get('temperature')[:].count() == 8
+        nc.close()
+
     def test_attempts_empty(self):
         filename = 'test_attempts_empty.nc'
 
@@ -5,9 +5,11 @@ import tempfile
 
 import pytest
 import numpy as np
+import pandas as pd
+import netCDF4 as nc4
 
 from pyaxiom.netcdf.dataset import EnhancedDataset
-from pyaxiom.utils import generic_masked, get_dtype
+from pyaxiom.utils import generic_masked, get_dtype, encode_times, decode_times, padded_index, padded_array
 
 import logging
 from pyaxiom import logger
@@ -33,6 +35,106 @@ def test_int64_dtypes(data, expected_dtype):
     os.remove('foo.nc')
 
 
+class TestEncodeTimes(unittest.TestCase):
+
+    def setUp(self):
+        self.times = pd.Series(pd.to_datetime(['1990-01-01 00:00:00', '1990-01-01 01:30:00', None]))
+
+    def test_naive_seconds(self):
+        r = encode_times(self.times, 'seconds since 1990-01-01 00:00:00')
+        assert np.issubdtype(r.dtype, np.integer)
+        assert r[0] == 0
+        assert r[1] == 5400
+        assert r.mask.tolist() == [False, False, True]
+
+    def test_tz_aware(self):
+        eastern = self.times.dt.tz_localize('US/Eastern')
+        r = encode_times(eastern, 'seconds since 1990-01-01T00:00:00Z')
+        assert r[0] == 5 * 3600
+        assert r[1] == 5 * 3600 + 5400
+        assert r[2] is np.ma.masked
+
+    def test_fractional_units(self):
+        r = encode_times(self.times, 'hours since 1990-01-01')
+        assert np.isclose(r[1], 1.5)
+
+        r = encode_times(self.times, 'hours since 1990-01-01', integer=True)
+        assert np.issubdtype(r.dtype, np.integer)
+        assert r[1] == 1
+
+    def test_bad_units(self):
+        with self.assertRaises(ValueError):
+            encode_times(self.times, 'months since 1990-01-01')
+        with self.assertRaises(ValueError):
+            encode_times(self.times, 'seconds')
+
+
+class TestDecodeTimes(unittest.TestCase):
+
+    def test_round_trip(self):
+        times = pd.Series(pd.to_datetime(['1990-01-01 00:00:00', '1990-01-01 01:30:00', None]))
+        r = decode_times(encode_times(times, 'seconds since 1990-01-01 00:00:00'), 'seconds since 1990-01-01 00:00:00')
+        assert r.dtype == np.dtype('datetime64[ns]')
+        assert r[:2].tolist() == times.values[:2].tolist()
+        assert np.isnat(r[2])
+
+    def test_fractional_units(self):
+        values = np.ma.MaskedArray([0, 1.5, np.nan, 2], mask=[False, False, False, True])
+        r = decode_times(values, 'hours since 1990-01-01T00:00:00Z')
+        assert r[1] == np.datetime64('1990-01-01T01:30:00')
+        assert np.isnat(r[2:]).all()
+
+    def test_matches_num2date(self):
+        values = np.array([0, 86400.25, 1e9 + 0.5])
+        units = 'seconds since 1970-01-01'
+        expected = np.array(nc4.num2date(values, units), dtype='datetime64[ns]')
+        assert (abs(decode_times(values, units) - expected) < np.timedelta64(1, 'ms')).all()
+
+    def test_fractions_match_num2date(self):
+        # Float noise below a microsecond is rounded away like num2date does,
+        # which is itself only accurate to a few microseconds in older netCDF4
+        values = np.array([1.5e9 + 0.1, 1.5e9 + 0.749, 86400.000001, -0.3])
+        units = 'seconds since 1970-01-01'
+        r = decode_times(values, units)
+        assert r.tolist() == pd.to_datetime([
+            '2017-07-14 02:40:00.100000', '2017-07-14 02:40:00.749000',
+            '1970-01-02 00:00:00.000001', '1969-12-31 23:59:59.700000'
+        ]).values.tolist()
+        expected = np.array(nc4.num2date(values, units), dtype='datetime64[ns]')
+        assert (abs(r - expected) < np.timedelta64(1, 'ms')).all()
+        assert (r.astype(np.int64) % 1000 == 0).all()
+
+    def test_other_calendars(self):
+        r = decode_times(np.array([0, 360]), 'days since 2000-01-01', calendar='360_day')
+        assert r.dtype == object
+        assert r[1].year == 2001
+
+        # Dates outside of the datetime64[ns] range
+        r = decode_times(np.array([0, 1]), 'days since 0001-01-01')
+        assert r.dtype == object
+        assert r[1].day == 2
+
+
+class TestPaddedArrays(unittest.TestCase):
+
+    def test_padded_index(self):
+        instances, index, counts, first_rows = padded_index(['b', 'a', 'b', 'b', 'a'])
+        assert instances.tolist() == ['a', 'b']
+        assert index[0].tolist() == [1, 0, 1, 1, 0]
+        assert index[1].tolist() == [0, 0, 1, 2, 1]
+        assert counts.tolist() == [2, 3]
+        assert first_rows.tolist() == [1, 0]
+
+    def test_padded_array(self):
+        _, index, counts, _ = padded_index([1, 0, 1])
+        padded = padded_array(np.array([1.5, np.nan, 3.5]), index, (2, 2), -9999.9)
+        assert padded.tolist() == [[-9999.9, -9999.9], [1.5, 3.5]]
+
+        strings = padded_array(np.array(['x', None, 'zz'], dtype=object), index, (2, 2))
+        assert strings.dtype == object
+        assert strings.tolist() == [['', ''], ['x', 'zz']]
+
+
 class TestUtils(unittest.TestCase):
 
     def setUp(self):
@@ -118,3 +220,47 @@ class TestNetcdfUtils(unittest.TestCase):
         self.assertEqual('foo_99', cf_safe_name('foo-99'))
         self.assertEqual('foo_99_', cf_safe_name('foo(99)'))
         self.assertEqual('v__foo_99_', cf_safe_name('_foo(99)'))
+
+    def test_feature_batches(self):
+        from pyaxiom.netcdf.utils import feature_batches
+        sizes = [10, 20, 5, 40, 0, 3]
+        self.assertEqual(feature_batches(sizes), [(0, 6)])
+        self.assertEqual(feature_batches(sizes, 30), [(0, 2), (2, 3), (3, 4), (4, 6)])
+        self.assertEqual(feature_batches(sizes, 1), [(0, 1), (1, 2), (2, 3), (3, 4), (4, 6)])
+        self.assertEqual(feature_batches([], 30), [])
+        self.assertEqual(feature_batches([]), [])
+
+    def test_chunk_layout(self):
+        from pyaxiom.netcdf.utils import ChunkLayout, chunk_cache
+        dims = ('profile', 'z')
+
+        # One whole profile per chunk
+        per_instance = ChunkLayout('per-instance', 'profile', 'z', 1000, 500)
+        self.assertEqual(per_instance.chunksizes(dims, 'f8'), (16, 500))
+        self.assertEqual(per_instance.chunksizes(('profile',), 'f8'), (1000,))
+
+        # Whole profiles, many of them per chunk
+        scan = ChunkLayout('per-variable-scan', 'profile', 'z', 1000, 500)
+        self.assertEqual(scan.chunksizes(dims, 'f8'), (1000, 500))
+
+        balanced = ChunkLayout('balanced', 'profile', 'z', 1000, 500)
+        self.assertEqual(balanced.chunksizes(dims, 'f8'), (362, 362))
+
+        # Ragged chunks hold about one profile, but not less than 4 KiB
+        ragged = ChunkLayout('per-instance', 'profile', 'obs', 50, 100000, ragged=True)
+        self.assertEqual(ragged.chunksizes(('obs',), 'f4'), (2000,))
+        ragged = ChunkLayout('per-instance', 'profile', 'obs', 1000, 100000, ragged=True)
+        self.assertEqual(ragged.chunksizes(('obs',), 'f4'), (1024,))
+
+        # Library defaults
+        self.assertIsNone(ChunkLayout(None, 'profile', 'z', 1000, 500).chunksizes(dims, 'f8'))
+        self.assertEqual(ChunkLayout(None, 'profile', 'z', 1000, 500).attributes(), {})
+
+        with self.assertRaises(ValueError):
+            ChunkLayout('random', 'profile', 'z', 1000, 500)
+
+        size, nelems, preemption = chunk_cache('per-variable-scan', (1000, 500), (1000, 500), 8)
+        self.assertEqual(size, 1000 * 500 * 8)
+        self.assertEqual(preemption, 1.0)
+        size, nelems, preemption = chunk_cache('balanced', (1000, 500), (362, 362), 8)
+        self.assertEqual(size, 362 * 362 * 8 * 4)
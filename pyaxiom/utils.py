@@ -5,9 +5,11 @@ import random
 import string
 import operator
 import itertools
+from datetime import datetime
 import simplejson as json
 
 import numpy as np
+import pandas as pd
 import netCDF4 as nc4
 
 from pyaxiom.urn import IoosUrn
@@ -58,7 +60,10 @@ def normalize_array(var):
             return var[:]
 
         def decoder(x):
-            return str(x.decode('utf-8'))
+            # Newer netCDF4 versions return str from chartostring already
+            if isinstance(x, bytes):
+                x = x.decode('utf-8')
+            return str(x)
         vfunc = np.vectorize(decoder)
         return vfunc(nc4.chartostring(var[:]))
     else:
@@ -152,6 +157,186 @@ def get_dtype(obj):
         return type(obj)
 
 
+# Nanoseconds in each of the "<unit> since <epoch>" units we can handle with
+# integer arithmetic. Months and years are calendar dependent and excluded.
+TIME_UNIT_NANOSECONDS = {
+    'microseconds': 1000,
+    'microsecond': 1000,
+    'us': 1000,
+    'milliseconds': 1000000,
+    'millisecond': 1000000,
+    'msec': 1000000,
+    'ms': 1000000,
+    'seconds': 1000000000,
+    'second': 1000000000,
+    'secs': 1000000000,
+    'sec': 1000000000,
+    's': 1000000000,
+    'minutes': 60 * 1000000000,
+    'minute': 60 * 1000000000,
+    'mins': 60 * 1000000000,
+    'min': 60 * 1000000000,
+    'hours': 3600 * 1000000000,
+    'hour': 3600 * 1000000000,
+    'hrs': 3600 * 1000000000,
+    'hr': 3600 * 1000000000,
+    'h': 3600 * 1000000000,
+    'days': 86400 * 1000000000,
+    'day': 86400 * 1000000000,
+    'd': 86400 * 1000000000,
+}
+
+
+def parse_time_units(units):
+    """
+    Splits a CF "<unit> since <epoch>" string into the number of nanoseconds
+    in one unit and the epoch as nanoseconds since 1970-01-01 UTC.
+    Raises a ValueError for units that are not a fixed number of seconds.
+    """
+    try:
+        unit, epoch = units.split(' since ', 1)
+    except (AttributeError, ValueError):
+        raise ValueError("Time units must look like '<unit> since <epoch>', got {}".format(units))
+
+    unit = unit.strip().lower()
+    if unit not in TIME_UNIT_NANOSECONDS:
+        raise ValueError("Time unit '{}' is not a fixed length unit".format(unit))
+
+    # A Timestamp's value is always nanoseconds since the epoch in UTC
+    epoch = pd.Timestamp(epoch.strip())
+    return TIME_UNIT_NANOSECONDS[unit], epoch.value
+
+
+def encode_times(times, units, integer=False):
+    """
+    Returns a masked array of numeric offsets for `times` in a CF
+    "<unit> since <epoch>" `units` string using integer numpy arithmetic.
+    `times` can be anything pandas can turn into a DatetimeIndex (datetime64
+    columns, tz-aware or naive, or python datetimes). Naive times are treated
+    as UTC and NaT values are masked. Offsets are integers when they are all
+    whole units, floats otherwise. Use `integer=True` to floor them to whole
+    units instead.
+    """
+    unit_ns, epoch_ns = parse_time_units(units)
+
+    index = pd.DatetimeIndex(pd.to_datetime(times))
+    # The values of a tz-aware index are already in UTC
+    ns = np.asarray(index.values).astype('datetime64[ns]').astype(np.int64)
+    mask = np.asarray(pd.isnull(index))
+
+    offsets = ns - epoch_ns
+    offsets[mask] = 0
+
+    if integer is True or not np.any(offsets % unit_ns):
+        encoded = offsets // unit_ns
+    else:
+        encoded = offsets / unit_ns
+
+    return np.ma.MaskedArray(encoded, mask=mask)
+
+
+# Calendars that match numpy's proleptic gregorian datetime64 over the
+# datetime64[ns] range (1677 - 2262)
+GREGORIAN_CALENDARS = ['standard', 'gregorian', 'proleptic_gregorian']
+
+
+def decode_times(values, units, calendar='standard'):
+    """
+    Returns a datetime64[ns] array of the numeric offsets in `values` from a
+    CF "<unit> since <epoch>" `units` string. Masked and NaN values are NaT.
+    Gregorian calendars with fixed length units are decoded with integer
+    numpy arithmetic, anything else falls back to netCDF4.num2date and
+    returns its datetime objects when they are not representable as
+    datetime64[ns] (e.g. a 360_day calendar).
+    """
+    mask = np.ma.getmaskarray(values)
+    values = np.ma.getdata(values)
+    if np.issubdtype(values.dtype, np.floating):
+        mask = mask | np.isnan(values)
+    values = np.where(mask, 0, values)
+
+    if values.size == 0:
+        return np.empty(values.shape, dtype='datetime64[ns]')
+
+    if (calendar or 'standard').lower() not in GREGORIAN_CALENDARS:
+        return _num2date(values, mask, units, calendar)
+
+    try:
+        unit_ns, epoch_ns = parse_time_units(units)
+    except ValueError:
+        return _num2date(values, mask, units, calendar)
+
+    # Stay inside of the int64 nanoseconds of datetime64[ns]
+    bounds = np.array([values.min(), values.max()], dtype=np.float64) * unit_ns + epoch_ns
+    if not np.all(np.abs(bounds) < 2 ** 63 - 1):
+        return _num2date(values, mask, units, calendar)
+
+    if np.issubdtype(values.dtype, np.integer):
+        ns = values.astype(np.int64) * unit_ns
+    else:
+        # Whole units are exact, only the fractions are rounded, to whole
+        # microseconds like num2date so float noise doesn't show up
+        whole = np.floor(values)
+        ns = whole.astype(np.int64) * unit_ns + (np.round((values - whole) * unit_ns / 1000) * 1000).astype(np.int64)
+
+    times = np.asarray(ns + epoch_ns).astype('datetime64[ns]')
+    times[mask] = np.datetime64('NaT')
+    return times
+
+
+def _num2date(values, mask, units, calendar):
+    dates = np.asarray(nc4.num2date(values, units, calendar or 'standard'), dtype=object)
+    if all( isinstance(d, datetime) for d in dates.flat ):
+        try:
+            times = np.asarray(pd.to_datetime(dates.ravel()).values).reshape(dates.shape)
+            times[mask] = np.datetime64('NaT')
+            return times
+        except (ValueError, OverflowError):
+            # Outside of the datetime64[ns] range
+            pass
+    dates[mask] = None
+    return dates
+
+
+def padded_index(labels):
+    """
+    Positions of rows in a padded (instance, position) array, the layout of
+    the incomplete multidimensional DSG files. `labels` are the instance of
+    each row, positions count the rows of each instance in the order they
+    appear. Returns the sorted unique instances, an index tuple to scatter
+    the rows with, the row count of each instance and the first row of each.
+    """
+    instances, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    counts = np.bincount(inverse, minlength=instances.size)
+    starts = np.cumsum(counts) - counts
+
+    positions = np.empty(inverse.size, dtype=np.int64)
+    positions[order] = np.arange(order.size) - starts[inverse[order]]
+    return instances, (inverse, positions), counts, order[starts]
+
+
+def padded_array(values, index, shape, fill_value=None):
+    """
+    Scatters `values` into a new array of `shape` at `index` (see
+    `padded_index`). Empty cells and NaN values are `fill_value`.
+    Strings are padded as a fixed width array and returned as objects
+    with '' in the empty cells.
+    """
+    values = np.asarray(values)
+    if values.dtype == object or values.dtype.kind in ['S', 'U']:
+        values = np.where(pd.isnull(values), '', values).astype(np.unicode_)
+        padded = np.zeros(shape, dtype=values.dtype)
+        padded[index] = values
+        return padded.astype(object)
+
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), fill_value, values)
+    padded = np.full(shape, fill_value, dtype=values.dtype)
+    padded[index] = values
+    return padded
+
+
 def dict_update(d, u):
     # http://stackoverflow.com/a/3233356
     import collections